@@ -0,0 +1,264 @@
+"""
+Bit-level I/O for the codes in this package.
+
+A code only knows which bits to write and how to read them back. Where those bits end up is up to the writer/reader:
+  - PackedBitWriter/PackedBitReader store 8 bits per byte, which is what an index would actually keep in memory or on disk;
+  - StringBitWriter/StringBitReader store one "0"/"1" character per bit, which is what you want to look at when debugging.
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class PackedEncoding:
+    """
+    Bits packed into bytes, most significant bit first. The last byte is padded with zeroes, which is why the amount of
+    bits has to be stored separately.
+    """
+    data: bytes
+    n_bits: int
+
+    def __len__(self):
+        return self.n_bits
+
+    def __str__(self) -> str:
+        """The debug view, i.e. the same "0"/"1" string that the string-based codes produce."""
+        if not self.data:
+            return ""
+        return bin(int.from_bytes(self.data, "big"))[2:].zfill(8*len(self.data))[:self.n_bits]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    @staticmethod
+    def fromString(bits: str) -> "PackedEncoding":
+        writer = PackedBitWriter()
+        writer.writeBits(bits)
+        return writer.finish()
+
+
+class BitWriter(ABC):
+
+    def __init__(self):
+        self.n_bits = 0
+
+    def __len__(self):
+        return self.n_bits
+
+    @abstractmethod
+    def write(self, value: int, width: int):
+        """
+        Write the `width` least significant bits of the given non-negative integer, most significant bit first.
+        The value is assumed to fit in that width.
+        """
+        pass
+
+    def writeBits(self, bits: str):
+        if bits:
+            self.write(int(bits, 2), len(bits))
+
+    def writeUnary(self, n: int):  # n-1 zeroes and a one, i.e. the number 1 in n bits.
+        self.write(1, n)
+
+    @abstractmethod
+    def finish(self):
+        pass
+
+
+class BitReader(ABC):
+
+    def __init__(self, n_bits: int, start: int=0):
+        self.n_bits   = n_bits
+        self.position = start
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, position: int):
+        self.position = position
+
+    def isExhausted(self) -> bool:
+        return self.position >= self.n_bits
+
+    @abstractmethod
+    def read(self, width: int) -> int:
+        """Read the next `width` bits as an unsigned integer and move past them."""
+        pass
+
+    @abstractmethod
+    def readUnary(self) -> int:
+        """Read zeroes up to and including the next one. Returns how many bits that was."""
+        pass
+
+    def peek(self, width: int) -> int:
+        """Like read(), but without moving. Bits past the end are read as zeroes."""
+        start = self.position
+        available = min(width, self.n_bits - start)
+        value = self.read(available)
+        self.position = start
+        return value << (width - available)
+
+
+class PackedBitWriter(BitWriter):
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+        self.accumulator = 0  # Bits that haven't been flushed to the buffer yet.
+        self.pending     = 0  # Amount of such bits.
+
+    def write(self, value: int, width: int):
+        self.accumulator = (self.accumulator << width) | value
+        self.pending += width
+        self.n_bits  += width
+        if self.pending >= 64:  # Flush all full bytes. Keeping the accumulator small keeps the shifts cheap.
+            leftover = self.pending & 7
+            self.buffer += (self.accumulator >> leftover).to_bytes(self.pending >> 3, "big")
+            self.accumulator &= (1 << leftover) - 1
+            self.pending = leftover
+
+    def finish(self) -> PackedEncoding:
+        padding = -self.pending % 8
+        tail = (self.accumulator << padding).to_bytes((self.pending + padding) // 8, "big")
+        return PackedEncoding(data=bytes(self.buffer) + tail, n_bits=self.n_bits)
+
+
+class PackedBitReader(BitReader):
+    """
+    Reads from anything that supports slicing into bytes, so also from a memoryview or mmap.
+    """
+
+    def __init__(self, encoding: PackedEncoding, start: int=0):
+        super().__init__(encoding.n_bits, start)
+        self.data = encoding.data
+
+    def read(self, width: int) -> int:
+        if width == 0:
+            return 0
+
+        end = self.position + width
+        if end > self.n_bits:
+            raise EOFError(f"Tried to read {width} bits at position {self.position} of a {self.n_bits}-bit encoding.")
+
+        first_byte = self.position >> 3
+        end_byte   = (end + 7) >> 3
+        chunk = int.from_bytes(self.data[first_byte:end_byte], "big")
+        self.position = end
+        return (chunk >> ((end_byte << 3) - end)) & ((1 << width) - 1)
+
+    def readUnary(self) -> int:
+        start = self.position
+        byte_index = start >> 3
+        try:
+            byte = self.data[byte_index] & (0xFF >> (start & 7))  # Ignore the bits before the cursor.
+            while byte == 0:
+                byte_index += 1
+                byte = self.data[byte_index]
+        except IndexError:
+            raise EOFError(f"No terminating one after position {start}.")
+
+        one = (byte_index << 3) + 8 - byte.bit_length()
+        if one >= self.n_bits:
+            raise EOFError(f"No terminating one after position {start}.")
+        self.position = one + 1
+        return one + 1 - start
+
+    def peek(self, width: int) -> int:
+        end = self.position + width
+        if end > self.n_bits:
+            return super().peek(width)
+
+        end_byte = (end + 7) >> 3
+        chunk = int.from_bytes(self.data[self.position >> 3:end_byte], "big")
+        return (chunk >> ((end_byte << 3) - end)) & ((1 << width) - 1)
+
+
+class StringBitWriter(BitWriter):
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+
+    def write(self, value: int, width: int):
+        if width:
+            self.parts.append(bin(value)[2:].zfill(width))
+            self.n_bits += width
+
+    def writeBits(self, bits: str):
+        self.parts.append(bits)
+        self.n_bits += len(bits)
+
+    def finish(self) -> str:
+        return "".join(self.parts)
+
+
+class StringBitReader(BitReader):
+
+    def __init__(self, encoding: str, start: int=0):
+        super().__init__(len(encoding), start)
+        self.data = encoding
+
+    def read(self, width: int) -> int:
+        if width == 0:
+            return 0
+
+        end = self.position + width
+        if end > self.n_bits:
+            raise EOFError(f"Tried to read {width} bits at position {self.position} of a {self.n_bits}-bit encoding.")
+
+        value = int(self.data[self.position:end], 2)
+        self.position = end
+        return value
+
+    def readUnary(self) -> int:
+        start = self.position
+        one = self.data.find("1", start)
+        if one < 0:
+            raise EOFError(f"No terminating one after position {start}.")
+        self.position = one + 1
+        return one + 1 - start
+
+
+def packFields(values: np.ndarray, widths: np.ndarray, offsets: np.ndarray, n_bits: int) -> PackedEncoding:
+    """
+    Vectorised counterpart to calling BitWriter.write(value, width) many times: writes every value in its given width,
+    most significant bit first, starting at its given bit offset. Fields can be given in any order, but shouldn't overlap.
+    """
+    values  = np.asarray(values, dtype=np.uint64)
+    widths  = np.asarray(widths, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    field_of_bit  = np.repeat(np.arange(len(values)), widths)
+    bit_in_field  = np.arange(len(field_of_bit)) - np.repeat(np.cumsum(widths) - widths, widths)
+    shifts = (widths[field_of_bit] - 1 - bit_in_field).astype(np.uint64)
+
+    bits = np.zeros(n_bits, dtype=np.uint8)
+    bits[offsets[field_of_bit] + bit_in_field] = (values[field_of_bit] >> shifts) & np.uint64(1)
+    return PackedEncoding(data=np.packbits(bits).tobytes(), n_bits=n_bits)
+
+
+def unpackFields(encoding: PackedEncoding, widths: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Vectorised counterpart to calling BitReader.read(width) at many positions. Inverse of packFields.
+    """
+    widths  = np.asarray(widths, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    bits = np.unpackbits(np.frombuffer(encoding.data, dtype=np.uint8), count=encoding.n_bits)
+
+    result = np.zeros(len(widths), dtype=np.uint64)
+    nonempty = np.flatnonzero(widths)  # Zero-width fields are 0, and would confuse reduceat below.
+    widths  = widths[nonempty]
+    offsets = offsets[nonempty]
+    if len(nonempty) == 0:
+        return result
+
+    field_starts = np.cumsum(widths) - widths
+    field_of_bit = np.repeat(np.arange(len(widths)), widths)
+    bit_in_field = np.arange(len(field_of_bit)) - field_starts[field_of_bit]
+    shifts = (widths[field_of_bit] - 1 - bit_in_field).astype(np.uint64)
+
+    result[nonempty] = np.add.reduceat(bits[offsets[field_of_bit] + bit_in_field].astype(np.uint64) << shifts, field_starts)
+    return result
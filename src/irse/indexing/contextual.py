@@ -1,8 +1,19 @@
-from typing import Iterable, List
-from irse.indexing.nonparametric import Code, Encoding, Decoding, GammaCode, toBinary
+from typing import Iterable, Iterator, List, Union
+import numpy as np
+
+from irse.indexing.nonparametric import Code, Encoding, Decoding, GammaCode
+from irse.indexing.bits import BitWriter, BitReader, PackedEncoding, PackedBitReader, StringBitWriter
 
 
 class InterpolativeCode(Code):
+    """
+    Binary interpolative coding of a strictly increasing list of positive integers (e.g. document IDs, not gaps).
+
+    The list is encoded by its length, its first element and the difference between its last and first element, after
+    which the middle element is encoded relative to the range that the first and last element leave for it, and the
+    same is done for the left and right half. Both halves are processed with an explicit stack of index ranges into the
+    one list, so nothing is copied, nothing is concatenated, and long lists don't run into Python's recursion limit.
+    """
 
     def __init__(self):
         self.initial_code = GammaCode()
@@ -13,83 +24,95 @@ class InterpolativeCode(Code):
     def decode(self, target: Encoding) -> Decoding:
         raise RuntimeError("Interpolative code doesn't exist for individual numbers.")
 
-    def encodeMany(self, source: Iterable[int]) -> Encoding:
-        L = list(source)
-        return self.initial_code.encode(len(L)) \
-               + self.initial_code.encode(L[0]) \
-               + self.initial_code.encode(L[-1] - L[0]) \
-               + self._encodeInternals(L)
+    def read(self, reader: BitReader) -> int:
+        raise RuntimeError("Interpolative code doesn't exist for individual numbers.")
 
-    def _encodeInternals(self, source: List[int]) -> Encoding:
+    def encodeMany(self, source: Iterable[int]) -> Encoding:
+        writer = StringBitWriter()
+        self.writeMany(source, writer)
+        return writer.finish()
+
+    def writeMany(self, source: Union[Iterable[int], np.ndarray], writer: BitWriter):
+        L = source.tolist() if isinstance(source, np.ndarray) else list(source)
+        if not L:
+            return
+
+        self.initial_code.write(len(L), writer)
+        self.initial_code.write(L[0], writer)
+        if len(L) > 1:  # A difference of 0 has no gamma code, and it isn't needed either.
+            self.initial_code.write(L[-1] - L[0], writer)
+
+        # Encodes everything except the first and last element of each range, which have been encoded already.
+        # The left range is pushed last so that it is popped first, which gives the same bit order as recursing would.
+        stack = [(0, len(L)-1)]
+        while stack:
+            first, last = stack.pop()
+            n = last - first + 1
+            if n < 3:
+                continue
+
+            mid_index = n // 2
+            minimum_possible = L[first] + mid_index          # If you're at [1], you have to be at least L[0] + 1.
+            maximum_possible = L[last]  - (n-1 - mid_index)  # If you're at [len(L)-2], you can be at most L[len(L)-1] - 1.
+
+            # Note: 16 possible values can be encoded with 4 bits, 8 with 3 bits, 4 with 2 bits, 2 with 1 bit, so 1 should be encoded with 0 bits.
+            #       This number can still be recovered because the decoder can always compute the length of the next value and will hence find that it should look for a 0-width number.
+            if maximum_possible > minimum_possible:
+                writer.write(L[first + mid_index] - minimum_possible, (maximum_possible - minimum_possible).bit_length())
+
+            stack.append((first + mid_index, last))
+            stack.append((first, first + mid_index))
+
+    def _readInto(self, reader: BitReader, values: List[int]) -> int:
+        """
+        Decodes one encoded list into the start of the given preallocated list. Returns the list's length.
+        """
+        n = self.initial_code.read(reader)
+        values[0]   = self.initial_code.read(reader)
+        values[n-1] = values[0] + (self.initial_code.read(reader) if n > 1 else 0)
+
+        stack = [(0, n-1)]
+        while stack:
+            first, last = stack.pop()
+            size = last - first + 1
+            if size < 3:
+                continue
+
+            # We know that the encoder padded the mid value to a width that was independent of the value itself, using
+            # only the value of the boundaries and the index of the value in the list (size//2).
+            mid_index = size // 2
+            minimum_possible = values[first] + mid_index
+            maximum_possible = values[last]  - (size-1 - mid_index)
+            values[first + mid_index] = minimum_possible + reader.read((maximum_possible - minimum_possible).bit_length())
+
+            stack.append((first + mid_index, last))
+            stack.append((first, first + mid_index))
+
+        return n
+
+    def readMany(self, reader: BitReader) -> Iterator[int]:
+        while not reader.isExhausted():
+            start = reader.tell()
+            n = self.initial_code.read(reader)
+            reader.seek(start)
+
+            values = [0]*n
+            self._readInto(reader, values)
+            yield from values
+
+    def decodeArray(self, target: PackedEncoding) -> np.ndarray:
         """
-        Encodes everything except the first and last element, which are assumed to have been encoded already.
+        Decodes all the lists in the given encoding into one array. Every list is written straight into a preallocated
+        buffer, whose size is known as soon as the length at the start of the list has been read.
         """
-        if len(source) < 3:
-            return ""
-
-        mid_index = len(source) // 2
-
-        minimum_possible = source[0]  + mid_index                    # If you're at [1], you have to be at least L[0] + 1.
-        maximum_possible = source[-1] - (len(source)-1 - mid_index)  # If you're at [len(L)-2], you can be at most L[len(L)-1] - 1.
-        possible_values = maximum_possible - minimum_possible + 1
-
-        mid_value = source[mid_index]
-        shifted_mid_value = mid_value - minimum_possible  # The result ranges from 0 up to (not including) possible_values.
-
-        # print(f"{mid_value} in [{minimum_possible},{maximum_possible}] is offset by {shifted_mid_value} ({toBinary(shifted_mid_value).zfill(len(toBinary(possible_values-1)))}) inside the {possible_values} values.")
-        # Note: 16 possible values can be encoded with 4 bits, 8 with 3 bits, 4 with 2 bits, 2 with 1 bit, so 1 should be encoded with 0 bits.
-        #       This number can still be recovered because the decoder can always compute the length of the next value and will hence find that it should look for a 0-width number.
-        return (toBinary(shifted_mid_value).zfill(len(toBinary(possible_values-1))) if possible_values > 1 else "") \
-            + self._encodeInternals(source[:mid_index+1]) \
-            + self._encodeInternals(source[mid_index:])
-
-    def decodeMany(self, target: Encoding) -> Iterable[int]:
-        while target:
-            # Decode preamble
-            head = 0
-            n, extra_head = self.initial_code.decode(target[head:])
-            head += extra_head
-            L1, extra_head = self.initial_code.decode(target[head:])
-            head += extra_head
-            diff, extra_head = self.initial_code.decode(target[head:])
-            head += extra_head
-            Ln = L1 + diff
-
-            # Decode recursively
-            inner_values, extra_head = self._decodeInternals(target[head:], n, L1, Ln)
-            head += extra_head
-            target = target[head:]
-
-            values = [L1] + inner_values + [Ln]
-            for value in values:
-                yield value
-
-    def _decodeInternals(self, target: Encoding, n, L1, Ln):
-        if n < 3:
-            return [], 0
-
-        # We know that we padded the result of the first recursive call by an amount of zeroes that was independent of
-        # the value we encoded, using only the value of the boundaries and the index of the value in the list (n//2).
-        mid_index = n//2
-
-        minimum_possible = L1 + mid_index
-        maximum_possible = Ln - (n-1 - mid_index)
-        possible_values = maximum_possible - minimum_possible + 1
-
-        # mid_value = source[mid_index]
-        # shifted_mid_value = mid_value - minimum_possible  # The result ranges from 0 up to (not including) possible_values.
-
-        if possible_values > 1:
-            head      = len(toBinary(possible_values - 1))
-            mid_value = int(target[:head], 2)
-        else:
-            head      = 0
-            mid_value = 0
-
-        mid_value += minimum_possible
-
-        decoded_left_half, extra_head = self._decodeInternals(target[head:], mid_index+1, L1, mid_value)
-        head += extra_head
-        decoded_right_half, extra_head = self._decodeInternals(target[head:], n-1 - mid_index + 1, mid_value, Ln)
-        head += extra_head
-        return decoded_left_half + [mid_value] + decoded_right_half, head
+        reader = PackedBitReader(target)
+        arrays = []
+        while not reader.isExhausted():
+            start = reader.tell()
+            n = self.initial_code.read(reader)
+            reader.seek(start)
+
+            values = [0]*n  # Python ints are much faster to do arithmetic on than NumPy scalars.
+            self._readInto(reader, values)
+            arrays.append(np.array(values, dtype=np.int64))
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
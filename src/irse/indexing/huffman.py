@@ -1,14 +1,104 @@
-from typing import Iterable, Dict, Tuple, List
-from collections import Counter
+from typing import Iterable, Dict, Tuple, List, Hashable
+from collections import Counter, defaultdict
+from bisect import bisect_right
+from heapq import merge
 from dataclasses import dataclass
 import numpy as np
 
-from irse.indexing.nonparametric import Code, Encoding, Decoding, ONE, ZERO, toBinary
+from irse.indexing.nonparametric import Code, Encoding, Decoding, ONE, ZERO, toBinary, bitLengths
+from irse.indexing.bits import BitWriter, BitReader, StringBitReader, PackedEncoding, packFields
 
 
 CanonicalCodebook = Tuple[List[str], List[int]]
 
 
+def huffmanMerges(weights: List[int]) -> List[Tuple[int,int]]:
+    """
+    Huffman's algorithm, without building a tree. Returns, for every merge in order, the indices of the lightest and the
+    second-lightest node that were merged. Index i < n refers to the i'th weight, and index n+m to the result of merge m.
+
+    Rather than re-sorting or using a heap, this uses two queues: the leaves, sorted once, and the merged nodes, which
+    are created in order of increasing weight and hence stay sorted by themselves. The lightest node is always at the
+    front of one of the two. That's O(n log n) for the sort, and O(n) for the merging.
+    Ties are broken the same way as repeatedly inserting into one sorted list would: leaves before merged nodes, later
+    leaves before earlier leaves, and earlier merged nodes before later merged nodes.
+    """
+    n = len(weights)
+    leaves = sorted(range(n), key=lambda i: (weights[i], -i))
+    leaf_head = 0
+    merged_weights = []
+    merged_head = 0
+
+    merges = []
+    for _ in range(n-1):
+        popped = []
+        popped_weight = 0
+        for _ in range(2):
+            if merged_head < len(merged_weights) and (leaf_head == n or merged_weights[merged_head] < weights[leaves[leaf_head]]):
+                popped.append(n + merged_head)
+                popped_weight += merged_weights[merged_head]
+                merged_head += 1
+            else:
+                popped.append(leaves[leaf_head])
+                popped_weight += weights[leaves[leaf_head]]
+                leaf_head += 1
+        merges.append((popped[0], popped[1]))
+        merged_weights.append(popped_weight)
+
+    return merges
+
+
+def huffmanCodeLengths(weights: List[int]) -> List[int]:
+    """
+    Codeword lengths of a Huffman code for the given weights, i.e. the depth of every leaf in the Huffman tree.
+    """
+    n = len(weights)
+    depths = [0]*(2*n-1)
+    merges = huffmanMerges(weights)
+    for m in reversed(range(len(merges))):  # A merged node is always created after its children, so go from the root downwards.
+        lightest, second_lightest = merges[m]
+        depths[lightest] = depths[second_lightest] = depths[n+m] + 1
+    return depths[:n]
+
+
+def lengthLimitedCodeLengths(weights: List[int], max_length: int) -> List[int]:
+    """
+    Codeword lengths of the best prefix code whose codewords are no longer than max_length, using the package-merge
+    algorithm. You need this when a Huffman code for a skewed distribution has very long codewords, e.g. to keep
+    decoding tables small.
+
+    Package-merge treats every symbol as a coin with a face value equal to its weight, available in every denomination
+    2^-1 ... 2^-max_length. The cheapest set of coins worth n-1 is found by repeatedly pairing up ("packaging") the
+    coins of the smallest denomination and merging those packages into the next denomination. A symbol's codeword length
+    is then the amount of its coins in that set. Runs in O(n * max_length).
+    """
+    n = len(weights)
+    if n == 1:
+        return [0]
+    if n > 2**max_length:
+        raise ValueError(f"Cannot give {n} symbols a codeword of at most {max_length} bits.")
+
+    leaves = sorted(((weights[i], i) for i in range(n)))  # An item (weight, reference) refers to symbol i if i >= 0 ...
+    package_children = []                                # ... and to the package at -i-1 otherwise.
+    items = leaves
+    for _ in range(max_length-1):
+        packages = []
+        for j in range(0, len(items)-1, 2):
+            package_children.append((items[j][1], items[j+1][1]))
+            packages.append((items[j][0] + items[j+1][0], -len(package_children)))
+        items = list(merge(leaves, packages, key=lambda item: item[0]))
+
+    lengths = [0]*n
+    stack = [reference for _, reference in items[:2*n-2]]
+    while stack:  # Every package is part of at most one other package, so this visits every package at most once.
+        reference = stack.pop()
+        if reference >= 0:
+            lengths[reference] += 1
+        else:
+            stack.extend(package_children[-reference-1])
+    return lengths
+
+
 @dataclass
 class HuffmanTree:
 
@@ -23,7 +113,7 @@ class HuffmanTree:
     def __add__(self, other: "HuffmanTree") -> "HuffmanTree":
         return HuffmanTree(
             weight=self.weight + other.weight,
-            name=self.name + other.name,
+            name=None,  # Only leaves have a name. Concatenating the names of the children takes quadratic time in total.
             left=self,
             right=other
         )
@@ -32,11 +122,16 @@ class HuffmanTree:
         return self.left is None and self.right is None
 
     def getCodebook(self) -> Dict[str,str]:
-        if self.isLeaf():  # You are a lone node.
-            return {self.name: ""}
-        else:
-            return {k: ZERO + v for k,v in self.left.getCodebook().items()} \
-                 | {k: ONE  + v for k,v in self.right.getCodebook().items()}
+        codebook = dict()
+        stack = [(self, "")]
+        while stack:
+            node, codeword = stack.pop()
+            if node.isLeaf():
+                codebook[node.name] = codeword
+            else:
+                stack.append((node.right, codeword + ONE))
+                stack.append((node.left,  codeword + ZERO))
+        return codebook
 
     def getCodebookCanonical(self) -> CanonicalCodebook:
         codebook = self.getCodebook()
@@ -44,80 +139,195 @@ class HuffmanTree:
 
     @staticmethod
     def fromCodebook(codebook: Dict[str,str]) -> "HuffmanTree":
-        if len(codebook) == 1:
-            assert all(len(v) == 0 for v in codebook.values())
-
-            key, codeword = codebook.popitem()
-            codebook[key] = codeword  # Don't want to alter the codebook.
-            return HuffmanTree(
-                weight=0,
-                name=key
-            )
-        else:
-            assert all(len(v) > 0 for v in codebook.values())
-
-            left_codewords  = {k: v[1:] for k,v in codebook.items() if v[0] == ZERO}
-            right_codewords = {k: v[1:] for k,v in codebook.items() if v[0] == ONE}
-
-            return HuffmanTree.fromCodebook(left_codewords) + HuffmanTree.fromCodebook(right_codewords)
+        """
+        Inserts every codeword into a tree one bit at a time, so every bit of the codebook is only looked at once.
+        """
+        root = HuffmanTree(weight=0, name=None)
+        for key, codeword in codebook.items():
+            node = root
+            for bit in codeword:
+                if bit == ZERO:
+                    if node.left is None:
+                        node.left = HuffmanTree(weight=0, name=None)
+                    node = node.left
+                else:
+                    if node.right is None:
+                        node.right = HuffmanTree(weight=0, name=None)
+                    node = node.right
+            assert node.isLeaf() and node.name is None, f"Codebook is not prefix-free at {key}."
+            node.name = key
+
+        return root
 
     @staticmethod
     def fromCanonicalCodebook(codebook: CanonicalCodebook) -> "HuffmanTree":
-        lengths = list(zip(codebook[1], codebook[0]))
-        lengths.sort()
+        return HuffmanTree.fromCodebook(CanonicalHuffmanTable(codebook).getCodebook())
+
+
+class CanonicalHuffmanTable:
+    """
+    Decoding tables for the canonical Huffman code with the given codeword lengths. In a canonical code, the codewords
+    of each length are consecutive integers, and the first codeword of every length follows from the amount of
+    codewords of the shorter lengths. Hence, the lengths are all you need to store, and you never need a tree to decode:
+      - The next `lookup_bits` bits of the input are looked up in a table, which resolves all short codewords in one step.
+      - For longer codewords, the bits are left-aligned to the maximal length. The codewords of length L are then exactly
+        those below a limit that increases with L, so the length is found by binary search over those limits.
+    """
+
+    def __init__(self, codebook: CanonicalCodebook, lookup_bits: int=10):
+        keys, lengths = codebook
+        self.symbols = [key for _, key in sorted(zip(lengths, keys))]
+        self.lengths = sorted(lengths)
+        self.max_length = self.lengths[-1] if self.lengths else 0
+
+        # First codeword and first symbol index of every length.
+        counts = Counter(self.lengths)
+        self.first_codeword = [0]*(self.max_length+1)
+        self.first_symbol   = [0]*(self.max_length+1)
+        codeword = 0
+        symbol   = 0
+        for length in range(1, self.max_length+1):
+            codeword <<= 1
+            self.first_codeword[length] = codeword
+            self.first_symbol[length]   = symbol
+            codeword += counts[length]
+            symbol   += counts[length]
+
+        # Left-aligned upper limits of every length (exclusive). Lengths without codewords get the limit of the previous length.
+        self.limits = [(self.first_codeword[length] + counts[length]) << (self.max_length - length) for length in range(1, self.max_length+1)]
+
+        # Lookup table for codewords of at most lookup_bits bits.
+        self.lookup_bits = min(lookup_bits, self.max_length)
+        self.lookup = [None]*(1 << self.lookup_bits)
+        for index, length in enumerate(self.lengths):
+            if length > self.lookup_bits:
+                break
+            codeword = self.first_codeword[length] + index - self.first_symbol[length]
+            padding = self.lookup_bits - length
+            self.lookup[codeword << padding:(codeword+1) << padding] = [(self.symbols[index], length)] * (1 << padding)
+
+    def getCodebook(self) -> Dict[str,str]:
+        return {symbol: toBinary(codeword).zfill(length) if length else "" for symbol, (codeword, length) in self.getPackedCodebook().items()}
+
+    def getPackedCodebook(self) -> Dict[str,Tuple[int,int]]:
+        return {symbol: (self.first_codeword[length] + index - self.first_symbol[length], length)
+                for index, (symbol, length) in enumerate(zip(self.symbols, self.lengths))}
 
-        reverse_codebook = dict()
-        while lengths:
-            length, key = lengths.pop(0)
+    def read(self, reader: BitReader) -> str:
+        """
+        Peeking past the end gives zeroes, which can look like the start of a codeword, so every codeword is checked to
+        end within the input. Otherwise a truncated input would decode to made-up symbols.
+        """
+        entry = self.lookup[reader.peek(self.lookup_bits)]
+        if entry is not None:
+            symbol, length = entry
+            CanonicalHuffmanTable._skip(reader, length)
+            return symbol
 
-            codeword = ""
-            while len(codeword) < length:
-                if codeword + ZERO not in reverse_codebook:
-                    codeword += ZERO
-                elif codeword + ONE not in reverse_codebook:
-                    codeword += ONE
-                else:  # This is possible: if you have 3 codewords with length 3, you could have 000 and 001, and it should backtrack to flip the first 0 that doesn't create a prefix.
-                    while True:
-                        last_zero = codeword.rfind(ZERO)
-                        codeword = codeword[:last_zero]
-                        if codeword + ONE not in reverse_codebook:
-                            break
-                    codeword += ONE
+        window = reader.peek(self.max_length)
+        length = bisect_right(self.limits, window) + 1
+        CanonicalHuffmanTable._skip(reader, length)
+        return self.symbols[self.first_symbol[length] + (window >> (self.max_length - length)) - self.first_codeword[length]]
 
-            reverse_codebook[codeword] = key
 
-        return HuffmanTree.fromCodebook({v:k for k,v in reverse_codebook.items()})
+    @staticmethod
+    def _skip(reader: BitReader, length: int):
+        if reader.position + length > reader.n_bits:
+            raise EOFError(f"Codeword of {length} bits at position {reader.position} runs past the end of a {reader.n_bits}-bit encoding.")
+        reader.position += length
 
 
 class HuffmanCode(Code):
 
-    def __init__(self, heaviest_child_gets_zero: bool=True):
+    def __init__(self, heaviest_child_gets_zero: bool=True, canonical: bool=False, max_codeword_length: int=None):
+        """
+        :param canonical: Whether to use the canonical code with the same codeword lengths as the Huffman tree. It
+                          compresses equally well, but is decoded with tables rather than by walking the tree bit by bit.
+                          No tree is built in that case; training only computes the codeword lengths.
+        :param max_codeword_length: For a canonical code, the maximal codeword length. If the Huffman code has longer
+                                    codewords, the best code within this limit is used instead.
+        """
+        if max_codeword_length is not None and not canonical:
+            raise ValueError("Codeword lengths can only be limited for canonical codes.")
+
         self.tree: HuffmanTree = None
         self.heaviest_leftward = heaviest_child_gets_zero
+        self.canonical = canonical
+        self.max_codeword_length = max_codeword_length
+        self.table: CanonicalHuffmanTable = None
 
         self.codebook_cache = None
+        self.packed_codebook_cache = None  # Same codewords, as (integer, length) pairs so they can be written without parsing strings.
+
+    @classmethod
+    def fromCodeLengths(cls, codebook: CanonicalCodebook) -> "HuffmanCode":
+        """
+        Reconstructs a canonical code from nothing but its codeword lengths, e.g. as stored alongside an index.
+        There is no tree in that case.
+        """
+        code = cls(canonical=True)
+        code._setCodebook(codebook)
+        return code
+
+    def getCodeLengths(self) -> CanonicalCodebook:
+        return tuple(zip(*sorted((k, length) for k,(_,length) in self.packed_codebook_cache.items())))
+
+    def parameters(self) -> dict:
+        """
+        Besides the constructor arguments, the trained codebook: only the codeword lengths for a canonical code, and
+        the codewords themselves otherwise, since the tree isn't determined by its lengths.
+        """
+        parameters = {"heaviest_child_gets_zero": self.heaviest_leftward, "canonical": self.canonical,
+                      "max_codeword_length": self.max_codeword_length}
+        if self.packed_codebook_cache is not None:
+            if self.canonical:
+                keys, lengths = self.getCodeLengths()
+                parameters["lengths"] = dict(zip(keys, lengths))
+            else:
+                parameters["codebook"] = self.codebook_cache
+        return parameters
+
+    @classmethod
+    def fromParameters(cls, parameters: dict) -> "HuffmanCode":
+        parameters = dict(parameters)
+        lengths  = parameters.pop("lengths", None)
+        codebook = parameters.pop("codebook", None)
+        code = cls(**parameters)
+        if lengths is not None:
+            code._setCodebook((list(lengths.keys()), list(lengths.values())))
+        elif codebook is not None:
+            code.tree = HuffmanTree.fromCodebook(codebook)
+            code.codebook_cache = dict(codebook)
+            code.packed_codebook_cache = {k: (int(v, 2) if v else 0, len(v)) for k,v in codebook.items()}
+        return code
+
+    def _setCodebook(self, codebook: CanonicalCodebook):
+        self.table = CanonicalHuffmanTable(codebook)
+        self.packed_codebook_cache = self.table.getPackedCodebook()
+        self.codebook_cache = {k: toBinary(codeword).zfill(length) if length else "" for k,(codeword,length) in self.packed_codebook_cache.items()}
 
     def train(self, corpus: Iterable[str]):
         self.trainFromCounts(Counter(corpus))
 
     def trainFromCounts(self, counts: Counter):
-        nodes = [HuffmanTree(weight=count, name=str(key)) for key, count in counts.items()]
-        nodes.sort(reverse=True)  # Lowest-probability keys are now at the end.
-
-        while len(nodes) > 1:
-            # Pop worst nodes and combine them
-            worst_node        = nodes.pop()
-            second_worst_node = nodes.pop()
-            combination = second_worst_node + worst_node if self.heaviest_leftward else worst_node + second_worst_node
-
-            # Insert
-            i = 0
-            while i < len(nodes) and combination < nodes[i]:
-                i += 1
-            nodes.insert(i, combination)
-
-        self.tree = nodes[0]
+        keys    = [str(key) for key in counts]
+        weights = list(counts.values())
+
+        if self.canonical:
+            lengths = huffmanCodeLengths(weights)
+            if self.max_codeword_length is not None and max(lengths) > self.max_codeword_length:
+                lengths = lengthLimitedCodeLengths(weights, self.max_codeword_length)
+            self._setCodebook((keys, lengths))
+            return
+
+        nodes = [HuffmanTree(weight=weight, name=key) for key, weight in zip(keys, weights)]
+        for worst, second_worst in huffmanMerges(weights):
+            worst_node, second_worst_node = nodes[worst], nodes[second_worst]
+            nodes.append(second_worst_node + worst_node if self.heaviest_leftward else worst_node + second_worst_node)
+
+        self.tree = nodes[-1]
         self.codebook_cache = self.tree.getCodebook()
+        self.packed_codebook_cache = {k: (int(v, 2) if v else 0, len(v)) for k,v in self.codebook_cache.items()}
 
     def encode(self, source: str) -> Encoding:
         if source not in self.codebook_cache:
@@ -126,6 +336,10 @@ class HuffmanCode(Code):
         return self.codebook_cache.get(source, "")
 
     def decode(self, target: Encoding) -> Decoding:
+        if self.canonical:
+            reader = StringBitReader(target)
+            return self.table.read(reader), reader.tell()
+
         current_node = self.tree
         head = 0
         while True:
@@ -142,24 +356,64 @@ class HuffmanCode(Code):
                 raise ValueError("Found weird character in encoding:", target[head])
             head += 1
 
+    def write(self, source: str, writer: BitWriter):
+        if source not in self.packed_codebook_cache:  # Skipping it would silently shift everything after it.
+            raise ValueError(f"Symbol {repr(source)} has no Huffman codeword.")
+
+        writer.write(*self.packed_codebook_cache[source])
+
+    def read(self, reader: BitReader) -> str:
+        if self.canonical:
+            return self.table.read(reader)
+
+        current_node = self.tree
+        while not current_node.isLeaf():
+            current_node = current_node.right if reader.read(1) else current_node.left
+        return current_node.name
+
 
 class LLRUN(HuffmanCode):
+    """
+    Huffman-codes the bucket floor(log2(n)) of every number n, followed by the bucket's amount of offset bits.
+    """
 
     def train(self, corpus: Iterable[int]):
         buckets = Counter()
         for number in corpus:
-            buckets[int(np.log2(number))] += 1  # [2^i ... 2^{i+1}-1] all have the same result for int(log2), namely i, and there are 2^i such numbers, codable with i bits of offset.
+            buckets[number.bit_length() - 1] += 1  # [2^i ... 2^{i+1}-1] all have bit length i+1, and there are 2^i such numbers, codable with i bits of offset.
+        self.trainFromBuckets(buckets)
 
+    def trainFromBuckets(self, buckets: Counter):
         # Make sure there are no gaps in the bucket numbers. We expect numbers anywhere in the maximum bucket range (but nothing beyond that).
-        for bucket in range(max(buckets.keys())):
+        # There should also be at least two buckets, because a lone bucket gets an empty codeword and then no bit is ever read for bucket 0.
+        for bucket in range(max(max(buckets.keys()), 1) + 1):
             if bucket not in buckets:
                 buckets[bucket] = 0
 
         self.trainFromCounts(buckets)
 
+    @classmethod
+    def trainPerKey(cls, keyed_corpus: Iterable[Tuple[Hashable,int]], **kwargs) -> Dict[Hashable, "LLRUN"]:
+        """
+        Trains a separate model for every key in one pass over the given (key, number) pairs, e.g. (term, gap) pairs
+        for a model per posting list, or ((term, block index), gap) pairs for a model per block of a posting list.
+        Only the bucket counts of every key are held in memory while streaming.
+
+        :param kwargs: Passed to the constructor of every model, e.g. canonical=True.
+        """
+        buckets_per_key = defaultdict(Counter)
+        for key, number in keyed_corpus:
+            buckets_per_key[key][number.bit_length() - 1] += 1
+
+        models = dict()
+        for key, buckets in buckets_per_key.items():
+            models[key] = cls(**kwargs)
+            models[key].trainFromBuckets(buckets)
+        return models
+
     def encode(self, source: int) -> Encoding:
-        bucket = int(np.log2(source))
-        return self.tree.getCodebook()[str(bucket)] + (toBinary(source - 2**bucket).zfill(bucket) if bucket != 0 else "")  # No length indications needed. Huffman will go down the tree and stop at the boundary, and then we will also know how many bits the rest took to encode.
+        bucket = source.bit_length() - 1
+        return self.codebook_cache[str(bucket)] + (toBinary(source - 2**bucket).zfill(bucket) if bucket != 0 else "")  # No length indications needed. Huffman will go down the tree and stop at the boundary, and then we will also know how many bits the rest took to encode.
 
     def decode(self, target: Encoding) -> Decoding:
         bucket, head = super().decode(target)
@@ -168,3 +422,38 @@ class LLRUN(HuffmanCode):
 
         bucket = int(bucket)
         return 2**bucket + (int(target[head:head+bucket], 2) if bucket != 0 else 0), head+bucket
+
+    def write(self, source: int, writer: BitWriter):
+        bucket = source.bit_length() - 1
+        if str(bucket) not in self.packed_codebook_cache:
+            raise ValueError(f"Number {source} is in bucket {bucket}, which has no Huffman codeword.")
+        codeword, length = self.packed_codebook_cache[str(bucket)]
+        writer.write((codeword << bucket) | (source ^ (1 << bucket)), length + bucket)
+
+    def read(self, reader: BitReader) -> int:
+        bucket = int(super().read(reader))
+        return (1 << bucket) | reader.read(bucket)
+
+    def encodeArray(self, source: np.ndarray) -> PackedEncoding:
+        """
+        Vectorised equivalent of encodeManyPacked: the codeword of every number's bucket is looked up in an array, and
+        all codewords and offsets are then written at once.
+        """
+        values  = np.asarray(source, dtype=np.uint64)
+        buckets = bitLengths(values) - 1
+        if len(values) and (buckets.min() < 0 or str(buckets.max()) not in self.packed_codebook_cache):
+            raise ValueError("LLRUN can only encode positive integers in the buckets it was trained on.")
+
+        n_buckets = len(self.packed_codebook_cache)
+        codewords = np.array([self.packed_codebook_cache[str(bucket)][0] for bucket in range(n_buckets)], dtype=np.uint64)
+        lengths   = np.array([self.packed_codebook_cache[str(bucket)][1] for bucket in range(n_buckets)], dtype=np.int64)
+
+        codeword_lengths = lengths[buckets]
+        ends = np.cumsum(codeword_lengths + buckets)
+        offset_starts = ends - buckets
+        return packFields(
+            np.concatenate([codewords[buckets], values ^ (np.uint64(1) << buckets.astype(np.uint64))]),
+            np.concatenate([codeword_lengths, buckets]),
+            np.concatenate([offset_starts - codeword_lengths, offset_starts]),
+            int(ends[-1]) if len(ends) else 0
+        )
@@ -0,0 +1,552 @@
+"""
+An inverted index: for every term, the list of documents it appears in (its postings), together with how often it
+appears there (its term frequency), plus the length of every document.
+
+Posting lists are cut into blocks of a fixed amount of postings. Each block stores
+  - the gaps between its document IDs (the first gap being relative to the last ID of the previous block), and
+  - the term frequencies,
+each compressed with a Code of choice and padded to a whole byte, so that a block can be decoded on its own. For every
+block, the index also keeps the last document ID in it, which lets you skip over blocks without decoding them, and the
+highest term frequency and shortest document length in it, which bound the score that any document in it can get.
+
+All of this is kept in a handful of flat arrays (one entry per term, one entry per block) and one byte string holding
+all the blocks of all the terms, in lexicographic order of the terms.
+
+Because nothing in that layout is a Python object, it can be written to disk as-is and memory-mapped back in: opening
+an index then costs no more than reading its header, and the operating system only loads the pages of the posting lists
+that queries actually touch. Processes that map the same file share those pages.
+"""
+from typing import Iterable, List, Tuple, Optional, Union, Dict, BinaryIO
+from collections import Counter, defaultdict
+from pathlib import Path
+from array import array
+from io import BytesIO
+
+import os
+import mmap
+import json
+import shutil
+import tempfile
+import numpy as np
+
+from irse.indexing.bits import PackedEncoding
+from irse.indexing.nonparametric import Code, UnaryCode, GammaCode, DeltaCode, OmegaCode, VByte, Simple9, Simple16, PForDelta, OptPForDelta
+from irse.indexing.contextual import InterpolativeCode
+from irse.indexing.parametric import GolombRiceCode
+from irse.indexing.huffman import HuffmanCode, LLRUN
+
+Postings = Tuple[np.ndarray, np.ndarray]  # Document IDs and term frequencies.
+
+# The vectorised encoders/decoders have a fixed cost of tens of microseconds per call, which only pays off for longer
+# inputs. Most posting lists are very short (Zipf's law), so most blocks are encoded number by number.
+VECTORISE_FROM_VALUES = 64
+VECTORISE_FROM_BITS   = 512
+
+
+def encodeArray(code: Code, values: np.ndarray) -> PackedEncoding:
+    """Encodes an array with the code's vectorised encoder if it has one and the array is long, and number by number otherwise."""
+    if hasattr(code, "encodeArray") and len(values) >= VECTORISE_FROM_VALUES:
+        return code.encodeArray(values)
+    return code.encodeManyPacked(values.tolist())
+
+
+def decodeArray(code: Code, encoding: PackedEncoding) -> np.ndarray:
+    """Decodes into an int64 array with the code's vectorised decoder if it has one and the encoding is long, and number by number otherwise."""
+    if hasattr(code, "decodeArray") and encoding.n_bits >= VECTORISE_FROM_BITS:
+        return code.decodeArray(encoding).astype(np.int64)
+    return np.fromiter(code.decodeManyPacked(encoding), dtype=np.int64)
+
+
+def encodesIdentifiers(code: Code) -> bool:
+    """
+    Whether the code compresses increasing lists of identifiers by itself (like interpolative coding does), rather than
+    needing them to be turned into gaps first.
+    """
+    return isinstance(code, InterpolativeCode)
+
+
+class IndexVersionError(ValueError):
+    """The index file was written in another version of the format."""
+    pass
+
+
+CODES = {code.__name__: code for code in [UnaryCode, GammaCode, DeltaCode, OmegaCode, VByte, Simple9, Simple16,
+                                          PForDelta, OptPForDelta, InterpolativeCode, GolombRiceCode, HuffmanCode, LLRUN]}
+
+
+def dumpCodes(code: Code, frequency_code: Code, block_size: int) -> bytes:
+    def describe(c: Code) -> dict:
+        if type(c).__name__ not in CODES:
+            raise ValueError(f"{type(c).__name__} cannot be stored with an index.")
+        return {"class": type(c).__name__, "parameters": c.parameters()}
+
+    return json.dumps({"code": describe(code), "frequency_code": describe(frequency_code), "block_size": block_size}).encode("utf-8")
+
+
+def loadCodes(blob: Union[bytes, memoryview]) -> Tuple[Code, Code, int]:
+    """
+    Rebuilds the codes from their stored class names and parameters. Only the classes in CODES can come out of this,
+    unlike unpickling, which constructs whatever the file asks for.
+    """
+    def rebuild(description: dict) -> Code:
+        if description["class"] not in CODES:
+            raise ValueError(f"Unknown code {repr(description['class'])}.")
+        return CODES[description["class"]].fromParameters(description["parameters"])
+
+    codes = json.loads(bytes(blob).decode("utf-8"))
+    return rebuild(codes["code"]), rebuild(codes["frequency_code"]), codes["block_size"]
+
+
+class Lexicon:
+    """
+    A sorted list of terms, stored as their concatenated UTF-8 bytes plus the offset where each starts. Looking up a
+    term is a binary search, so unlike a dictionary, there is nothing to build when the lexicon is loaded from disk.
+    (UTF-8 bytes sort the same way as the strings they encode, so sorted strings give sorted bytes.)
+    """
+
+    def __init__(self, blob: Union[bytes, memoryview], offsets: np.ndarray):
+        self.blob    = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def fromTerms(terms: List[str]) -> "Lexicon":
+        encoded = [term.encode("utf-8") for term in terms]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        return Lexicon(b"".join(encoded), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _bytes(self, i: int) -> bytes:
+        return bytes(self.blob[int(self.offsets[i]):int(self.offsets[i+1])])
+
+    def __getitem__(self, i: int) -> str:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return self._bytes(i % len(self)).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._bytes(i).decode("utf-8")
+
+    def find(self, term: str) -> Optional[int]:
+        """The index of the given term, or None if it isn't in the lexicon."""
+        key = term.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self) and self._bytes(low) == key else None
+
+
+class InvertedIndex:
+
+    MAGIC   = b"IRSEINDX"
+    VERSION = 3
+    # The sections of the file, in order. All but the first two are arrays of little-endian 64-bit integers.
+    SECTIONS = ["codes", "lexicon", "lexicon_offsets", "document_frequencies", "first_blocks",
+                "block_last_documents", "block_offsets", "block_document_bits", "block_frequency_bits",
+                "block_max_frequencies", "block_min_lengths", "document_lengths", "data"]
+
+    def __init__(self, lexicon: Lexicon, document_frequencies: np.ndarray, first_blocks: np.ndarray,
+                 block_last_documents: np.ndarray, block_offsets: np.ndarray, block_document_bits: np.ndarray, block_frequency_bits: np.ndarray,
+                 block_max_frequencies: np.ndarray, block_min_lengths: np.ndarray, data: bytes, document_lengths: np.ndarray,
+                 code: Code, frequency_code: Code, block_size: int):
+        """
+        You normally don't call this yourself; see fromDocuments() and InvertedIndexWriter instead.
+
+        :param lexicon: the vocabulary, sorted.
+        :param document_frequencies: for every term, the amount of documents it appears in.
+        :param first_blocks: for every term, the index of its first block, plus one more element (the total amount of blocks).
+        :param block_last_documents: for every block, the last document ID it contains.
+        :param block_offsets: for every block, the byte offset in the data where it starts.
+        :param block_document_bits: for every block, the amount of bits in its document ID part, which comes first.
+        :param block_frequency_bits: for every block, the amount of bits in its term frequency part, which starts at the next byte.
+        :param block_max_frequencies: for every block, the highest term frequency in it.
+        :param block_min_lengths: for every block, the length of the shortest document in it.
+        :param data: all blocks, concatenated. Anything that can be sliced into bytes will do, like a memoryview of an mmap.
+        :param document_lengths: for every document, the amount of terms in it.
+        """
+        self.lexicon = lexicon
+        self.document_frequencies = document_frequencies
+        self.first_blocks         = first_blocks
+
+        self.block_last_documents = block_last_documents
+        self.block_offsets        = block_offsets
+        self.block_document_bits  = block_document_bits
+        self.block_frequency_bits = block_frequency_bits
+        self.block_max_frequencies = block_max_frequencies
+        self.block_min_lengths     = block_min_lengths
+        self.data = data
+
+        self.document_lengths = document_lengths
+        self.n_documents = len(document_lengths)
+        self.average_document_length = int(document_lengths.sum()) / self.n_documents if self.n_documents else 0.0
+
+        self.code = code
+        self.frequency_code = frequency_code
+        self.block_size = block_size
+
+    @staticmethod
+    def fromDocuments(documents: Iterable[List[str]], code: Code=None, frequency_code: Code=None, block_size: int=128) -> "InvertedIndex":
+        """
+        Inverts the given tokenised documents in memory. Document IDs are given in order of iteration, starting at 0.
+        """
+        postings = defaultdict(list)  # term -> [doc ID, tf, doc ID, tf, ...]
+        document_lengths = []
+        for document_id, document in enumerate(documents):
+            document_lengths.append(len(document))
+            for term, frequency in Counter(document).items():
+                postings[term].extend((document_id, frequency))
+
+        writer = InvertedIndexWriter(code, frequency_code, block_size)
+        writer.addDocumentLengths(np.array(document_lengths, dtype=np.int64))
+        for term in sorted(postings):
+            pairs = np.array(postings.pop(term), dtype=np.int64)
+            writer.add(term, pairs[0::2], pairs[1::2])
+        return writer.finish()
+
+    def renumbered(self, new_ids: np.ndarray, path: Path=None) -> "InvertedIndex":
+        """
+        The same index, but document i becomes document new_ids[i]. Useful to give documents that are more likely to
+        be retrieved the lowest IDs, so that they sit at the front of every posting list.
+
+        :param new_ids: a permutation of 0 ... n_documents-1.
+        :param path: if given, the new index is written there (see InvertedIndexWriter) rather than kept in memory.
+        """
+        new_ids = np.asarray(new_ids, dtype=np.int64)
+        if len(new_ids) != self.n_documents or not np.array_equal(np.sort(new_ids), np.arange(self.n_documents)):
+            raise ValueError("New document IDs must be a permutation of the old ones.")
+
+        writer = InvertedIndexWriter(self.code, self.frequency_code, self.block_size, path=path)
+        document_lengths = np.empty(self.n_documents, dtype=np.int64)
+        document_lengths[new_ids] = self.document_lengths
+        writer.addDocumentLengths(document_lengths)
+        for term in self.lexicon:
+            documents, frequencies = self.postings(term)
+            documents = new_ids[documents]
+            order = np.argsort(documents)
+            writer.add(term, documents[order], frequencies[order])
+        return writer.finish()
+
+    def save(self, path: Path):
+        """
+        File layout: the magic bytes and version, a table with the byte offset and size of every section, and then the
+        sections themselves, each starting at a multiple of 8 bytes so that the arrays can be used without copying.
+        The codes are stored as JSON with their class name and parameters, so that trained codes (LLRUN, Huffman) come
+        along without anything being pickled.
+        """
+        writeIndexFile(path, {
+            "codes": dumpCodes(self.code, self.frequency_code, self.block_size),
+            "lexicon": self.lexicon.blob,
+            "lexicon_offsets": self.lexicon.offsets,
+            "document_frequencies": self.document_frequencies,
+            "first_blocks": self.first_blocks,
+            "block_last_documents": self.block_last_documents,
+            "block_offsets": self.block_offsets,
+            "block_document_bits": self.block_document_bits,
+            "block_frequency_bits": self.block_frequency_bits,
+            "block_max_frequencies": self.block_max_frequencies,
+            "block_min_lengths": self.block_min_lengths,
+            "document_lengths": self.document_lengths,
+            "data": self.data
+        })
+
+    @staticmethod
+    def load(path: Path) -> "InvertedIndex":
+        """
+        Memory-maps an index written by save(). Nothing but the header and the codes is read here.
+        Raises an IndexVersionError for an index written by another version of this class, which you should rebuild.
+        """
+        with open(path, "rb") as handle:
+            if handle.read(len(InvertedIndex.MAGIC)) != InvertedIndex.MAGIC:
+                raise ValueError(f"{path} is not an inverted index.")
+            buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)  # The mapping stays valid after closing the file.
+
+        version = int(np.frombuffer(buffer, dtype="<u8", count=1, offset=len(InvertedIndex.MAGIC))[0])  # Other versions may have another header.
+        if version != InvertedIndex.VERSION:
+            raise IndexVersionError(f"{path} has version {version} of the index format, but only version {InvertedIndex.VERSION} is supported.")
+        header = np.frombuffer(buffer, dtype="<u8", count=1 + 2*len(InvertedIndex.SECTIONS), offset=len(InvertedIndex.MAGIC))
+
+        view = memoryview(buffer)
+        sections = dict()
+        for name, (offset, size) in zip(InvertedIndex.SECTIONS, header[1:].reshape(-1, 2).tolist()):
+            if name in {"codes", "lexicon", "data"}:
+                sections[name] = view[offset:offset+size]
+            else:
+                sections[name] = np.frombuffer(buffer, dtype="<i8", count=size // 8, offset=offset)
+
+        code, frequency_code, block_size = loadCodes(sections["codes"])
+        return InvertedIndex(
+            lexicon=Lexicon(sections["lexicon"], sections["lexicon_offsets"]),
+            document_frequencies=sections["document_frequencies"],
+            first_blocks=sections["first_blocks"],
+            block_last_documents=sections["block_last_documents"],
+            block_offsets=sections["block_offsets"],
+            block_document_bits=sections["block_document_bits"],
+            block_frequency_bits=sections["block_frequency_bits"],
+            block_max_frequencies=sections["block_max_frequencies"],
+            block_min_lengths=sections["block_min_lengths"],
+            data=sections["data"],
+            document_lengths=sections["document_lengths"],
+            code=code, frequency_code=frequency_code, block_size=block_size
+        )
+
+    def __len__(self):
+        return len(self.lexicon)
+
+    def __contains__(self, term: str):
+        return self.lexicon.find(term) is not None
+
+    def termId(self, term: str) -> Optional[int]:
+        return self.lexicon.find(term)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the compressed postings."""
+        return len(self.data)
+
+    def documentFrequency(self, term: str) -> int:
+        term_id = self.lexicon.find(term)
+        return 0 if term_id is None else int(self.document_frequencies[term_id])
+
+    def blockRange(self, term: str) -> range:
+        """The indices of the blocks that make up the posting list of the given term."""
+        term_id = self.lexicon.find(term)
+        if term_id is None:
+            return range(0)
+        return range(int(self.first_blocks[term_id]), int(self.first_blocks[term_id+1]))
+
+    def decodeBlock(self, block: int, previous: Optional[int]=None) -> Postings:
+        """
+        Decodes one block. Its first gap is relative to the last document ID of the term's previous block (or -1 for the
+        term's first block); if you know that value, you can pass it to save looking it up.
+        """
+        if previous is None:
+            term_id = int(np.searchsorted(self.first_blocks, block, side="right")) - 1
+            previous = -1 if self.first_blocks[term_id] == block else int(self.block_last_documents[block-1])
+
+        start = int(self.block_offsets[block])
+        document_bits  = int(self.block_document_bits[block])
+        frequency_bits = int(self.block_frequency_bits[block])
+        middle = start + (document_bits + 7) // 8
+        end    = middle + (frequency_bits + 7) // 8
+
+        numbers     = decodeArray(self.code,           PackedEncoding(data=self.data[start:middle], n_bits=document_bits))
+        frequencies = decodeArray(self.frequency_code, PackedEncoding(data=self.data[middle:end],   n_bits=frequency_bits))
+        if encodesIdentifiers(self.code):
+            return numbers - 1, frequencies
+        return previous + np.cumsum(numbers), frequencies
+
+    def postings(self, term: str) -> Postings:
+        """
+        Decodes the full posting list of the given term. Terms that aren't in the index have an empty posting list.
+        """
+        blocks = self.blockRange(term)
+        if not blocks:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        documents, frequencies = [], []
+        previous = -1
+        for block in blocks:
+            d, f = self.decodeBlock(block, previous)
+            documents.append(d)
+            frequencies.append(f)
+            previous = int(self.block_last_documents[block])
+        return np.concatenate(documents), np.concatenate(frequencies)
+
+
+def writeIndexFile(path: Path, sections: Dict[str, Union[bytes, memoryview, np.ndarray, array, BinaryIO]]):
+    """
+    Writes the given sections in the layout of InvertedIndex.save(). Arrays are stored as little-endian 64-bit integers,
+    and file objects are copied from their start in chunks, so that sections that were built on disk stay there.
+    """
+    def size(section) -> int:
+        if isinstance(section, (bytes, memoryview)):
+            return len(section)
+        elif isinstance(section, (np.ndarray, array)):
+            return 8*len(section)
+        else:
+            return section.seek(0, os.SEEK_END)
+
+    table = []
+    offset = len(InvertedIndex.MAGIC) + 8 + 16*len(InvertedIndex.SECTIONS)
+    for name in InvertedIndex.SECTIONS:
+        offset += -offset % 8
+        table.extend((offset, size(sections[name])))
+        offset += table[-1]
+
+    with open(path, "wb") as handle:
+        handle.write(InvertedIndex.MAGIC)
+        handle.write(np.array([InvertedIndex.VERSION] + table, dtype="<u8").tobytes())
+        for name in InvertedIndex.SECTIONS:
+            handle.write(b"\0" * (-handle.tell() % 8))
+            section = sections[name]
+            if isinstance(section, (bytes, memoryview)):
+                handle.write(section)
+            elif isinstance(section, (np.ndarray, array)):
+                handle.write(np.asarray(section, dtype="<i8").tobytes())
+            else:
+                section.seek(0)
+                shutil.copyfileobj(section, handle)
+
+
+class InvertedIndexWriter:
+    """
+    Compresses posting lists into the layout of an InvertedIndex. First, the lengths of all documents must be added.
+    Then, terms must be added in lexicographic order, each with its postings sorted by document ID. The postings of a
+    term can be added all at once or over several calls in a row.
+
+    The compressed blocks and the document lengths are written to a buffer in memory, or, if the writer is given a path,
+    to temporary files next to that path, from which finish() then copies them into the index file. Only the lexicon and
+    the few integers per term and per block stay in memory, so the size of the postings doesn't matter.
+    """
+
+    def __init__(self, code: Code=None, frequency_code: Code=None, block_size: int=128, path: Path=None):
+        """
+        :param code: code for the document IDs. Codes for numbers get the gaps between IDs (all >= 1), and codes for
+                     increasing lists (interpolative coding) get the IDs themselves, plus 1.
+        :param frequency_code: code for the term frequencies (all >= 1). Defaults to the same code, unless that code
+                               only works for increasing lists, in which case it defaults to the gamma code.
+        :param path: where to write the index. If not given, the index is built in memory.
+        """
+        self.code = code or VByte()
+        self.frequency_code = frequency_code or (GammaCode() if encodesIdentifiers(self.code) else self.code)
+        self.block_size = block_size
+        self.path = path
+
+        self.terms = []
+        self.document_frequencies = array("q")
+        self.first_blocks         = array("q", [0])
+        self.block_last_documents = array("q")
+        self.block_offsets        = array("q")
+        self.block_document_bits  = array("q")
+        self.block_frequency_bits = array("q")
+        self.block_max_frequencies = array("q")
+        self.block_min_lengths     = array("q")
+        if path is None:
+            self.data             = BytesIO()
+            self.document_lengths = BytesIO()
+        else:
+            self.data             = tempfile.TemporaryFile(dir=Path(path).parent)
+            self.document_lengths = tempfile.TemporaryFile(dir=Path(path).parent)
+        self.n_bytes = 0
+        self.lengths = None  # Array view on the document lengths, once they are all known.
+
+        # Postings of the current term that don't fill a block yet, and the last document ID before them.
+        self.pending_documents   = np.zeros(0, dtype=np.int64)
+        self.pending_frequencies = np.zeros(0, dtype=np.int64)
+        self.previous = -1
+
+    def add(self, term: str, documents: np.ndarray, frequencies: np.ndarray):
+        documents   = np.asarray(documents,   dtype=np.int64)
+        frequencies = np.asarray(frequencies, dtype=np.int64)
+        if self.lengths is None:
+            self.lengths = self._documentLengths()
+
+        if not self.terms or term != self.terms[-1]:
+            if self.terms and term < self.terms[-1]:
+                raise ValueError(f"Terms must be added in increasing order, but got '{term}' after '{self.terms[-1]}'.")
+            self._finishTerm()
+            self.terms.append(term)
+            self.document_frequencies.append(0)
+            self.previous = -1
+        elif len(documents) and documents[0] <= (self.pending_documents[-1] if len(self.pending_documents) else self.previous):
+            raise ValueError(f"Postings of '{term}' must be added in increasing order of document ID.")
+
+        self.document_frequencies[-1] += len(documents)
+        self.pending_documents   = np.concatenate([self.pending_documents, documents])
+        self.pending_frequencies = np.concatenate([self.pending_frequencies, frequencies])
+        while len(self.pending_documents) >= self.block_size:
+            self._writeBlock(self.pending_documents[:self.block_size], self.pending_frequencies[:self.block_size])
+            self.pending_documents   = self.pending_documents[self.block_size:]
+            self.pending_frequencies = self.pending_frequencies[self.block_size:]
+
+    def addDocumentLengths(self, document_lengths: np.ndarray):
+        """Appends the lengths of the next documents, in order of document ID."""
+        if self.lengths is not None:
+            raise RuntimeError("Document lengths must all be added before any postings.")
+        self.document_lengths.write(np.asarray(document_lengths, dtype="<i8").tobytes())
+
+    def _documentLengths(self) -> np.ndarray:
+        if isinstance(self.document_lengths, BytesIO):
+            return np.frombuffer(self.document_lengths.getvalue(), dtype="<i8")
+
+        self.document_lengths.flush()
+        if self.document_lengths.seek(0, os.SEEK_END) == 0:  # Can't map an empty file.
+            return np.zeros(0, dtype="<i8")
+        return np.memmap(self.document_lengths, dtype="<i8", mode="r")
+
+    def _writeBlock(self, documents: np.ndarray, frequencies: np.ndarray):
+        if encodesIdentifiers(self.code):
+            numbers = documents + 1
+        else:
+            numbers = np.diff(documents, prepend=self.previous)
+        document_part  = encodeArray(self.code, numbers.astype(np.uint64))
+        frequency_part = encodeArray(self.frequency_code, frequencies.astype(np.uint64))
+
+        self.previous = int(documents[-1])
+        self.block_last_documents.append(self.previous)
+        self.block_offsets.append(self.n_bytes)
+        self.block_document_bits.append(document_part.n_bits)
+        self.block_frequency_bits.append(frequency_part.n_bits)
+        self.block_max_frequencies.append(int(frequencies.max()))
+        self.block_min_lengths.append(int(self.lengths[documents].min()))
+        self.data.write(document_part.data)
+        self.data.write(frequency_part.data)
+        self.n_bytes += len(document_part.data) + len(frequency_part.data)
+
+    def _finishTerm(self):
+        if not self.terms:
+            return
+        if len(self.pending_documents):
+            self._writeBlock(self.pending_documents, self.pending_frequencies)
+            self.pending_documents   = self.pending_documents[:0]
+            self.pending_frequencies = self.pending_frequencies[:0]
+        self.first_blocks.append(len(self.block_offsets))
+
+    def finish(self) -> InvertedIndex:
+        """
+        :return: the index, which is memory-mapped from disk if the writer was given a path.
+        """
+        self._finishTerm()
+        lexicon = Lexicon.fromTerms(self.terms)
+
+        if self.path is None:
+            return InvertedIndex(
+                lexicon=lexicon,
+                document_frequencies=np.array(self.document_frequencies, dtype=np.int64),
+                first_blocks=np.array(self.first_blocks, dtype=np.int64),
+                block_last_documents=np.array(self.block_last_documents, dtype=np.int64),
+                block_offsets=np.array(self.block_offsets, dtype=np.int64),
+                block_document_bits=np.array(self.block_document_bits, dtype=np.int64),
+                block_frequency_bits=np.array(self.block_frequency_bits, dtype=np.int64),
+                block_max_frequencies=np.array(self.block_max_frequencies, dtype=np.int64),
+                block_min_lengths=np.array(self.block_min_lengths, dtype=np.int64),
+                data=self.data.getvalue(),
+                document_lengths=np.frombuffer(self.document_lengths.getvalue(), dtype="<i8").astype(np.int64),
+                code=self.code, frequency_code=self.frequency_code, block_size=self.block_size
+            )
+        else:
+            writeIndexFile(self.path, {
+                "codes": dumpCodes(self.code, self.frequency_code, self.block_size),
+                "lexicon": lexicon.blob,
+                "lexicon_offsets": lexicon.offsets,
+                "document_frequencies": self.document_frequencies,
+                "first_blocks": self.first_blocks,
+                "block_last_documents": self.block_last_documents,
+                "block_offsets": self.block_offsets,
+                "block_document_bits": self.block_document_bits,
+                "block_frequency_bits": self.block_frequency_bits,
+                "block_max_frequencies": self.block_max_frequencies,
+                "block_min_lengths": self.block_min_lengths,
+                "document_lengths": self.document_lengths,
+                "data": self.data
+            })
+            self.data.close()
+            self.document_lengths.close()
+            return InvertedIndex.load(self.path)
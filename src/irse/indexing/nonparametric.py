@@ -1,6 +1,11 @@
-from typing import Tuple, Iterable
+from typing import Tuple, Iterable, Iterator, List
 from abc import abstractmethod, ABC
 
+import numpy as np
+
+from irse.indexing.bits import BitWriter, BitReader, PackedEncoding, PackedBitWriter, PackedBitReader, StringBitWriter, StringBitReader, \
+    packFields, unpackFields
+
 
 Encoding = str
 Decoding = Tuple[int,int]  # Result and how much you moved in the input.
@@ -12,6 +17,41 @@ def toBinary(i: int) -> Encoding:
     return bin(i)[2:]
 
 
+def bitLengths(values: np.ndarray) -> np.ndarray:
+    """
+    Vectorised int.bit_length for unsigned integers.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.frexp(values.astype(np.float64))[1].astype(np.int64)
+    rounded_up = (lengths > 0) & ((values >> np.maximum(lengths-1, 0).astype(np.uint64)) == 0)  # Floats can't hold 64 bits, so 2^k-1 can become 2^k for large k.
+    return lengths - rounded_up
+
+
+def followChain(successors: np.ndarray) -> np.ndarray:
+    """
+    Given, for every index i, the index successors[i] > i that comes after it (where anything >= len(successors) means
+    that there is nothing after it), returns the sorted indices that are visited when starting at index 0.
+
+    This is the one inherently sequential step in decoding a stream of variable-length codewords (where does the next
+    codeword start?). Pointer doubling does it in O(log n) vectorised passes rather than a Python loop over the chain.
+    """
+    n = len(successors)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    jump = np.append(np.minimum(successors, n), n).astype(np.int32 if n < 2**31-1 else np.int64)  # The last element is a sentinel that points to itself.
+    visited = np.zeros(1, dtype=jump.dtype)
+    while True:  # After k iterations, visited contains the first 2^k elements of the chain, and jump skips 2^k elements.
+        reached = jump[visited]
+        reached = reached[reached < n]
+        if len(reached) == 0:
+            break
+        visited = np.concatenate([visited, reached])
+        jump = jump[jump]
+
+    return np.sort(visited)
+
+
 class Code(ABC):
 
     @abstractmethod
@@ -25,11 +65,52 @@ class Code(ABC):
     def encodeMany(self, source: Iterable[int]) -> Encoding:
         return "".join(map(self.encode, source))
 
-    def decodeMany(self, target: Encoding) -> Iterable[int]:
-        while target:
-            result, cursor = self.decode(target)
-            target = target[cursor:]
-            yield result
+    def decodeMany(self, target: Encoding, start: int=0) -> Iterator[int]:
+        """
+        Lazily decodes the given encoding from the given bit offset onwards. The encoding is never sliced; a cursor moves
+        through it instead, so decoding is linear in its length and you can stop at any point without paying for the rest.
+        """
+        return self.readMany(StringBitReader(target, start))
+
+    # The methods below do the same as the above, except they write into/read from a bit buffer rather than a string.
+    # This is what you would use in practice: with a PackedBitWriter, every bit actually takes one bit of memory.
+
+    def write(self, source: int, writer: BitWriter):
+        writer.writeBits(self.encode(source))
+
+    @abstractmethod
+    def read(self, reader: BitReader) -> int:
+        pass
+
+    def writeMany(self, source: Iterable[int], writer: BitWriter):
+        for number in source:
+            self.write(number, writer)
+
+    def readMany(self, reader: BitReader) -> Iterator[int]:
+        while not reader.isExhausted():
+            yield self.read(reader)
+
+    def encodeManyPacked(self, source: Iterable[int]) -> PackedEncoding:
+        writer = PackedBitWriter()
+        self.writeMany(source, writer)
+        return writer.finish()
+
+    def decodeManyPacked(self, target: PackedEncoding, start: int=0) -> Iterator[int]:
+        return self.readMany(PackedBitReader(target, start))
+
+    # A code is stored alongside an index as its class name and the values below, rather than as a pickle, so that
+    # opening an index can never run code that came with the file.
+
+    def parameters(self) -> dict:
+        """
+        The constructor arguments of this code (plus, for codes that are trained, what was learnt), as values that
+        JSON can hold. fromParameters() turns them back into the same code.
+        """
+        return dict()
+
+    @classmethod
+    def fromParameters(cls, parameters: dict) -> "Code":
+        return cls(**parameters)
 
 
 class UnaryCode(Code):
@@ -43,6 +124,12 @@ class UnaryCode(Code):
             i += 1
         return i+1, i+1
 
+    def write(self, source: int, writer: BitWriter):
+        writer.writeUnary(source)
+
+    def read(self, reader: BitReader) -> int:
+        return reader.readUnary()
+
 
 class GammaCode(Code):
 
@@ -57,6 +144,14 @@ class GammaCode(Code):
         length, head = self.unary.decode(target)
         return int(ONE + target[head:head+length-1], base=2), head+length-1  # length-1 because the first 1 is truncated.
 
+    def write(self, source: int, writer: BitWriter):
+        length = source.bit_length()
+        writer.write(source, 2*length-1)  # The unary code for the length is length-1 zeroes and a one, and that one doubles as the leading 1 of the binary.
+
+    def read(self, reader: BitReader) -> int:
+        length = reader.readUnary()
+        return (1 << (length-1)) | reader.read(length-1)
+
 
 class DeltaCode(Code):
 
@@ -71,6 +166,15 @@ class DeltaCode(Code):
         length, head = self.gamma.decode(target)
         return int(ONE + target[head:head+length-1], base=2), head+length-1  # length-1 because the first 1 is truncated.
 
+    def write(self, source: int, writer: BitWriter):
+        length = source.bit_length()
+        self.gamma.write(length, writer)
+        writer.write(source ^ (1 << (length-1)), length-1)
+
+    def read(self, reader: BitReader) -> int:
+        length = self.gamma.read(reader)
+        return (1 << (length-1)) | reader.read(length-1)
+
 
 class OmegaCode(Code):
 
@@ -91,6 +195,22 @@ class OmegaCode(Code):
             next_length = int(next_chunk, 2) + 1
         return next_length-1, head+1
 
+    def write(self, source: int, writer: BitWriter):
+        groups = []
+        while source != 1:
+            length = source.bit_length()
+            groups.append((source, length))
+            source = length-1
+        for value, length in reversed(groups):
+            writer.write(value, length)
+        writer.write(0, 1)
+
+    def read(self, reader: BitReader) -> int:
+        value = 1
+        while reader.read(1):  # The 1 that was just read is the leading bit of a group of value+1 bits.
+            value = (1 << value) | reader.read(value)
+        return value
+
 
 class VByte(Code):
 
@@ -113,6 +233,49 @@ class VByte(Code):
             head += 8
         return int(bits, 2), head
 
+    def write(self, source: int, writer: BitWriter):
+        n_bytes = max(1, (source.bit_length()-1)//7+1)  # 0 still takes a byte.
+        for i in range(n_bytes-1, -1, -1):
+            writer.write((0x80 if i == 0 else 0) | ((source >> 7*i) & 0x7F), 8)
+
+    def read(self, reader: BitReader) -> int:
+        value = 0
+        while True:
+            byte = reader.read(8)
+            value = (value << 7) | (byte & 0x7F)
+            if byte & 0x80:
+                return value
+
+    def encodeArray(self, source: np.ndarray) -> PackedEncoding:
+        """
+        Vectorised equivalent of encodeManyPacked. Every byte position is filled for all numbers at once, counting from
+        the last byte of each number (the one with the stop bit) backwards.
+        """
+        values = np.asarray(source, dtype=np.uint64)
+        n_bytes = np.ones(len(values), dtype=np.int64)
+        for i in range(1, 10):  # 64 bits need at most 10 bytes of 7 bits.
+            n_bytes += values >= np.uint64(1 << 7*i)
+
+        ends = np.cumsum(n_bytes)
+        result = np.zeros(ends[-1] if len(ends) else 0, dtype=np.uint8)
+        for i in range(int(n_bytes.max(initial=0))):
+            has_byte = n_bytes > i
+            result[ends[has_byte] - 1 - i] = (values[has_byte] >> np.uint64(7*i)) & np.uint64(0x7F)
+        result[ends - 1] |= 0x80
+
+        return PackedEncoding(data=result.tobytes(), n_bits=8*len(result))
+
+    def decodeArray(self, target: PackedEncoding) -> np.ndarray:
+        data = np.frombuffer(target.data, dtype=np.uint8, count=target.n_bits // 8)
+        stops   = np.flatnonzero(data & 0x80)
+        n_bytes = np.diff(stops, prepend=-1)
+
+        result = np.zeros(len(stops), dtype=np.uint64)
+        for i in range(int(n_bytes.max(initial=0))):
+            has_byte = n_bytes > i
+            result[has_byte] |= (data[stops[has_byte] - i] & 0x7F).astype(np.uint64) << np.uint64(7*i)
+        return result
+
 
 class Simple9(Code):
 
@@ -125,7 +288,23 @@ class Simple9(Code):
     def decode(self, target: Encoding) -> Decoding:
         raise RuntimeError("Simple-9 has no individual decoding.")
 
+    def read(self, reader: BitReader) -> int:
+        raise RuntimeError("Simple-9 has no individual decoding.")
+
     def encodeMany(self, source: Iterable[int]) -> Encoding:
+        writer = StringBitWriter()
+        self.writeMany(source, writer)
+        return writer.finish()
+
+    def writeMany(self, source: Iterable[int], writer: BitWriter):
+        for amount, numbers in self._words(source):
+            stride = 28 // amount
+            writer.write(amount if amount != 28 else 0, 4)
+            for number in numbers:
+                writer.write(number, stride)
+            writer.write(0, 28 - stride*len(numbers))
+
+    def _words(self, source: Iterable[int]) -> Iterator[Tuple[int, List[int]]]:
         """
         Go through the list, and accumulate numbers. Then, you can do two things:
           1. switch preferred mode, or
@@ -133,20 +312,23 @@ class Simple9(Code):
         The first happens when an integer has a bigger length than the current stride. Possibly, you then have to commit
         what was already in the buffer using the old stride.
         The second happens when your accumulated numbers can fill up the current mode, i.e. there are  >= amount  integers.
+
+        Yields the amount of slots of each word, and the numbers that go into it (which can be less than the amount of slots).
         """
-        result = ""
         buffer = []
 
         amount_index = len(self.possible_amounts) - 1
         amount       = self.possible_amounts[amount_index]
         for number in source:
-            bits = toBinary(number)
-            buffer.append(bits)
+            if not 1 <= number < 2**28:  # A 0 would fit in any slot, but reads back as padding.
+                raise ValueError("Simple-9 can only encode integers from 1 to 2^28-1.")
+            length = number.bit_length()
+            buffer.append(number)
 
-            if len(bits) > 28 // amount:  # Current stride can't support this length.
+            if length > 28 // amount:  # Current stride can't support this length.
                 new_index  = amount_index
                 new_amount = amount
-                while len(bits) > 28 // new_amount:
+                while length > 28 // new_amount:
                     new_index -= 1
                     new_amount = self.possible_amounts[new_index]
 
@@ -154,8 +336,7 @@ class Simple9(Code):
                 # fill the slots before getting to this new number. If that's the case, don't use this new stride yet, but
                 # commit using the old stride. If the buffer does fit, no "emergency commit" has to be done yet.
                 if len(buffer) > new_amount:  # The buffer stretches past the new amount, and the last element is that new integer.
-                    new_bits = (toBinary(amount) if amount != 28 else ZERO).zfill(4) + "".join(map(lambda bits: bits.zfill(28 // amount), buffer[:-1]))  # Note the :-1 instead of :amount because we're not sure if we can even fill all the old slots. We only know we have too much for the new slots.
-                    result += new_bits + ZERO*(32-len(new_bits))
+                    yield amount, buffer[:-1]  # Note the :-1 instead of :amount because we're not sure if we can even fill all the old slots. We only know we have too much for the new slots.
                     buffer = [buffer[-1]]
 
                 amount_index = new_index
@@ -163,8 +344,7 @@ class Simple9(Code):
 
             # Normal commit
             if len(buffer) >= amount:
-                new_bits = (toBinary(amount) if amount != 28 else ZERO).zfill(4) + "".join(map(lambda bits: bits.zfill(28//amount), buffer[:amount]))
-                result += new_bits + ZERO*(32-len(new_bits))
+                yield amount, buffer[:amount]
                 buffer = buffer[amount:]
 
                 # Reset stride
@@ -172,19 +352,398 @@ class Simple9(Code):
                 amount       = self.possible_amounts[amount_index]
 
         if buffer:  # Use the current stride, which we know is valid, to commit the rest.
-            new_bits = (toBinary(amount) if amount != 28 else ZERO).zfill(4) + "".join(map(lambda bits: bits.zfill(28 // amount), buffer[:amount]))
-            result += new_bits + ZERO * (32 - len(new_bits))
-
-        return result
+            yield amount, buffer[:amount]
 
-    def decodeMany(self, target: Encoding) -> Iterable[int]:
-        while target:
-            amount = int(target[:4], 2) or 28
+    def encodeArray(self, source: np.ndarray) -> PackedEncoding:
+        """
+        Vectorised equivalent of encodeManyPacked. Rather than switching modes while scanning, it computes for every
+        position at once which mode fits the most numbers starting there, and then chains words together from the start.
+        This can pack some words fuller than the scalar encoder does, but any decoder reads the result the same way.
+        """
+        values = np.asarray(source, dtype=np.uint64)
+        n = len(values)
+        if n == 0:
+            return PackedEncoding(data=b"", n_bits=0)
+        lengths = np.frexp(values.astype(np.float64))[1]  # Equal to the bit length for integers this small.
+        if lengths.max() > 28 or lengths.min() == 0:
+            raise ValueError("Simple-9 can only encode integers from 1 to 2^28-1.")
+
+        # For every position, find the biggest amount whose stride fits all the numbers in its window. A window fits when
+        # the amount of too-long numbers before its end equals the amount before its start.
+        positions = np.arange(n)
+        amounts = np.zeros(n, dtype=np.int64)
+        too_long_before = np.zeros(n+1, dtype=np.int32)
+        too_long_before_end = np.empty(n, dtype=np.int32)
+        for amount in self.possible_amounts:  # From small to big, so bigger amounts overwrite smaller ones.
+            np.cumsum(lengths > 28 // amount, out=too_long_before[1:])
+            too_long_before_end[:max(n-amount,0)] = too_long_before[amount:n]
+            too_long_before_end[max(n-amount,0):] = too_long_before[n]  # Windows at the end are cut off.
+            amounts[too_long_before_end == too_long_before[:n]] = amount
+
+        word_starts = followChain(positions + amounts)
+        word_amounts = amounts[word_starts]
+        word_sizes   = np.diff(word_starts, append=n)  # Smaller than the amount for the last word if it isn't full.
+        word_strides = 28 // word_amounts
+
+        # Every number is shifted into its slot, and the slots of one word are summed together.
+        word_of_number = np.repeat(np.arange(len(word_starts)), word_sizes)
+        slot_of_number = positions - word_starts[word_of_number]
+        shifts = 28 - word_strides[word_of_number]*(slot_of_number + 1)
+        words = np.add.reduceat(values << shifts.astype(np.uint64), word_starts)
+        words |= np.where(word_amounts == 28, 0, word_amounts).astype(np.uint64) << np.uint64(28)
+
+        return PackedEncoding(data=words.astype(">u4").tobytes(), n_bits=32*len(words))
+
+    def decodeArray(self, target: PackedEncoding) -> np.ndarray:
+        words = np.frombuffer(target.data, dtype=">u4", count=target.n_bits // 32).astype(np.uint64)
+        amounts = (words >> np.uint64(28)).astype(np.int64)
+        amounts[amounts == 0] = 28
+        strides = 28 // amounts
+
+        word_of_slot = np.repeat(np.arange(len(words)), amounts)
+        slot_in_word = np.arange(len(word_of_slot)) - np.repeat(np.cumsum(amounts) - amounts, amounts)
+        slot_strides = strides[word_of_slot]
+        shifts = (28 - slot_strides*(slot_in_word + 1)).astype(np.uint64)
+        result = (words[word_of_slot] >> shifts) & ((np.uint64(1) << slot_strides.astype(np.uint64)) - np.uint64(1))
+        return result[result != 0]  # Empty slots are 0, and no actual number is.
+
+    def readMany(self, reader: BitReader) -> Iterator[int]:
+        while not reader.isExhausted():
+            word = reader.read(32)
+            amount = (word >> 28) or 28
             stride = 28 // amount
-            for i in range(amount):
-                number = int(target[4 + i*stride:4 + (i+1)*stride], 2)
+            mask   = (1 << stride) - 1
+            for shift in range(28 - stride, 28 - stride*(amount+1), -stride):
+                number = (word >> shift) & mask
                 if number == 0:
                     break
                 yield number
 
-            target = target[32:] # Will trim off an extra '28 % amount' versus what the loop saw.
+
+class Simple16(Code):
+    """
+    Like Simple-9, a 32-bit word is a 4-bit selector plus 28 bits of payload. Simple-9 only uses 9 of the 16 possible
+    selectors, and every one of them has a single slot width, which wastes up to 3 bits per word. Simple-16 uses all
+    16 selectors, and mixes slot widths within a word, so a handful of bigger numbers doesn't force a wide stride on
+    all their neighbours.
+    """
+
+    def __init__(self):
+        layouts = [  # (amount, width) runs, in the order they appear in the word. Sorted by amount of slots.
+            [(28,1)],
+            [(7,2), (14,1)],
+            [(7,1), (7,2), (7,1)],
+            [(14,1), (7,2)],
+            [(14,2)],
+            [(1,4), (8,3)],
+            [(1,3), (4,4), (3,3)],
+            [(7,4)],
+            [(4,5), (2,4)],
+            [(2,4), (4,5)],
+            [(3,6), (2,5)],
+            [(2,5), (3,6)],
+            [(4,7)],
+            [(1,10), (2,9)],
+            [(2,14)],
+            [(1,28)]
+        ]
+        self.layouts = layouts
+        self.slot_widths = [[width for amount, width in layout for _ in range(amount)] for layout in layouts]
+
+        # For vectorised packing: the shift and width of every slot of every selector.
+        self.amount_table = np.array([len(widths) for widths in self.slot_widths])
+        self.width_table  = np.zeros((16, 28), dtype=np.int64)
+        self.shift_table  = np.zeros((16, 28), dtype=np.int64)
+        for selector, widths in enumerate(self.slot_widths):
+            self.width_table[selector, :len(widths)] = widths
+            self.shift_table[selector, :len(widths)] = 28 - np.cumsum(widths)
+
+    def encode(self, source: int) -> Encoding:
+        raise RuntimeError("Simple-16 has no individual encoding.")
+
+    def decode(self, target: Encoding) -> Decoding:
+        raise RuntimeError("Simple-16 has no individual decoding.")
+
+    def read(self, reader: BitReader) -> int:
+        raise RuntimeError("Simple-16 has no individual decoding.")
+
+    def encodeMany(self, source: Iterable[int]) -> Encoding:
+        writer = StringBitWriter()
+        self.writeMany(source, writer)
+        return writer.finish()
+
+    def writeMany(self, source: Iterable[int], writer: BitWriter):
+        """
+        Greedily uses the first selector (i.e. the one with the most slots) that fits the upcoming numbers. At the end
+        of the list, a selector also fits if it has more slots than there are numbers left; those slots stay 0.
+        """
+        numbers = list(source)
+        if any(not 1 <= number < 2**28 for number in numbers):  # A 0 would fit in any slot, but reads back as padding.
+            raise ValueError("Simple-16 can only encode integers from 1 to 2^28-1.")
+        i = 0
+        while i < len(numbers):
+            for selector, widths in enumerate(self.slot_widths):
+                amount = min(len(widths), len(numbers) - i)
+                if all(numbers[i+j].bit_length() <= widths[j] for j in range(amount)):
+                    break
+            else:
+                raise ValueError(f"Simple-16 can only encode integers from 1 to 2^28-1, not {numbers[i]}.")
+
+            writer.write(selector, 4)
+            for j in range(amount):
+                writer.write(numbers[i+j], widths[j])
+            writer.write(0, 28 - sum(widths[:amount]))
+            i += amount
+
+    def readMany(self, reader: BitReader) -> Iterator[int]:
+        while not reader.isExhausted():
+            word = reader.read(32)
+            shift = 28
+            for width in self.slot_widths[word >> 28]:
+                shift -= width
+                number = (word >> shift) & ((1 << width) - 1)
+                if number == 0:
+                    break
+                yield number
+
+    def encodeArray(self, source: np.ndarray) -> PackedEncoding:
+        """
+        Vectorised equivalent of encodeManyPacked. Produces exactly the same words.
+        """
+        values = np.asarray(source, dtype=np.uint64)
+        n = len(values)
+        if n == 0:
+            return PackedEncoding(data=b"", n_bits=0)
+        lengths = bitLengths(values)
+        if lengths.max() > 28 or lengths.min() == 0:
+            raise ValueError("Simple-16 can only encode integers from 1 to 2^28-1.")
+
+        # A run of slots fits at a position when no number in its window is too long for the run's width.
+        too_long_before = dict()
+        for width in {width for layout in self.layouts for _, width in layout}:
+            too_long_before[width] = np.concatenate([[0], np.cumsum(lengths > width)])
+
+        positions = np.arange(n)
+        selectors = np.zeros(n, dtype=np.int64)
+        for selector in reversed(range(16)):  # The first selector that fits wins, so it has to overwrite the others.
+            fits = np.ones(n, dtype=bool)
+            run_start = 0
+            for amount, width in self.layouts[selector]:
+                window_start = np.minimum(positions + run_start, n)
+                window_end   = np.minimum(positions + run_start + amount, n)
+                fits &= too_long_before[width][window_end] == too_long_before[width][window_start]
+                run_start += amount
+            selectors[fits] = selector
+
+        word_starts    = followChain(positions + self.amount_table[selectors])
+        word_selectors = selectors[word_starts]
+        word_sizes     = np.diff(word_starts, append=n)
+
+        word_of_number = np.repeat(np.arange(len(word_starts)), word_sizes)
+        slot_of_number = positions - word_starts[word_of_number]
+        shifts = self.shift_table[word_selectors[word_of_number], slot_of_number]
+        words = np.add.reduceat(values << shifts.astype(np.uint64), word_starts)
+        words |= word_selectors.astype(np.uint64) << np.uint64(28)
+
+        return PackedEncoding(data=words.astype(">u4").tobytes(), n_bits=32*len(words))
+
+    def decodeArray(self, target: PackedEncoding) -> np.ndarray:
+        words = np.frombuffer(target.data, dtype=">u4", count=target.n_bits // 32).astype(np.uint64)
+        selectors = (words >> np.uint64(28)).astype(np.int64)
+        amounts   = self.amount_table[selectors]
+
+        word_of_slot = np.repeat(np.arange(len(words)), amounts)
+        slot_in_word = np.arange(len(word_of_slot)) - np.repeat(np.cumsum(amounts) - amounts, amounts)
+        slot_selectors = selectors[word_of_slot]
+        shifts = self.shift_table[slot_selectors, slot_in_word].astype(np.uint64)
+        masks  = (np.uint64(1) << self.width_table[slot_selectors, slot_in_word].astype(np.uint64)) - np.uint64(1)
+        result = (words[word_of_slot] >> shifts) & masks
+        return result[result != 0]
+
+
+class PForDelta(Code):
+    """
+    Patched frame-of-reference coding. The list is cut into blocks, and all numbers in a block are stored in the same
+    amount of bits b. That amount is chosen such that most of the block fits; the few numbers that don't, are
+    "exceptions" that store their lowest b bits in their slot like everyone else, and their position in the block and
+    their remaining high bits after the slots. An outlier thus costs extra bits for itself, rather than for its block.
+
+    Every block looks like:
+        [amount of numbers] [b] [amount of exceptions] [width of the high bits] [slots] [exception positions] [high bits]
+    Unlike Simple-9, numbers can be 0, since the amount of numbers is stored explicitly.
+    """
+
+    def __init__(self, block_size: int=128, exception_ratio: float=0.1):
+        self.block_size      = block_size
+        self.exception_ratio = exception_ratio
+
+        self.count_width    = block_size.bit_length()      # Fits any amount from 0 to block_size.
+        self.position_width = (block_size-1).bit_length()  # Fits any position in a block.
+        self.header_width   = 2*self.count_width + 2*7     # Widths are at most 64, which fits in 7 bits.
+
+    def parameters(self) -> dict:
+        return {"block_size": self.block_size, "exception_ratio": self.exception_ratio}
+
+    def encode(self, source: int) -> Encoding:
+        raise RuntimeError("PForDelta has no individual encoding.")
+
+    def decode(self, target: Encoding) -> Decoding:
+        raise RuntimeError("PForDelta has no individual decoding.")
+
+    def read(self, reader: BitReader) -> int:
+        raise RuntimeError("PForDelta has no individual decoding.")
+
+    def encodeMany(self, source: Iterable[int]) -> Encoding:
+        writer = StringBitWriter()
+        self.writeMany(source, writer)
+        return writer.finish()
+
+    def _chooseWidths(self, histograms: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+        """
+        Given, for every block, how many of its numbers have each bit length from 0 to 64, choose the width b of the
+        block's slots. Classic PForDelta takes the smallest b that makes at most a fixed fraction of the block an exception.
+        """
+        exceptions = histograms[:, ::-1].cumsum(axis=1)[:, ::-1]  # Numbers with bit length >= b ...
+        exceptions = np.concatenate([exceptions[:, 1:], np.zeros((len(sizes), 1), dtype=exceptions.dtype)], axis=1)  # ... > b.
+        allowed = np.floor(self.exception_ratio * sizes).astype(np.int64)
+        return np.argmax(exceptions <= allowed[:, None], axis=1)
+
+    def _blockLayouts(self, lengths: np.ndarray, block_of_number: np.ndarray, n_blocks: int):
+        sizes      = np.bincount(block_of_number, minlength=n_blocks)
+        histograms = np.bincount(block_of_number*65 + lengths, minlength=n_blocks*65).reshape(n_blocks, 65)
+        widths = self._chooseWidths(histograms, sizes)
+
+        max_lengths  = np.max((histograms > 0) * np.arange(65), axis=1)
+        n_exceptions = np.bincount(block_of_number, weights=lengths > widths[block_of_number], minlength=n_blocks).astype(np.int64)
+        high_widths  = np.where(n_exceptions > 0, max_lengths - widths, 0)
+        return sizes, widths, n_exceptions, high_widths
+
+    def writeMany(self, source: Iterable[int], writer: BitWriter):
+        numbers = list(source)
+        for block_start in range(0, len(numbers), self.block_size):
+            block = numbers[block_start:block_start+self.block_size]
+            lengths = np.array([number.bit_length() for number in block])
+            (size,), (width,), (n_exceptions,), (high_width,) = self._blockLayouts(lengths, np.zeros(len(block), dtype=np.int64), 1)
+            width, high_width = int(width), int(high_width)
+
+            exceptions = [i for i, number in enumerate(block) if number.bit_length() > width]
+            writer.write(int(size), self.count_width)
+            writer.write(width, 7)
+            writer.write(int(n_exceptions), self.count_width)
+            writer.write(high_width, 7)
+            mask = (1 << width) - 1
+            for number in block:
+                writer.write(number & mask, width)
+            for i in exceptions:
+                writer.write(i, self.position_width)
+            for i in exceptions:
+                writer.write(block[i] >> width, high_width)
+
+    def readMany(self, reader: BitReader) -> Iterator[int]:
+        while not reader.isExhausted():
+            size         = reader.read(self.count_width)
+            width        = reader.read(7)
+            n_exceptions = reader.read(self.count_width)
+            high_width   = reader.read(7)
+
+            block = [reader.read(width) for _ in range(size)]
+            positions = [reader.read(self.position_width) for _ in range(n_exceptions)]
+            for i in positions:
+                block[i] |= reader.read(high_width) << width
+            yield from block
+
+    def encodeArray(self, source: np.ndarray) -> PackedEncoding:
+        """
+        Vectorised equivalent of encodeManyPacked: all blocks are laid out at once, and then every field is written at
+        its offset in one go. Produces exactly the same bits.
+        """
+        values = np.asarray(source, dtype=np.uint64)
+        n = len(values)
+        if n == 0:
+            return PackedEncoding(data=b"", n_bits=0)
+        n_blocks = (n - 1) // self.block_size + 1
+        block_of_number = np.arange(n) // self.block_size
+        lengths = bitLengths(values)
+        sizes, widths, n_exceptions, high_widths = self._blockLayouts(lengths, block_of_number, n_blocks)
+
+        slots_start      = self.header_width
+        positions_start  = slots_start + sizes*widths
+        high_bits_start  = positions_start + n_exceptions*self.position_width
+        block_bits   = high_bits_start + n_exceptions*high_widths
+        block_starts = np.cumsum(block_bits) - block_bits
+
+        # Headers
+        header_values  = np.stack([sizes, widths, n_exceptions, high_widths], axis=1).ravel()
+        header_widths  = np.tile([self.count_width, 7, self.count_width, 7], n_blocks)
+        header_offsets = (block_starts[:, None] + np.cumsum([0, self.count_width, 7, self.count_width])).ravel()
+
+        # Slots
+        number_widths = widths[block_of_number]
+        slot_values   = values & ((np.uint64(1) << number_widths.astype(np.uint64)) - np.uint64(1))
+        slot_offsets  = block_starts[block_of_number] + slots_start + (np.arange(n) % self.block_size)*number_widths
+
+        # Exceptions
+        exceptions = np.flatnonzero(lengths > number_widths)
+        exception_blocks = block_of_number[exceptions]
+        exception_ranks  = np.arange(len(exceptions)) - (np.cumsum(n_exceptions) - n_exceptions)[exception_blocks]
+        position_values  = exceptions % self.block_size
+        position_offsets = block_starts[exception_blocks] + positions_start[exception_blocks] + exception_ranks*self.position_width
+        high_values  = values[exceptions] >> widths[exception_blocks].astype(np.uint64)
+        high_offsets = block_starts[exception_blocks] + high_bits_start[exception_blocks] + exception_ranks*high_widths[exception_blocks]
+
+        return packFields(
+            np.concatenate([header_values.astype(np.uint64), slot_values, position_values.astype(np.uint64), high_values]),  # Mixing signed and unsigned would go through floats.
+            np.concatenate([header_widths, number_widths, np.full(len(exceptions), self.position_width), high_widths[exception_blocks]]),
+            np.concatenate([header_offsets, slot_offsets, position_offsets, high_offsets]),
+            int(block_bits.sum())
+        )
+
+    def decodeArray(self, target: PackedEncoding) -> np.ndarray:
+        """
+        Where a block starts depends on the headers of all the blocks before it, so only the headers are read one by one.
+        There are few of them, and after that, all slots and exceptions are unpacked at once.
+        """
+        reader = PackedBitReader(target)
+        headers = []
+        while not reader.isExhausted():
+            block_start  = reader.tell()
+            size         = reader.read(self.count_width)
+            width        = reader.read(7)
+            n_exceptions = reader.read(self.count_width)
+            high_width   = reader.read(7)
+            headers.append((block_start, size, width, n_exceptions, high_width))
+            reader.seek(block_start + self.header_width + size*width + n_exceptions*(self.position_width + high_width))
+        if not headers:
+            return np.zeros(0, dtype=np.uint64)
+        block_starts, sizes, widths, n_exceptions, high_widths = map(np.array, zip(*headers))
+
+        block_of_number = np.repeat(np.arange(len(headers)), sizes)
+        number_in_block = np.arange(len(block_of_number)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        slot_widths = widths[block_of_number]
+        result = unpackFields(target, slot_widths, block_starts[block_of_number] + self.header_width + number_in_block*slot_widths)
+
+        exception_blocks = np.repeat(np.arange(len(headers)), n_exceptions)
+        exception_ranks  = np.arange(len(exception_blocks)) - np.repeat(np.cumsum(n_exceptions) - n_exceptions, n_exceptions)
+        positions_start  = block_starts + self.header_width + sizes*widths
+        positions = unpackFields(target, np.full(len(exception_blocks), self.position_width),
+                                 positions_start[exception_blocks] + exception_ranks*self.position_width).astype(np.int64)
+        high_bits = unpackFields(target, high_widths[exception_blocks],
+                                 positions_start[exception_blocks] + n_exceptions[exception_blocks]*self.position_width + exception_ranks*high_widths[exception_blocks])
+
+        first_number_of_block = np.cumsum(sizes) - sizes
+        result[first_number_of_block[exception_blocks] + positions] |= high_bits << widths[exception_blocks].astype(np.uint64)
+        return result
+
+
+class OptPForDelta(PForDelta):
+    """
+    PForDelta where b isn't chosen by a fixed exception ratio, but as the b that makes the block as small as possible.
+    """
+
+    def _chooseWidths(self, histograms: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+        bs = np.arange(65)
+        exceptions  = np.concatenate([histograms[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:], np.zeros((len(sizes), 1), dtype=np.int64)], axis=1)
+        max_lengths = np.max((histograms > 0) * bs, axis=1)
+        high_widths = np.where(exceptions > 0, max_lengths[:, None] - bs, 0)
+        costs = sizes[:, None]*bs + exceptions*(self.position_width + high_widths)
+        return np.argmin(costs, axis=1)
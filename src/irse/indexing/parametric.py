@@ -1,4 +1,7 @@
-from irse.indexing.nonparametric import Code, UnaryCode, toBinary, Encoding, Decoding
+import numpy as np
+
+from irse.indexing.nonparametric import Code, UnaryCode, toBinary, Encoding, Decoding, followChain
+from irse.indexing.bits import BitWriter, BitReader, PackedEncoding
 
 
 class GolombRiceCode(Code):
@@ -8,6 +11,9 @@ class GolombRiceCode(Code):
         self.unary = UnaryCode()
         self.offset_length = len(toBinary(bucket_size-1))  # Biggest offset possible needs this many bits
 
+    def parameters(self) -> dict:
+        return {"bucket_size": self.M}
+
     def encode(self, source: int) -> Encoding:
         source -= 1  # Now it is >= 0. Saves us some bits.
         return self.unary.encode(source // self.M + 1) + toBinary(source % self.M).zfill(self.offset_length)  # + 1 to the quotient because it can be 0, and there is no unary for 0.
@@ -16,3 +22,48 @@ class GolombRiceCode(Code):
         q_plus_one, head = self.unary.decode(target)
         r = int(target[head:head+self.offset_length], 2)
         return ((q_plus_one-1)*self.M + r) + 1, head+self.offset_length
+
+    def write(self, source: int, writer: BitWriter):
+        quotient, remainder = divmod(source-1, self.M)
+        writer.writeUnary(quotient+1)
+        writer.write(remainder, self.offset_length)
+
+    def read(self, reader: BitReader) -> int:
+        q_plus_one = reader.readUnary()
+        return (q_plus_one-1)*self.M + reader.read(self.offset_length) + 1
+
+    def encodeArray(self, source: np.ndarray) -> PackedEncoding:
+        """
+        Vectorised equivalent of encodeManyPacked. Each number's codeword gets a known start in one big bit array, so
+        the unary terminators and the bits of the remainders can all be set at once.
+        """
+        values = np.asarray(source, dtype=np.uint64) - np.uint64(1)
+        quotients  = (values // np.uint64(self.M)).astype(np.int64)
+        remainders = values % np.uint64(self.M)
+
+        ends = np.cumsum(quotients + 1 + self.offset_length)
+        terminators = ends - self.offset_length - 1
+        bits = np.zeros(ends[-1] if len(ends) else 0, dtype=np.uint8)
+        bits[terminators] = 1
+        for i in range(self.offset_length):
+            bits[terminators + 1 + i] = (remainders >> np.uint64(self.offset_length - 1 - i)) & np.uint64(1)
+
+        return PackedEncoding(data=np.packbits(bits).tobytes(), n_bits=len(bits))
+
+    def decodeArray(self, target: PackedEncoding) -> np.ndarray:
+        """
+        The ones in the bit array are either unary terminators or remainder bits. Every terminator is followed by exactly
+        offset_length remainder bits and then the zeroes of the next quotient, so from one terminator, you know which one
+        is the next terminator. The first one is always a terminator, and the rest follow by chaining.
+        """
+        bits = np.unpackbits(np.frombuffer(target.data, dtype=np.uint8), count=target.n_bits)
+        ones = np.flatnonzero(bits)
+        ones_before = np.zeros(len(bits) + 1, dtype=np.int32 if len(bits) < 2**31 else np.int64)
+        np.cumsum(bits, out=ones_before[1:])
+        terminators = ones[followChain(ones_before[np.minimum(ones + 1 + self.offset_length, len(bits))])]  # The index of the first one at or after the given position is the amount of ones before it.
+
+        starts = np.concatenate([[0], terminators[:-1] + 1 + self.offset_length])
+        remainders = np.zeros(len(terminators), dtype=np.uint64)
+        for i in range(self.offset_length):
+            remainders = (remainders << np.uint64(1)) | bits[terminators + 1 + i]
+        return (terminators - starts).astype(np.uint64)*np.uint64(self.M) + remainders + np.uint64(1)
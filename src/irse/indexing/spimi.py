@@ -0,0 +1,222 @@
+"""
+Single-pass in-memory indexing (SPIMI), for corpora whose postings don't fit in memory.
+
+Documents are streamed once. Their postings are collected in a dictionary from term to a growing array of postings,
+until the estimated size of that dictionary exceeds a memory budget. The dictionary is then written to disk as a "run",
+with its terms in sorted order, and emptied. Since documents arrive in order of ID, every run covers a later range of
+IDs than the runs before it. When the documents run out, all runs are read in parallel and merged by term (a k-way
+merge with a heap), and the postings of each term go straight into an InvertedIndexWriter that writes to disk. Every
+run that is read is an open file, so when there are too many runs for that, groups of them are merged into bigger runs
+first, in as many passes as needed.
+
+At no point is more than one run's worth of postings in memory, however big the corpus is.
+
+Because runs only need to be in order of document ID, and not be produced by the same process, the corpus can also be
+cut into consecutive batches that are preprocessed and inverted by different processes, after which the merge is the same.
+"""
+from typing import Iterable, List, Iterator, Tuple, Optional, Callable, Union
+from collections import Counter, deque
+from pathlib import Path
+from array import array
+from heapq import merge
+
+import struct
+import tempfile
+import multiprocessing
+import numpy as np
+
+from irse.indexing.nonparametric import Code
+from irse.indexing.inverted import InvertedIndex, InvertedIndexWriter
+
+RUN_RECORD_HEADER = struct.Struct("<IQ")  # Length of the term in bytes, amount of postings.
+
+
+class SPIMI:
+
+    # Rough amount of memory that a new term costs in the dictionary (the string, the dictionary slot, and an empty
+    # array), and that every posting costs (two 8-byte integers, plus the slack of a growing array).
+    BYTES_PER_TERM    = 200
+    BYTES_PER_POSTING = 18
+
+    def __init__(self, memory_budget: int=256*2**20, code: Code=None, frequency_code: Code=None, block_size: int=128,
+                 max_fan_in: int=64):
+        """
+        :param memory_budget: the (estimated) amount of bytes that the postings in memory may take up before they are
+                              written to a run. This is what bounds the memory used during indexing.
+        :param max_fan_in: maximal amount of runs merged at once, i.e. of run files open at the same time.
+        """
+        if max_fan_in < 2:
+            raise ValueError("At least two runs have to be merged at once.")
+        self.memory_budget = memory_budget
+        self.max_fan_in = max_fan_in
+        self.code = code
+        self.frequency_code = frequency_code
+        self.block_size = block_size
+
+    def build(self, documents: Iterable[Union[str, List[str]]], path: Path,
+              preprocess: Callable[[str], List[str]]=None, processes: int=1, batch_size: int=10_000) -> InvertedIndex:
+        """
+        Indexes the given documents (document IDs are given in order of iteration, starting at 0), writes the index to
+        the given path, and returns it memory-mapped. Runs are written to temporary files next to that path.
+
+        :param documents: tokenised documents, or raw documents if a preprocessing function is given.
+        :param preprocess: turns a raw document into its terms. Preprocessing is usually the slowest part of indexing,
+                           so when multiple processes are used, it is done in those processes.
+        :param processes: if more than 1, batches of documents are preprocessed and inverted into runs by a pool of
+                          processes, which each get the full memory budget. The runs are merged exactly like the runs
+                          of a single process, so the resulting index file is identical.
+        :param batch_size: amount of documents sent to a process at once. Every batch produces at least one run, so a
+                           big corpus in small batches gives many runs; the merge then takes more than one pass (see
+                           _merge()), which costs disk traffic but not open files. Batches that roughly fill the memory
+                           budget avoid that.
+        """
+        path = Path(path)
+        writer = InvertedIndexWriter(self.code, self.frequency_code, self.block_size, path=path)
+        with tempfile.TemporaryDirectory(dir=path.parent) as folder:
+            folder = Path(folder)
+            runs = []
+            if processes > 1:
+                batches = self._invertBatches(documents, folder, preprocess, processes, batch_size)
+            else:
+                batches = [self._invert(map(preprocess, documents) if preprocess else documents, 0, folder / "run")]
+
+            for batch in batches:
+                for run, document_lengths in batch:
+                    if run is not None:
+                        runs.append(run)
+                    writer.addDocumentLengths(document_lengths)
+            self._merge(runs, writer)
+        return writer.finish()
+
+    def _invert(self, documents: Iterable[List[str]], first_id: int, prefix: Path) -> Iterator[Tuple[Optional[Path], array]]:
+        """
+        Inverts the given documents into runs whose paths start with the given prefix. Yields, for every run, its path
+        and the lengths of the documents in it. Documents without terms may leave a last "run" without a path.
+        """
+        n_runs = 0
+        dictionary = dict()  # term -> array of doc ID, tf, doc ID, tf, ...
+        document_lengths = array("q")
+        used = 0
+        for document_id, document in enumerate(documents, start=first_id):
+            document_lengths.append(len(document))
+            for term, frequency in Counter(document).items():
+                postings = dictionary.get(term)
+                if postings is None:
+                    postings = dictionary[term] = array("q")
+                    used += SPIMI.BYTES_PER_TERM + len(term)
+                postings.append(document_id)
+                postings.append(frequency)
+                used += SPIMI.BYTES_PER_POSTING
+
+            if used >= self.memory_budget:
+                yield self._writeRun(dictionary, prefix.with_name(f"{prefix.name}{n_runs}.bin")), document_lengths
+                n_runs += 1
+                dictionary = dict()
+                document_lengths = array("q")
+                used = 0
+
+        if dictionary:
+            yield self._writeRun(dictionary, prefix.with_name(f"{prefix.name}{n_runs}.bin")), document_lengths
+        elif document_lengths:
+            yield None, document_lengths
+
+    def _invertBatches(self, documents: Iterable[str], folder: Path, preprocess: Callable[[str], List[str]],
+                       processes: int, batch_size: int) -> Iterator[List[Tuple[Optional[Path], array]]]:
+        """
+        Sends batches of documents to a pool of processes, and yields their runs in the order of the batches. Only a
+        few batches per process are in flight at any time, so the corpus is still streamed rather than read up front.
+        """
+        with multiprocessing.Pool(processes, initializer=_initialiseWorker, initargs=(self, preprocess)) as pool:
+            in_flight = deque()
+            first_id = 0
+            for b, batch in enumerate(_batched(documents, batch_size)):
+                in_flight.append(pool.apply_async(_invertBatch, (batch, first_id, folder / f"batch{b}-run")))
+                first_id += len(batch)
+                if len(in_flight) >= 2*processes:
+                    yield in_flight.popleft().get()
+            while in_flight:
+                yield in_flight.popleft().get()
+
+    @staticmethod
+    def _writeRun(dictionary: dict, path: Path) -> Path:
+        with open(path, "wb") as handle:
+            for term in sorted(dictionary):
+                SPIMI._writeRecord(handle, term, dictionary[term])
+        return path
+
+    @staticmethod
+    def _writeRecord(handle, term: str, postings: Union[array, np.ndarray]):
+        encoded = term.encode("utf-8")
+        handle.write(RUN_RECORD_HEADER.pack(len(encoded), len(postings) // 2))
+        handle.write(encoded)
+        handle.write(np.asarray(postings, dtype="<i8").tobytes())
+
+    @staticmethod
+    def _readRun(path: Path) -> Iterator[Tuple[str, np.ndarray]]:
+        with open(path, "rb") as handle:
+            while True:
+                header = handle.read(RUN_RECORD_HEADER.size)
+                if not header:
+                    break
+                term_length, n_postings = RUN_RECORD_HEADER.unpack(header)
+                term = handle.read(term_length).decode("utf-8")
+                yield term, np.frombuffer(handle.read(16*n_postings), dtype="<i8")
+
+    def _merge(self, runs: List[Path], writer: InvertedIndexWriter):
+        """
+        The heap merge is stable, so when several runs have the same term, they come out in the order of the runs, and
+        hence in order of document ID. The writer glues consecutive postings of the same term together.
+
+        With more than max_fan_in runs, consecutive groups of runs are merged into one run each, until few enough are
+        left. Since the groups are consecutive, the merged runs are still in order of document ID. A merged run can have
+        several records for the same term (one per run it came from), which is fine, since they are in order too. Every
+        such pass reads and writes all postings once more, but with a fan-in of 64, two passes already handle 4096 runs.
+        """
+        n_passes = 0
+        while len(runs) > self.max_fan_in:
+            groups = [runs[i:i+self.max_fan_in] for i in range(0, len(runs), self.max_fan_in)]
+            runs = [self._mergeRuns(group, group[0].with_name(f"pass{n_passes}-run{g}.bin")) if len(group) > 1 else group[0]
+                    for g, group in enumerate(groups)]
+            n_passes += 1
+
+        for term, postings in self._mergedRecords(runs):
+            writer.add(term, postings[0::2], postings[1::2])
+
+    def _mergeRuns(self, runs: List[Path], path: Path) -> Path:
+        """Merges the given runs into one run at the given path, and deletes them."""
+        with open(path, "wb") as handle:
+            for term, postings in self._mergedRecords(runs):
+                SPIMI._writeRecord(handle, term, postings)
+        for run in runs:
+            run.unlink()
+        return path
+
+    def _mergedRecords(self, runs: List[Path]) -> Iterator[Tuple[str, np.ndarray]]:
+        return merge(*map(self._readRun, runs), key=lambda record: record[0])
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Every worker process gets its own copy of the indexer and the preprocessing function once, rather than with every batch.
+_worker_spimi: SPIMI = None
+_worker_preprocess: Callable[[str], List[str]] = None
+
+def _initialiseWorker(spimi: SPIMI, preprocess: Callable[[str], List[str]]):
+    global _worker_spimi, _worker_preprocess
+    _worker_spimi = spimi
+    _worker_preprocess = preprocess
+
+
+def _invertBatch(documents: list, first_id: int, prefix: Path) -> List[Tuple[Optional[Path], array]]:
+    if _worker_preprocess is not None:
+        documents = map(_worker_preprocess, documents)
+    return list(_worker_spimi._invert(documents, first_id, prefix))
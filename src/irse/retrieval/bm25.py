@@ -1,4 +1,7 @@
-from typing import List, Iterable, Tuple
+from typing import List, Iterable, Tuple, Optional
+from pathlib import Path
+
+import json
 
 import nltk
 from nltk.corpus import stopwords
@@ -9,7 +12,12 @@ nltk.download("stopwords", quiet=True)
 from tktkt.preparation.mappers import Lowercaser, FilterCharacters, MapperSequence, Stripper
 from tktkt.preparation.instances import TraditionalPretokeniser, Preprocessor, PunctuationPretokeniser
 
-from rank_bm25 import BM25Okapi
+from irse.indexing.nonparametric import Code
+from irse.indexing.inverted import InvertedIndex
+from irse.indexing.spimi import SPIMI
+from irse.retrieval.scoring import BM25
+from irse.retrieval.caching import Cache, LRUCache
+from irse.retrieval.topk import TermAtATimeMaxScore
 
 
 SimpleNormaliser = MapperSequence([
@@ -19,9 +27,24 @@ SimpleNormaliser = MapperSequence([
 ])
 
 
-class OkapiRetrieval:
+class OkapiPreprocessor:
+    """
+    Turns a document or query into the terms that are indexed: normalisation, pretokenisation, stopword removal and
+    lemmatisation.
+
+    Token frequencies are Zipfian, so the same few tokens make up most of any text. Hence, what becomes of a token (its
+    lemma, or None if it is a stopword) is cached, so that WordNet is only consulted once per distinct token rather than
+    once per occurrence. The cache can be saved and loaded, e.g. along with an index, so that a warm start doesn't need
+    WordNet at all for tokens it has seen before.
+
+    Can be sent to other processes: they get a copy of the cache and a fresh copy of the tools rather than a pickled one.
+    """
 
-    def __init__(self, corpus: Iterable[str]):
+    def __init__(self, cache_size: int=2**18):
+        self.cache = LRUCache(cache_size)
+        self._load()
+
+    def _load(self):
         self.pretokeniser = Preprocessor(
             uninvertible_mapping=SimpleNormaliser,
             splitter=TraditionalPretokeniser()
@@ -29,12 +52,130 @@ class OkapiRetrieval:
         self.lemmatizer = WordNetLemmatizer()
         self.stopwords  = set(stopwords.words("english"))
 
-        self.retriever = BM25Okapi([self._preprocess(document) for document in corpus])
+    def __getstate__(self):
+        return {"cache": self.cache}
+
+    def __setstate__(self, state):
+        self.cache = state["cache"]
+        self._load()
+
+    def __call__(self, doc: str) -> List[str]:
+        terms = []
+        for token in self.pretokeniser.do(doc):
+            term = self.cache.get(token, self._normalise)
+            if term is not None:
+                terms.append(term)
+        return terms
+
+    def _normalise(self, token: str) -> Optional[str]:
+        return None if token in self.stopwords else self.lemmatizer.lemmatize(token)
+
+    def saveCache(self, path: Path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(list(self.cache.items()), handle)
+
+    def loadCache(self, path: Path):
+        with open(path, "r", encoding="utf-8") as handle:
+            for token, term in json.load(handle):
+                self.cache.put(token, term)
+
+
+class OkapiRetrieval:
+
+    def __init__(self, corpus: Iterable[str]=None, code: Code=None, index: InvertedIndex=None,
+                 save_to: Path=None, memory_budget: int=256*2**20, processes: int=1, cache_size: int=2**18,
+                 result_cache: Cache=None):
+        """
+        :param corpus: the documents to index. They are streamed, so this can be a generator. Not needed when an
+                       existing index is given.
+        :param code: the code used to compress the posting lists of the inverted index. VByte by default.
+        :param index: an index that was built earlier, e.g. loaded from disk with InvertedIndex.load().
+        :param save_to: if given, the index is built on disk at this path, in bounded memory (see SPIMI), rather than in memory.
+        :param memory_budget: roughly how many bytes of postings are kept in memory at once when building on disk
+                              (per process, when using multiple processes).
+        :param processes: amount of processes that preprocess and invert the corpus when building on disk. The index is
+                          the same for any amount of processes. (Each process has its own preprocessing cache, so with
+                          more than one, the cache that is saved with the index doesn't have the corpus's tokens in it.)
+        :param cache_size: maximal amount of tokens for which the result of preprocessing is cached. The cache is shared
+                           by indexing and querying; see .preprocessor.cache for hit rate statistics.
+        :param result_cache: cache for the results of filter(). Queries are looked up by their terms after
+                             preprocessing, in sorted order, so that queries that only differ in case, punctuation,
+                             stopwords, inflection or word order share an entry. By default, an LRU cache of at most
+                             4096 results and (roughly) 64 MiB. It is emptied whenever the index is replaced.
+        """
+        self.results = result_cache if result_cache is not None else LRUCache(max_size=2**12, max_bytes=64*2**20, sizeof=_resultSize)
+        self.preprocessor = OkapiPreprocessor(cache_size)
+
+        if index is None:
+            if save_to is not None:
+                index = SPIMI(memory_budget, code=code).build(corpus, save_to, preprocess=self.preprocessor, processes=processes)
+                self.preprocessor.saveCache(OkapiRetrieval._cachePath(save_to))
+            elif processes > 1:
+                raise ValueError("Building with multiple processes is only supported when building on disk.")
+            else:
+                index = InvertedIndex.fromDocuments(map(self.preprocessor, corpus), code=code)
+        self.index = index
+
+    @property
+    def index(self) -> InvertedIndex:
+        return self._index
+
+    @index.setter
+    def index(self, index: InvertedIndex):
+        self._index    = index
+        self.retriever = BM25(index)
+        self.top_k     = TermAtATimeMaxScore(self.retriever)
+        self.results.clear()  # Results of the old index are meaningless for the new one.
+
+    def save(self, path: Path):
+        """Saves the index, and next to it, the preprocessing cache."""
+        self.index.save(path)
+        self.preprocessor.saveCache(OkapiRetrieval._cachePath(path))
+
+    @classmethod
+    def load(cls, path: Path) -> "OkapiRetrieval":
+        """Opens an index saved earlier, without touching the corpus (or even reading the posting lists)."""
+        retrieval = cls(index=InvertedIndex.load(path))
+        if OkapiRetrieval._cachePath(path).exists():
+            retrieval.preprocessor.loadCache(OkapiRetrieval._cachePath(path))
+        return retrieval
+
+    @staticmethod
+    def _cachePath(index_path: Path) -> Path:
+        index_path = Path(index_path)
+        return index_path.with_name(index_path.name + ".terms.json")
 
     def _preprocess(self, doc: str) -> List[str]:
-        return [self.lemmatizer.lemmatize(t) for t in self.pretokeniser.do(doc) if t not in self.stopwords]
+        return self.preprocessor(doc)
+
+    def _cacheKey(self, query: str, truncate_at: Optional[int]) -> Tuple[Tuple[str, ...], Optional[int]]:
+        return tuple(sorted(self._preprocess(query))), truncate_at
+
+    def _rank(self, key: Tuple[Tuple[str, ...], Optional[int]]) -> List[Tuple[int, float]]:
+        terms, truncate_at = key
+        if truncate_at is None:
+            return self.retriever.rank(list(terms))
+        # When only the top results are asked for, documents that can't make it are pruned rather than scored and
+        # sorted. The results are the same either way.
+        return self.top_k.rank(list(terms), truncate_at)
 
     def filter(self, query: str, truncate_at: int=None) -> List[Tuple[int, float]]:
-        scores = self.retriever.get_scores(self._preprocess(query))
-        ranking = sorted(filter(lambda x: x[1] > 0, enumerate(scores)), key=lambda x: x[1], reverse=True)
-        return ranking[:truncate_at]
+        """
+        Results are cached; see .results for hit rate statistics. Every call gets its own copy of the result list.
+        """
+        return list(self.results.get(self._cacheKey(query, truncate_at), self._rank))
+
+    def filterMany(self, queries: Iterable[str], truncate_at: int=None) -> List[List[Tuple[int, float]]]:
+        """
+        The results of filter() for every query, but the queries that aren't cached are computed all together, which
+        is much faster when there are many of them (e.g. for evaluation).
+        """
+        keys = [self._cacheKey(query, truncate_at) for query in queries]
+        missing = [key for key in dict.fromkeys(keys) if key not in self.results]
+        computed = dict(zip(missing, self.retriever.rankMany([list(terms) for terms, _ in missing], truncate_at)))
+        return [list(self.results.get(key, lambda key: computed[key] if key in computed else self._rank(key))) for key in keys]
+
+
+def _resultSize(result: List[Tuple[int, float]]) -> int:
+    """Rough amount of bytes taken up by a list of (int, float) tuples."""
+    return 64 + 100*len(result)
@@ -0,0 +1,203 @@
+"""
+Bounded caches with hit/miss counters.
+
+A cache is bounded by the amount of entries in it and, optionally, by an estimate of the amount of bytes they take up.
+What gets evicted when a new entry doesn't fit depends on the cache:
+    - LRUCache evicts the entry that was used least recently. Good when what is popular changes over time.
+    - LFUCache evicts the entry that was used least often (and among those, least recently). Good when a fixed set of
+      entries is popular, like the head of a Zipfian distribution of queries, which then can't be flushed out by a burst
+      of entries that are only used once.
+"""
+from typing import Callable, Hashable, Any, Iterator, Tuple, Dict
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+
+
+class Cache(ABC):
+
+    def __init__(self, max_size: int, max_bytes: int=None, sizeof: Callable[[Any], int]=None):
+        """
+        :param max_size: maximal amount of entries.
+        :param max_bytes: maximal sum of the sizes of the values, if given. A value bigger than this is never cached.
+        :param sizeof: estimates the size of a value in bytes. Only needed with max_bytes.
+        """
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("A cache bounded in bytes needs a way to estimate the size of its values.")
+        self.max_size  = max_size
+        self.max_bytes = max_bytes
+        self.sizeof    = sizeof
+        self.n_bytes = 0
+        self.hits    = 0
+        self.misses  = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def resetStatistics(self):
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, compute: Callable[[Hashable], Any]) -> Any:
+        """
+        Returns the cached value for the given key, or computes it, caches it and returns it.
+        """
+        try:
+            value = self._use(key)
+        except KeyError:
+            self.misses += 1
+            value = compute(key)
+            self.put(key, value)
+            return value
+
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if key in self:
+            self._remove(key)
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        # Room is made before inserting, so that the new entry can't be the one that goes. An LFU cache would otherwise
+        # always evict the newcomer (it has been used least), and once full, no new key could ever stay in it.
+        while len(self) > 0 and (len(self) >= self.max_size or (self.max_bytes is not None and self.n_bytes + size > self.max_bytes)):
+            self.n_bytes -= self._evict()
+        self._insert(key, value, size)
+        self.n_bytes += size
+
+    def clear(self):
+        for key, _ in list(self.items()):
+            self._remove(key)
+        self.n_bytes = 0
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def __contains__(self, key: Hashable):
+        pass
+
+    @abstractmethod
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:
+        """In such an order that putting them into an empty cache of the same kind restores the same eviction order."""
+        pass
+
+    @abstractmethod
+    def _use(self, key: Hashable) -> Any:
+        """Returns the value of the given key and records that it was used. Raises a KeyError if it isn't cached."""
+        pass
+
+    @abstractmethod
+    def _insert(self, key: Hashable, value: Any, size: int):
+        """Adds an entry that isn't in the cache yet."""
+        pass
+
+    @abstractmethod
+    def _remove(self, key: Hashable):
+        """Removes the given entry and subtracts its size."""
+        pass
+
+    @abstractmethod
+    def _evict(self) -> int:
+        """Removes the entry that should go first, and returns its size."""
+        pass
+
+
+class LRUCache(Cache):
+    """
+    Keeps at most max_size entries. When a new entry doesn't fit, the least recently used one is evicted.
+    """
+
+    def __init__(self, max_size: int, max_bytes: int=None, sizeof: Callable[[Any], int]=None):
+        super().__init__(max_size, max_bytes, sizeof)
+        self.entries = OrderedDict()  # From least to most recently used. Values are (value, size).
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self.entries
+
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:
+        """From least to most recently used."""
+        return ((key, value) for key, (value, _) in self.entries.items())
+
+    def _use(self, key: Hashable) -> Any:
+        value, _ = self.entries[key]
+        self.entries.move_to_end(key)
+        return value
+
+    def _insert(self, key: Hashable, value: Any, size: int):
+        self.entries[key] = (value, size)
+
+    def _remove(self, key: Hashable):
+        _, size = self.entries.pop(key)
+        self.n_bytes -= size
+
+    def _evict(self) -> int:
+        _, (_, size) = self.entries.popitem(last=False)
+        return size
+
+
+class LFUCache(Cache):
+    """
+    Keeps at most max_size entries. When a new entry doesn't fit, the least frequently used one is evicted, and among
+    equally frequently used ones, the least recently used one. Entries are grouped by their use count, so that finding
+    that entry doesn't require looking at all of them.
+    """
+
+    def __init__(self, max_size: int, max_bytes: int=None, sizeof: Callable[[Any], int]=None):
+        super().__init__(max_size, max_bytes, sizeof)
+        self.entries: Dict[Hashable, Tuple[Any, int, int]] = dict()  # key -> (value, size, use count)
+        self.by_count: Dict[int, OrderedDict] = defaultdict(OrderedDict)  # use count -> keys, from least to most recently used
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self.entries
+
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:
+        """From least to most frequently used. (Putting them back loses the use counts, but not their order.)"""
+        for count in sorted(self.by_count):
+            for key in self.by_count[count]:
+                yield key, self.entries[key][0]
+
+    def _use(self, key: Hashable) -> Any:
+        value, size, count = self.entries[key]
+        self._unlink(key, count)
+        self.entries[key] = (value, size, count + 1)
+        self.by_count[count + 1][key] = None
+        return value
+
+    def _insert(self, key: Hashable, value: Any, size: int):
+        self.entries[key] = (value, size, 1)
+        self.by_count[1][key] = None
+        self.min_count = 1
+
+    def _remove(self, key: Hashable):
+        _, size, count = self.entries.pop(key)
+        self._unlink(key, count)
+        self.n_bytes -= size
+
+    def _evict(self) -> int:
+        if self.min_count not in self.by_count:  # Entries were removed since the last use.
+            self.min_count = min(self.by_count)
+        key, _ = self.by_count[self.min_count].popitem(last=False)
+        if not self.by_count[self.min_count]:
+            del self.by_count[self.min_count]
+        _, size, _ = self.entries.pop(key)
+        return size
+
+    def _unlink(self, key: Hashable, count: int):
+        keys = self.by_count[count]
+        del keys[key]
+        if not keys:
+            del self.by_count[count]
+            if self.min_count == count:
+                self.min_count = count + 1
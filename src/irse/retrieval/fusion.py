@@ -0,0 +1,163 @@
+"""
+Ranking by a mix of a query-dependent score (BM25) and a query-independent, "static" score (e.g. PageRank):
+    score(d, q) = bm25_weight * BM25(d, q) + static_weight * static(d)
+for the documents that contain at least one query term.
+
+Rather than filtering the top documents by BM25 and then re-sorting those by static score (which makes the result
+depend on how many documents were filtered), both scores are combined during retrieval. To do that without scoring
+every matching document, the index is renumbered such that documents are in order of decreasing static score. Then,
+documents are scored in chunks of consecutive IDs (of growing size), and every chunk has a lower static score than the
+ones before it. BM25 can't exceed the sum of the upper bounds of the query terms, so as soon as even that, plus the
+static score of the next chunk, can't beat the k'th best combined score so far, no document after it can, and
+retrieval stops. Only the fronts of the posting lists have been decoded by then.
+"""
+from typing import List, Tuple, Dict
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from irse.indexing.inverted import InvertedIndex
+from irse.retrieval.scoring import BM25
+from irse.retrieval.topk import SLACK
+
+
+class _FrontCursor:
+    """
+    Hands out the postings of one term (with their contributions to BM25) in consecutive ranges of document IDs,
+    decoding blocks only when a range reaches them.
+    """
+
+    def __init__(self, bm25: BM25, term: str):
+        self.bm25 = bm25
+        self.idf  = bm25.idf(term)
+        blocks = bm25.index.blockRange(term)
+        self.first_block = blocks.start
+        self.block_lasts = bm25.index.block_last_documents[blocks.start:blocks.stop].tolist()
+        self.next_block  = 0
+
+        self.documents = np.zeros(0, dtype=np.int64)
+        self.scores    = np.zeros(0)
+
+    def upTo(self, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The postings with document ID below the given one, that weren't handed out yet."""
+        documents, scores = [self.documents], [self.scores]
+        while self.next_block < len(self.block_lasts) and (len(documents[-1]) == 0 or documents[-1][-1] < end):
+            previous = -1 if self.next_block == 0 else self.block_lasts[self.next_block-1]
+            d, f = self.bm25.index.decodeBlock(self.first_block + self.next_block, previous)
+            documents.append(d)
+            scores.append(self.bm25.contributions(self.idf, d, f))
+            self.next_block += 1
+
+        documents, scores = np.concatenate(documents), np.concatenate(scores)
+        split = int(np.searchsorted(documents, end))
+        self.documents, self.scores = documents[split:], scores[split:]
+        return documents[:split], scores[:split]
+
+
+class FusedRanking:
+
+    def __init__(self, index: InvertedIndex, static_scores: np.ndarray, bm25_weight: float=1.0, static_weight: float=1.0,
+                 chunk_size: int=1024, save_to: Path=None):
+        """
+        :param index: index whose document IDs match the positions in the static scores.
+        :param static_scores: for every document, a query-independent score that isn't negative. For PageRank, which
+                              sums to 1, multiplying by the amount of documents puts it on a scale that doesn't depend
+                              on the size of the collection.
+        :param chunk_size: amount of documents (in order of static score) that are scored before the first check of
+                           whether retrieval can stop. Every next chunk is twice as big as the one before it, so that
+                           a query that can't stop early doesn't need many chunks either.
+        :param save_to: if given, the renumbered index is written there, and the static scores next to it (see save()).
+        """
+        static_scores = np.asarray(static_scores, dtype=np.float64)
+        if len(static_scores) != index.n_documents:
+            raise ValueError(f"Expected {index.n_documents} static scores, but got {len(static_scores)}.")
+        if np.any(static_scores < 0):
+            raise ValueError("Static scores can't be negative.")
+
+        original_ids = np.argsort(-static_scores, kind="stable")  # new ID -> old ID
+        new_ids = np.empty_like(original_ids)
+        new_ids[original_ids] = np.arange(len(original_ids))
+        self._setUp(index.renumbered(new_ids, path=save_to), static_scores[original_ids], original_ids,
+                    bm25_weight, static_weight, chunk_size)
+        if save_to is not None:
+            self._saveStaticScores(save_to)
+
+    def _setUp(self, index: InvertedIndex, static_scores: np.ndarray, original_ids: np.ndarray,
+               bm25_weight: float, static_weight: float, chunk_size: int):
+        if bm25_weight < 0 or static_weight < 0:
+            raise ValueError("Weights can't be negative.")
+        self.index = index
+        self.bm25  = BM25(index)
+        self.static_scores = static_scores  # In the order of the renumbered index, so from high to low.
+        self.original_ids  = original_ids
+        self.bm25_weight   = bm25_weight
+        self.static_weight = static_weight
+        self.chunk_size    = chunk_size
+
+    def save(self, path: Path):
+        """Saves the renumbered index, and next to it, the static scores and the original document IDs."""
+        self.index.save(path)
+        self._saveStaticScores(path)
+
+    def _saveStaticScores(self, path: Path):
+        with open(FusedRanking._staticPath(path), "wb") as handle:
+            np.savez(handle, static_scores=self.static_scores, original_ids=self.original_ids)
+
+    @classmethod
+    def load(cls, path: Path, bm25_weight: float=1.0, static_weight: float=1.0, chunk_size: int=1024) -> "FusedRanking":
+        with np.load(FusedRanking._staticPath(path)) as arrays:
+            static_scores, original_ids = arrays["static_scores"], arrays["original_ids"]
+        ranking = cls.__new__(cls)
+        ranking._setUp(InvertedIndex.load(path), static_scores, original_ids, bm25_weight, static_weight, chunk_size)
+        return ranking
+
+    @staticmethod
+    def _staticPath(index_path: Path) -> Path:
+        index_path = Path(index_path)
+        return index_path.with_name(index_path.name + ".static.npz")
+
+    def rank(self, query: List[str], truncate_at: int) -> List[Tuple[int, float]]:
+        """
+        The documents that contain a query term, from highest to lowest combined score, with their original IDs.
+        Ties are ordered by original ID.
+        """
+        if truncate_at <= 0:
+            return []
+
+        cursors: Dict[str, _FrontCursor] = {term: _FrontCursor(self.bm25, term) for term in set(query)}
+        bm25_bound = sum(multiplicity * float(self.bm25.blockUpperBounds(term).max(initial=0.0))
+                         for term, multiplicity in Counter(query).items())
+
+        top_ids    = np.zeros(0, dtype=np.int64)  # Original IDs.
+        top_scores = np.zeros(0)
+        start, chunk_size = 0, self.chunk_size
+        while start < self.index.n_documents:
+            if len(top_ids) == truncate_at:
+                bound = self.bm25_weight * bm25_bound + self.static_weight * self.static_scores[start]
+                if bound * SLACK < top_scores[-1]:
+                    break
+
+            end = min(start + chunk_size, self.index.n_documents)
+            bm25 = np.zeros(end - start)
+            matched = np.zeros(end - start, dtype=bool)
+            chunk = {term: cursor.upTo(end) for term, cursor in cursors.items()}
+            for term in query:  # In query order, so that BM25 is summed exactly like BM25.scores() does.
+                documents, contributions = chunk[term]
+                bm25[documents - start] += contributions
+                matched[documents - start] = True
+
+            documents = np.flatnonzero(matched) + start
+            scores = self.bm25_weight * bm25[documents - start] + self.static_weight * self.static_scores[documents]
+            top_ids    = np.concatenate((top_ids,    self.original_ids[documents]))
+            top_scores = np.concatenate((top_scores, scores))
+            if len(top_ids) > truncate_at:
+                high = np.argpartition(-top_scores, truncate_at-1)[:truncate_at]
+                kth = top_scores[high].min()
+                high = np.flatnonzero(top_scores >= kth)  # Documents that tie with the k'th are kept, so that the lowest IDs can win.
+                top_ids, top_scores = top_ids[high], top_scores[high]
+            order = np.lexsort((top_ids, -top_scores))[:truncate_at]
+            top_ids, top_scores = top_ids[order], top_scores[order]
+            start, chunk_size = end, 2*chunk_size
+
+        return list(zip(top_ids.tolist(), top_scores.tolist()))
@@ -0,0 +1,172 @@
+"""
+Ranking functions that score documents by reading only the posting lists of the query terms from an inverted index,
+so that the cost of a query grows with the length of those posting lists rather than with the size of the corpus.
+"""
+from typing import List, Tuple, Dict
+
+import math
+import numpy as np
+
+from irse.indexing.inverted import InvertedIndex
+
+
+class BM25:
+    """
+    Okapi BM25, with the same formula and defaults as rank_bm25.BM25Okapi:
+      - idf(t) = log(N - df(t) + 0.5) - log(df(t) + 0.5), where terms that appear in more than half the documents (and
+        would hence get a negative idf) get epsilon times the average idf over the vocabulary instead;
+      - score(d, q) = sum over the terms t of q (with repetition) of idf(t) * tf(t,d) * (k1+1) / (tf(t,d) + k1 * (1 - b + b * |d|/avg|d|)).
+    """
+
+    def __init__(self, index: InvertedIndex, k1: float=1.5, b: float=0.75, epsilon: float=0.25):
+        self.index = index
+        self.k1 = k1
+        self.b  = b
+        self.epsilon = epsilon
+
+        # The part of the denominator that only depends on the document.
+        self.length_normalisation = k1 * (1 - b + b * index.document_lengths / index.average_document_length) if index.n_documents else np.zeros(0)
+        self._average_idf = None
+
+    @property
+    def average_idf(self) -> float:
+        """
+        Only needed for terms with a negative idf, so it is only computed (over the whole vocabulary) when one comes up.
+        math.log rather than np.log, because the latter can differ from it in the last bit, and math.fsum because its
+        result doesn't depend on the order of the vocabulary (which rank_bm25 sums in order of first appearance).
+        """
+        if self._average_idf is None:
+            N = self.index.n_documents
+            idfs = [math.log(N - df + 0.5) - math.log(df + 0.5) for df in self.index.document_frequencies.tolist()]
+            self._average_idf = math.fsum(idfs) / len(idfs) if idfs else 0.0
+        return self._average_idf
+
+    def idf(self, term: str) -> float:
+        term_id = self.index.termId(term)
+        if term_id is None:
+            return 0.0
+
+        N  = self.index.n_documents
+        df = int(self.index.document_frequencies[term_id])
+        idf = math.log(N - df + 0.5) - math.log(df + 0.5)
+        return idf if idf >= 0 else self.epsilon * self.average_idf
+
+    def contributions(self, idf: float, documents: np.ndarray, frequencies: np.ndarray) -> np.ndarray:
+        """How much a term with the given idf contributes to the scores of the given documents, given its frequencies in them."""
+        return idf * (frequencies * (self.k1 + 1) / (frequencies + self.length_normalisation[documents]))
+
+    def termScores(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The documents containing the given term, and how much the term contributes to the score of each.
+        """
+        documents, frequencies = self.index.postings(term)
+        return documents, self.contributions(self.idf(term), documents, frequencies)
+
+    def blockUpperBounds(self, term: str) -> np.ndarray:
+        """
+        For every block in the posting list of the given term, a number that its contribution to the score of any
+        document in that block can't exceed. The contribution grows with term frequency and shrinks with document length,
+        so the highest term frequency and the shortest document length in the block give such a bound.
+        """
+        blocks = self.index.blockRange(term)
+        frequencies = self.index.block_max_frequencies[blocks.start:blocks.stop]
+        lengths     = self.index.block_min_lengths[blocks.start:blocks.stop]
+        bounds = self.idf(term) * (frequencies * (self.k1 + 1) / (frequencies + self.k1 * (1 - self.b + self.b * lengths / self.index.average_document_length)))
+        return np.maximum(bounds, 0.0)  # Terms with negative idf can only lower a score.
+
+    def scores(self, query: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Term-at-a-time scoring: every query term adds its contributions to an accumulator that only has room for the
+        documents that contain at least one query term.
+        Returns these documents (sorted by ID) and their scores. All other documents have score 0.
+        """
+        contributions = dict()
+        for term in set(query):
+            contributions[term] = self.termScores(term)
+
+        candidates = np.unique(np.concatenate([documents for documents, _ in contributions.values()])) if contributions else np.zeros(0, dtype=np.int64)
+        scores = np.zeros(len(candidates))
+        for term in query:  # In query order, so that the scores are summed in the same order as an exhaustive scorer would.
+            documents, term_scores = contributions[term]
+            scores[np.searchsorted(candidates, documents)] += term_scores
+        return candidates, scores
+
+    def rank(self, query: List[str], truncate_at: int=None) -> List[Tuple[int, float]]:
+        """
+        The documents with a positive score, from highest to lowest score. Ties are ordered by document ID.
+        """
+        documents, scores = self.scores(query)
+        positive = scores > 0
+        documents, scores = documents[positive], scores[positive]
+
+        order = np.lexsort((documents, -scores))[:truncate_at]
+        return list(zip(documents[order].tolist(), scores[order].tolist()))
+
+    def rankMany(self, queries: List[List[str]], truncate_at: int=None, batch_size: int=256) -> List[List[Tuple[int, float]]]:
+        """
+        Same as calling rank() for every query, but the posting list of a term is only decoded once for all queries,
+        and the queries are scored together, a batch at a time, with NumPy:
+          - the postings of every term of every query (in query order) are concatenated, each posting labelled with
+            the pair (query, document) that it contributes to;
+          - np.bincount() adds the contributions up per pair. It does so in the order of the postings, so every score is
+            summed in the same order as rank() sums it;
+          - the top of every query is found with np.partition() rather than by sorting all its documents.
+
+        Memory: the scores of a term (two arrays as long as its posting list) are kept from the first batch that uses
+        the term until the last one, and dropped after that. So what is held at any time is the terms of the current
+        batch plus those shared between earlier and later batches, rather than every term of every query.
+        """
+        N = self.index.n_documents
+        last_batch: Dict[str, int] = dict()  # The index of the last batch that each term appears in.
+        for b, start in enumerate(range(0, len(queries), batch_size)):
+            for query in queries[start:start+batch_size]:
+                for term in query:
+                    last_batch[term] = b
+
+        term_scores: Dict[str, Tuple[np.ndarray, np.ndarray]] = dict()
+        results = []
+        for b, start in enumerate(range(0, len(queries), batch_size)):
+            batch = queries[start:start+batch_size]
+            batch_terms = {term for query in batch for term in query}
+            for term in batch_terms:
+                if term not in term_scores:
+                    term_scores[term] = self.termScores(term)
+
+            # One (query, document) key and one contribution for every posting of every query term.
+            keys          = [np.zeros(0, dtype=np.int64)]
+            contributions = [np.zeros(0)]
+            for q, query in enumerate(batch):
+                for term in query:
+                    documents, scores = term_scores[term]
+                    keys.append(q*N + documents)
+                    contributions.append(scores)
+            keys, pairs = np.unique(np.concatenate(keys), return_inverse=True)
+            scores = np.bincount(pairs.reshape(-1), weights=np.concatenate(contributions), minlength=len(keys))
+
+            positive = scores > 0
+            keys, scores = keys[positive], scores[positive]
+            queries_of_keys, documents = np.divmod(keys, max(N, 1))
+            bounds = np.searchsorted(queries_of_keys, np.arange(len(batch)+1))  # Keys are sorted, so grouped by query.
+            for q in range(len(batch)):
+                results.append(self._top(documents[bounds[q]:bounds[q+1]], scores[bounds[q]:bounds[q+1]], truncate_at))
+
+            for term in batch_terms:
+                if last_batch[term] == b:
+                    del term_scores[term]
+        return results
+
+    @staticmethod
+    def _top(documents: np.ndarray, scores: np.ndarray, truncate_at: int=None) -> List[Tuple[int, float]]:
+        """
+        The truncate_at highest-scoring documents, ordered like rank() orders them. Only documents that score at least
+        as high as the truncate_at'th highest score (found with a partition) are sorted.
+        """
+        if truncate_at is not None and len(scores) > truncate_at:
+            if truncate_at <= 0:
+                return []
+            kth = np.partition(scores, len(scores) - truncate_at)[len(scores) - truncate_at]
+            high = scores >= kth  # Includes all documents that tie with the k'th, so that the lowest IDs can win.
+            documents, scores = documents[high], scores[high]
+
+        order = np.lexsort((documents, -scores))[:truncate_at]
+        return list(zip(documents[order].tolist(), scores[order].tolist()))
@@ -0,0 +1,398 @@
+"""
+Top-k retrieval with dynamic pruning: rather than scoring every document that contains a query term and then sorting
+all of them, documents are visited in order of ID (document-at-a-time), the k best so far are kept in a heap, and
+documents whose score provably can't beat the k'th best score (the threshold) are skipped without being scored, and
+often without their postings even being decoded.
+
+What makes this possible is an upper bound on how much each term can contribute to a score:
+    - MaxScore splits the query terms into "essential" terms and "non-essential" terms whose bounds together don't exceed
+      the threshold. Only documents that contain an essential term can make it into the top k, so only those are visited.
+    - WAND sorts the terms by the document their cursor is at, and adds up their bounds in that order until they exceed
+      the threshold. The document at which that happens (the pivot) is the first one that could make it into the top k,
+      so all cursors before it can jump straight to it.
+    - Block-Max WAND does the same, but then checks the much tighter bounds of the blocks that contain the pivot. If those
+      don't exceed the threshold either, the cursors can jump past the end of those blocks without decoding them.
+
+Visiting documents one by one is a loop in Python, though, whereas exhaustive scoring adds up whole posting lists with
+NumPy. TermAtATimeMaxScore therefore applies the MaxScore idea term-at-a-time: terms are processed from highest to
+lowest bound, and once the bounds of the terms that are left can't beat the threshold by themselves, those terms only
+decode the blocks that contain documents that were already seen.
+
+The document-at-a-time classes (MaxScore, WAND, BlockMaxWAND) are hence reference implementations, to show how these
+algorithms work and to check them against: in Python, they are slower than exhaustive scoring with BM25.rank(). For
+speed, use TermAtATimeMaxScore, or BM25.rankMany() for many queries at once. (In a compiled language, the
+document-at-a-time algorithms are what search engines actually use.)
+
+All four give exactly the same results as scoring exhaustively: the same documents, in the same order, with the same
+scores (every score is summed in the same order as BM25.scores() does).
+"""
+from typing import List, Tuple, Dict
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import Counter
+from heapq import heappush, heapreplace
+
+import sys
+import numpy as np
+
+from irse.retrieval.scoring import BM25
+
+END = sys.maxsize  # Document "ID" of a cursor that has run out of postings.
+
+# Bounds are added up in a different order than scores, which can make a sum of bounds come out a rounding error lower
+# than the score it bounds. A little slack on the bound makes sure that such documents aren't skipped.
+SLACK = 1 + 1e-9
+
+def _couldEnter(bound: float, threshold: float) -> bool:
+    return bound * SLACK > threshold
+
+
+class PostingCursor:
+    """
+    Walks over the posting list of one term. A block is only decoded when a document in it is asked for.
+    """
+
+    def __init__(self, bm25: BM25, term: str, multiplicity: int=1):
+        """
+        :param multiplicity: how often the term appears in the query, which multiplies its upper bounds.
+        """
+        self.bm25  = bm25
+        self.index = bm25.index
+        self.idf   = bm25.idf(term)
+        self.multiplicity = multiplicity
+
+        blocks = self.index.blockRange(term)
+        self.first_block  = blocks.start
+        self.block_lasts  = self.index.block_last_documents[blocks.start:blocks.stop].tolist()
+        self.block_bounds = (multiplicity * bm25.blockUpperBounds(term)).tolist()
+        self.upper_bound  = max(self.block_bounds, default=0.0)
+
+        self.block = -1
+        self.documents: List[int]   = []
+        self.scores:    List[float] = []
+        self.position = 0
+        self.document = END
+        if self.block_lasts:
+            self._load(0)
+
+    def _load(self, block: int):
+        previous = -1 if block == 0 else self.block_lasts[block-1]
+        documents, frequencies = self.index.decodeBlock(self.first_block + block, previous)
+        self.scores    = self.bm25.contributions(self.idf, documents, frequencies).tolist()
+        self.documents = documents.tolist()
+        self.block    = block
+        self.position = 0
+        self.document = self.documents[0]
+
+    def score(self) -> float:
+        """Contribution of the term to the score of the current document (counted once, regardless of multiplicity)."""
+        return self.scores[self.position]
+
+    def next(self):
+        self.position += 1
+        if self.position < len(self.documents):
+            self.document = self.documents[self.position]
+        elif self.block + 1 < len(self.block_lasts):
+            self._load(self.block + 1)
+        else:
+            self.document = END
+
+    def nextGEQ(self, target: int):
+        """Move to the first document with ID >= target. Blocks that end before the target are skipped undecoded."""
+        if target <= self.document:
+            return
+        if target > self.block_lasts[self.block]:
+            block = bisect_left(self.block_lasts, target, self.block + 1)
+            if block == len(self.block_lasts):
+                self.document = END
+                return
+            self._load(block)
+        self.position = bisect_left(self.documents, target, self.position)
+        self.document = self.documents[self.position]
+
+    def blockBound(self, target: int) -> Tuple[float, int]:
+        """
+        Without moving or decoding: the upper bound of the block where the target would be, and the last ID in that block.
+        """
+        if self.document == END:
+            return 0.0, END
+        block = self.block if target <= self.block_lasts[self.block] else bisect_left(self.block_lasts, target, self.block + 1)
+        if block == len(self.block_lasts):
+            return 0.0, END
+        return self.block_bounds[block], self.block_lasts[block]
+
+
+class TopK:
+    """
+    The k best documents seen so far, in a min-heap. Documents must be offered in order of ID: a document whose score
+    ties with the k'th best then never makes it in, because ties are broken in favour of the lower ID.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.heap = []  # (score, -ID), so that the root is the worst document in the top k.
+        self.threshold = 0.0  # Score that has to be exceeded to get in. Scores must be positive even when there's room.
+
+    def offer(self, document: int, score: float):
+        if score <= self.threshold:
+            return
+        if len(self.heap) < self.k:
+            heappush(self.heap, (score, -document))
+        else:
+            heapreplace(self.heap, (score, -document))
+        if len(self.heap) == self.k:
+            self.threshold = self.heap[0][0]
+
+    def results(self) -> List[Tuple[int, float]]:
+        return [(-negative_id, score) for score, negative_id in sorted(self.heap, key=lambda entry: (-entry[0], -entry[1]))]
+
+
+def _highest(documents: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+    """The (at most) k documents with the highest scores, in no particular order."""
+    if len(documents) <= k:
+        return documents
+    return documents[np.argpartition(-scores, k-1)[:k]]
+
+
+class TopKRetrieval(ABC):
+
+    def __init__(self, bm25: BM25):
+        self.bm25 = bm25
+
+    @abstractmethod
+    def rank(self, query: List[str], k: int) -> List[Tuple[int, float]]:
+        """
+        Same as BM25.rank(query, truncate_at=k).
+        """
+        pass
+
+
+class DocumentAtATime(TopKRetrieval):
+    """
+    Reference implementation: one Python iteration per visited document, which makes it slower than exhaustive
+    scoring. See the module docstring.
+    """
+
+    def rank(self, query: List[str], k: int) -> List[Tuple[int, float]]:
+        if k <= 0:
+            return []
+
+        cursors = {term: PostingCursor(self.bm25, term, multiplicity) for term, multiplicity in Counter(query).items()}
+        in_query_order = [cursors[term] for term in query]
+        top = TopK(k)
+        self._search([cursor for cursor in cursors.values() if cursor.document != END], in_query_order, top)
+        return top.results()
+
+    @staticmethod
+    def _score(document: int, in_query_order: List[PostingCursor]) -> float:
+        score = 0.0
+        for cursor in in_query_order:
+            if cursor.document == document:
+                score += cursor.score()
+        return score
+
+    @abstractmethod
+    def _search(self, cursors: List[PostingCursor], in_query_order: List[PostingCursor], top: TopK):
+        """
+        Offers documents to the heap in order of ID, using the cursors in whatever order they like to find them.
+        """
+        pass
+
+
+class MaxScore(DocumentAtATime):
+
+    def _search(self, cursors: List[PostingCursor], in_query_order: List[PostingCursor], top: TopK):
+        cursors = sorted(cursors, key=lambda cursor: cursor.upper_bound)
+        cumulative_bounds = []  # cumulative_bounds[i] is the sum of the bounds of cursors 0...i.
+        total = 0.0
+        for cursor in cursors:
+            total += cursor.upper_bound
+            cumulative_bounds.append(total)
+
+        essential = 0  # Index of the first essential cursor.
+        while True:
+            while essential < len(cursors) and not _couldEnter(cumulative_bounds[essential], top.threshold):
+                essential += 1
+            if essential == len(cursors):
+                break
+
+            candidate = min(cursor.document for cursor in cursors[essential:])
+            if candidate == END:
+                break
+
+            # Upper bound on the candidate's score: actual contributions of the essential terms, and the bounds of the
+            # non-essential terms. Those bounds are replaced by actual contributions as long as the bound stays high enough.
+            partial = 0.0
+            for cursor in cursors[essential:]:
+                if cursor.document == candidate:
+                    partial += cursor.multiplicity * cursor.score()
+
+            survived = True
+            for i in range(essential-1, -1, -1):
+                if not _couldEnter(partial + cumulative_bounds[i], top.threshold):
+                    survived = False
+                    break
+                cursors[i].nextGEQ(candidate)
+                if cursors[i].document == candidate:
+                    partial += cursors[i].multiplicity * cursors[i].score()
+
+            if survived and _couldEnter(partial, top.threshold):
+                top.offer(candidate, self._score(candidate, in_query_order))
+
+            for cursor in cursors[essential:]:
+                if cursor.document == candidate:
+                    cursor.next()
+
+
+class WAND(DocumentAtATime):
+
+    def _search(self, cursors: List[PostingCursor], in_query_order: List[PostingCursor], top: TopK):
+        while True:
+            cursors.sort(key=lambda cursor: cursor.document)
+
+            # Find the pivot: the first cursor at which the bounds of it and all cursors before it could beat the threshold.
+            bound = 0.0
+            pivot = -1
+            for i, cursor in enumerate(cursors):
+                if cursor.document == END:
+                    break
+                bound += cursor.upper_bound
+                if _couldEnter(bound, top.threshold):
+                    pivot = i
+                    break
+            if pivot < 0:
+                break
+
+            pivot_document = cursors[pivot].document
+            while pivot + 1 < len(cursors) and cursors[pivot+1].document == pivot_document:
+                pivot += 1
+
+            if not self._checkBlocks(cursors, pivot, pivot_document, top.threshold):
+                continue
+
+            if cursors[0].document == pivot_document:  # Then all cursors up to the pivot are at the pivot document.
+                top.offer(pivot_document, self._score(pivot_document, in_query_order))
+                for cursor in cursors[:pivot+1]:
+                    cursor.next()
+            else:  # No document before the pivot document can beat the threshold.
+                for cursor in cursors[:pivot]:
+                    cursor.nextGEQ(pivot_document)
+
+    def _checkBlocks(self, cursors: List[PostingCursor], pivot: int, pivot_document: int, threshold: float) -> bool:
+        """
+        Hook for Block-Max WAND. Returns whether the pivot document should be processed. If not, the cursors should be
+        moved past it.
+        """
+        return True
+
+
+class BlockMaxWAND(WAND):
+
+    def _checkBlocks(self, cursors: List[PostingCursor], pivot: int, pivot_document: int, threshold: float) -> bool:
+        bound = 0.0
+        next_candidate = cursors[pivot+1].document if pivot + 1 < len(cursors) else END
+        for cursor in cursors[:pivot+1]:
+            block_bound, block_last = cursor.blockBound(pivot_document)
+            bound += block_bound
+            next_candidate = min(next_candidate, block_last + 1)
+
+        if _couldEnter(bound, threshold):
+            return True
+
+        # Until the first of these blocks ends, only the cursors up to the pivot can have documents, and these can't
+        # beat the threshold. So all of them can skip to the end of that block (or to where the next cursor is).
+        for cursor in cursors[:pivot+1]:
+            cursor.nextGEQ(next_candidate)
+        return False
+
+
+class TermAtATimeMaxScore(TopKRetrieval):
+    """
+    Accumulates partial scores of all documents in an array as long as documents that haven't been seen yet can still
+    make it, like exhaustive scoring does. These partial scores are lower bounds on the actual scores, so the k'th highest
+    of them is a lower bound on the threshold. Once the bounds of the terms that are left don't reach it, only the
+    documents that do reach it are kept as candidates, and the remaining terms only decode the blocks those are in.
+    Candidates whose partial score plus the bounds of the terms that are left no longer reach the threshold are dropped.
+    In the end, only the candidates are scored exactly, in query order.
+    """
+
+    def rank(self, query: List[str], k: int) -> List[Tuple[int, float]]:
+        if k <= 0:
+            return []
+
+        multiplicities = Counter(query)
+        idfs = {term: self.bm25.idf(term) for term in multiplicities}
+        if any(idf < 0 for idf in idfs.values()):  # Then partial scores aren't lower bounds.
+            return self.bm25.rank(query, truncate_at=k)
+
+        bounds = {term: multiplicity * float(self.bm25.blockUpperBounds(term).max(initial=0.0)) for term, multiplicity in multiplicities.items()}
+        order = sorted(multiplicities, key=lambda term: bounds[term], reverse=True)
+        remaining = [0.0]  # remaining[i] is the sum of the bounds of the terms from order[i] on.
+        for term in reversed(order):
+            remaining.insert(0, remaining[0] + bounds[term])
+
+        partial = np.zeros(self.bm25.index.n_documents)
+        best = np.zeros(0, dtype=np.int64)  # The (at most) k documents with the highest partial scores, when there are no candidates yet.
+        candidates = None
+        threshold = 0.0
+        term_scores: Dict[str, Tuple[np.ndarray, np.ndarray]] = dict()
+        for i, term in enumerate(order):
+            if candidates is None and not _couldEnter(remaining[i], threshold):
+                candidates = np.flatnonzero((partial + remaining[i]) * SLACK > threshold)
+
+            if candidates is None:
+                documents, scores = self.bm25.termScores(term)
+            else:
+                documents, scores = self._candidateScores(term, idfs[term], candidates)
+            partial[documents] += multiplicities[term] * scores
+            term_scores[term] = (documents, scores)
+
+            if candidates is None:
+                best = np.union1d(best, _highest(documents, partial[documents], k))
+                best = _highest(best, partial[best], k)
+                if len(best) == k:
+                    threshold = max(threshold, float(partial[best].min()) / SLACK)
+            else:
+                if len(candidates) >= k:
+                    threshold = max(threshold, float(np.partition(partial[candidates], -k)[-k]) / SLACK)
+                candidates = candidates[(partial[candidates] + remaining[i+1]) * SLACK > threshold]
+
+        if candidates is None:
+            candidates = np.flatnonzero(partial > 0)
+
+        # Exact scores, summed in the same order as BM25.scores() does.
+        scores = np.zeros(len(partial))
+        for term in query:
+            documents, contributions = term_scores[term]
+            scores[documents] += contributions
+        scores = scores[candidates]
+
+        positive = scores > 0
+        candidates, scores = candidates[positive], scores[positive]
+        ranking = np.lexsort((candidates, -scores))[:k]
+        return list(zip(candidates[ranking].tolist(), scores[ranking].tolist()))
+
+    def _candidateScores(self, term: str, idf: float, candidates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The contributions of the given term to those candidates that contain it. Only the blocks of the term's posting
+        list in which candidates would be are decoded.
+        """
+        index = self.bm25.index
+        blocks = index.blockRange(term)
+        block_lasts = index.block_last_documents[blocks.start:blocks.stop]
+        needed = np.unique(np.searchsorted(block_lasts, candidates))
+        needed = needed[needed < len(block_lasts)].tolist()
+        if not needed:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        documents, frequencies = [], []
+        for block in needed:
+            d, f = index.decodeBlock(blocks.start + block, -1 if block == 0 else int(block_lasts[block-1]))
+            documents.append(d)
+            frequencies.append(f)
+        documents, frequencies = np.concatenate(documents), np.concatenate(frequencies)
+
+        positions = np.minimum(np.searchsorted(candidates, documents), len(candidates) - 1)
+        found = candidates[positions] == documents
+        documents, frequencies = documents[found], frequencies[found]
+        return documents, self.bm25.contributions(idf, documents, frequencies)
@@ -1,16 +1,45 @@
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple, Iterable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
 from irse.general import PATH_DATA_OUT
 
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import bs4
 import lxml
 import time
 from urllib.parse import urlparse
 
 
+class TokenBucket:
+    """
+    Rate limit: a bucket holds at most `burst` tokens and gains `rate` tokens per second. A request takes a token, so
+    on average, at most `rate` requests are made per second, and at most `burst` right after one another.
+    """
+
+    def __init__(self, rate: float, burst: int=1):
+        self.rate  = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last   = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    def waitTime(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens)/self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
 class JACK:
     """
     Just Another Crawler Klass.
@@ -20,76 +49,158 @@ class JACK:
 
     The only intelligent feature is that you can disqualify any links with <nav> or <footer> as ancestor, e.g. if you want
     to crawl Wikipedia without the sidebar (although that's much more difficult in their new layout, smh).
+
+    Well, that and it isn't slow: pages are fetched by a pool of threads, several at once, over one session that keeps
+    its connections open. What keeps it polite is a rate limit per host (a TokenBucket) rather than a pause after every
+    page, so that a slow host doesn't hold up the others and a crawl over many hosts isn't capped at one page per second.
+    Pages are still visited in the order they were discovered, as far as the rate limits allow.
     """
 
-    def __init__(self, get_href_from_sides: bool=False, truncate_outlinks: bool=True):
+    def __init__(self, get_href_from_sides: bool=False, truncate_outlinks: bool=True, max_in_flight: int=8,
+                 requests_per_second_per_host: float=1.0, burst: int=1, timeout: float=30):
+        """
+        :param max_in_flight: amount of requests that can be waiting for a response at the same time.
+        :param requests_per_second_per_host: rate limit for every host (i.e. domain and port) separately.
+        :param burst: amount of requests a host can get right after one another after not getting any for a while.
+        :param timeout: seconds to wait for a server before giving up on a page.
+        """
         self.do_surroundings = get_href_from_sides
         self.do_truncate = truncate_outlinks
+        self.max_in_flight = max_in_flight
+        self.rate  = requests_per_second_per_host
+        self.burst = burst
+        self.timeout = timeout
+        self.session: requests.Session = None
 
-    def crawl(self, starting_url: str, max_crawls: int) -> Path:
-        known  = {starting_url: 0}
-        buffer = [starting_url]
+    def crawl(self, starting_url: str, max_crawls: int, output: Path=None) -> Path:
+        """
+        :param output: the JSON file to write to. By default, a new file in the data output folder.
+        :return: the path of a JSON file with, for every page that was crawled, its URL, title, body and the IDs of the
+                 pages it links to. Pages are numbered in the order they were discovered, crawled pages first.
+        """
+        known = {starting_url: 0}          # URL -> ID in order of discovery.
+        queues: Dict[str, deque] = dict()  # Host -> URLs to crawl, in order of discovery.
+        queues[urlparse(starting_url).netloc] = deque([starting_url])
+        buckets: Dict[str, TokenBucket] = dict()
 
-        extracted_data = dict()
+        extracted_data: Dict[int, dict] = dict()  # Discovery ID -> page.
+        in_flight: Dict[Future, str] = dict()
+        self.session = self._newSession()
+        with self.session, ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            while True:
+                # Send requests to the hosts that may get one, as long as there is room.
+                now = time.monotonic()
+                while len(in_flight) < self.max_in_flight and len(extracted_data) + len(in_flight) < max_crawls:
+                    host = self._nextHost(queues, buckets, known, now)
+                    if host is None:
+                        break
+                    url = queues[host].popleft()
+                    if not queues[host]:
+                        del queues[host]
+                    buckets[host].take(now)
+                    print(f"Crawling URL {len(extracted_data) + len(in_flight) + 1}:", url)
+                    in_flight[pool.submit(self._getPage, url)] = url
 
-        i = 0
-        while buffer and i < max_crawls:
-            current_url = buffer.pop(0)
+                if not in_flight:
+                    if not queues or len(extracted_data) >= max_crawls:
+                        break
+                    time.sleep(self._timeUntilHostReady(queues, buckets, now))
+                    continue
 
-            # Get page
-            print(f"Crawling URL {i+1}:", current_url)
-            soup = self._getSoup(current_url)
-            if soup is None:
-                continue
+                # Wait for a response, or until a host may get its next request.
+                may_send_more = queues and len(extracted_data) + len(in_flight) < max_crawls and len(in_flight) < self.max_in_flight
+                done, _ = wait(in_flight, timeout=self._timeUntilHostReady(queues, buckets, now) if may_send_more else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    url  = in_flight.pop(future)
+                    page = future.result()
+                    if page is None:
+                        continue
+                    hrefs, title, body = page
+
+                    # Add the links to the queues if not already seen.
+                    out_ids = []
+                    for href in hrefs:
+                        if href not in known:
+                            known[href] = len(known)
+                            queues.setdefault(urlparse(href).netloc, deque()).append(href)
+                        out_ids.append(known[href])
+                    extracted_data[known[url]] = {
+                        "url": url,
+                        "title": title,
+                        "body": body,
+                        "outlinks": out_ids
+                    }
+        self.session = None
 
-            # Get anchors with hrefs, then add them to the buffer if not already seen.
-            outlinks = self._getUniqueHrefs(current_url, soup)
-            out_ids = []
-            for href in outlinks:
-                if href not in known:
-                    buffer.append(href)
-                    known[href] = len(known)
-                    # print("\t> New link:", href)
-                out_ids.append(known.get(href))
-            out_ids = sorted(out_ids)
-
-            # Get payload
-            title, body = self._getContent(soup)
-            extracted_data[i] = {
-                "url": current_url,
-                "title": title,
-                "body": body,
-                "outlinks": out_ids if not self.do_truncate else list(filter(lambda i: i < max_crawls, out_ids))
-            }
-
-            # Wait a bit before your next request.
-            time.sleep(1)
-            i += 1
-
-        if i < max_crawls:
+        if len(extracted_data) < max_crawls:
             print("Stopped crawling prematurely because the link buffer was emptied.")
 
         print("Saving results...")
-        output = PATH_DATA_OUT / time.strftime("crawl-%H%M%S.json")
+        output = output if output is not None else PATH_DATA_OUT / time.strftime("crawl-%H%M%S.json")
         with open(output, "w", encoding="utf-8") as handle:
-            json.dump(extracted_data, handle, indent=4)
+            json.dump(self._renumber(extracted_data, len(known)), handle, indent=4)
         return output
 
+    def _renumber(self, extracted_data: Dict[int, dict], n_known: int) -> Dict[int, dict]:
+        """
+        Pages that failed to load leave gaps in the discovery IDs, and pages finish in a different order than they were
+        discovered in. So, crawled pages get the IDs 0, 1, 2, ... in order of discovery, and pages that were discovered
+        but not crawled get the IDs after those. Truncating the outlinks drops the latter.
+        """
+        crawled = set(extracted_data)
+        order = sorted(crawled) + [i for i in range(n_known) if i not in crawled]
+        new_ids = {old: new for new, old in enumerate(order)}
+
+        renumbered = dict()
+        for i, old in enumerate(sorted(crawled)):
+            page = extracted_data[old]
+            out_ids = sorted(new_ids[o] for o in page["outlinks"])
+            page["outlinks"] = out_ids if not self.do_truncate else [o for o in out_ids if o < len(crawled)]
+            renumbered[i] = page
+        return renumbered
+
+    def _nextHost(self, queues: Dict[str, deque], buckets: Dict[str, TokenBucket], known: Dict[str, int], now: float) -> Optional[str]:
+        """Of the hosts that may get a request now, the one with the URL that was discovered first."""
+        best_host, best_id = None, None
+        for host, queue in queues.items():
+            bucket = buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+            if bucket.waitTime(now) == 0 and (best_id is None or known[queue[0]] < best_id):
+                best_host, best_id = host, known[queue[0]]
+        return best_host
+
+    def _timeUntilHostReady(self, queues: Dict[str, deque], buckets: Dict[str, TokenBucket], now: float) -> float:
+        return min((buckets[host].waitTime(now) if host in buckets else 0.0 for host in queues), default=0.0)
+
+    def _newSession(self) -> requests.Session:
+        session = requests.Session()
+        session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) ...',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,...',
+            'Accept-Language': 'en-US,en;q=0.5',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'Referer': 'https://httpbin.dev',
+            'Connection': 'keep-alive'
+        })  # because you get a 403 without it - this is just a standard header
+        adapter = HTTPAdapter(pool_connections=self.max_in_flight, pool_maxsize=self.max_in_flight)  # Enough connections for every thread.
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _getPage(self, url: str) -> Optional[Tuple[List[str], str, str]]:
+        """Runs in a thread of the pool: fetches and parses a page, and returns its links, title and body."""
+        soup = self._getSoup(url)
+        if soup is None:
+            return None
+        return (self._getUniqueHrefs(url, soup),) + self._getContent(soup)
+
     def _getSoup(self, url: str) -> Optional[bs4.BeautifulSoup]:
-        headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) ...',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,...',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Referer': 'https://httpbin.dev',
-                'Connection': 'keep-alive'
-            } # because you get a 403 without it - this is just a standard header
         parsed_url = urlparse(url)
         if "wikipedia." in parsed_url.netloc:  # New Wikipedia layout no longer puts the translation pages in a <nav> and that causes messy crawling.
             url += "?useskin=vector"
 
         try:
-            response = requests.get(url, headers=headers)
+            response = self.session.get(url, timeout=self.timeout)
         except:
             print("\tURL couldn't be requested.")
             return None
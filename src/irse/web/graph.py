@@ -0,0 +1,222 @@
+"""
+Directed graphs as sparse adjacency matrices, so that link analysis (PageRank, HITS) can do a whole iteration as one
+sparse matrix-vector product rather than a Python loop over all edges.
+
+The adjacency matrix A has A[i,j] = the amount of links from node i to node j. It is stored in CSR format: for every
+node, the range of its out-links in one array of destinations. Out-degrees are computed once and count every link.
+
+Node IDs are used as row/column indices as they are, unless the graph is made compact: then, only the IDs that appear
+in the graph get an index, in increasing order of ID, and the graph keeps the original ID of every index. That matters
+for graphs with huge or sparse IDs, which would otherwise be padded with nodes that don't exist.
+
+Big graphs are usually stored as an edge list in a text file. Parsing that is much slower than the computations on the
+graph, so the first time such a file is read, the CSR arrays are saved next to it, and later reads map those arrays
+into memory rather than reading them, which takes about the same time whatever the size of the graph.
+"""
+from typing import Dict, List, Optional, Tuple
+from itertools import chain
+from pathlib import Path
+from io import BytesIO
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class Graph:
+
+    def __init__(self, sources: np.ndarray, destinations: np.ndarray, n_nodes: int, node_ids: np.ndarray=None):
+        """
+        :param sources: for every edge, the node it starts at.
+        :param destinations: for every edge, the node it ends at. Repeated edges count as many times as they appear.
+        :param n_nodes: nodes are 0 ... n_nodes-1. Nodes that appear in no edge are isolated.
+        :param node_ids: for every node, its original ID, if the nodes were renumbered.
+        """
+        sources      = np.asarray(sources,      dtype=np.int64)
+        destinations = np.asarray(destinations, dtype=np.int64)
+        self.n_nodes = n_nodes
+        self.node_ids: Optional[np.ndarray] = node_ids
+        self.adjacency: sp.csr_matrix = sp.csr_matrix((np.ones(len(sources)), (sources, destinations)), shape=(n_nodes, n_nodes))
+        self.out_degrees = np.asarray(self.adjacency.sum(axis=1)).ravel()  # Not the row lengths, since repeated edges were summed into one entry.
+
+    @staticmethod
+    def fromDict(edges: Dict[int, List[int]], nodes: int=None, filter_sink_tail: bool=False, compact: bool=False) -> "Graph":
+        """
+        Converts an adjacency list (node -> nodes it links to) in one pass.
+
+        :param nodes: minimal amount of nodes. By default, the highest node ID plus 1. Not used when compact.
+        :param filter_sink_tail: drop links to nodes with a higher ID than the highest source node. Those are typically
+                                 pages that were discovered but never crawled.
+        :param compact: only give indices to the IDs that appear in the graph (as a source or destination).
+        """
+        out_degrees  = np.fromiter(map(len, edges.values()), dtype=np.int64, count=len(edges))
+        sources      = np.repeat(np.fromiter(edges.keys(), dtype=np.int64, count=len(edges)), out_degrees)
+        destinations = np.fromiter(chain.from_iterable(edges.values()), dtype=np.int64, count=int(out_degrees.sum()))
+        max_source = max(edges) if edges else -1
+        if filter_sink_tail:
+            keep = destinations <= max_source
+            sources, destinations = sources[keep], destinations[keep]
+            max_node = max_source
+        else:
+            max_node = max(max_source, int(destinations.max(initial=-1)))
+
+        if compact:
+            node_ids = np.unique(np.concatenate((np.fromiter(edges.keys(), dtype=np.int64, count=len(edges)), destinations)))
+            return Graph(np.searchsorted(node_ids, sources), np.searchsorted(node_ids, destinations), len(node_ids), node_ids)
+
+        n_nodes = max_node+1 if nodes is None else max(nodes, max_node+1)
+        return Graph(sources, destinations, n_nodes)
+
+    @staticmethod
+    def fromEdgeFile(edge_file: Path, compact: bool=False, cache: bool=True, chunk_size: int=2**26) -> "Graph":
+        """
+        Reads a file with one link per line: the ID of the source and the ID of the destination, separated by
+        whitespace (e.g. a TSV). Lines that start with // or # (possibly indented) are comments. The result is the same as what
+        Graph.fromDict(readEdges(edge_file)) gives, but the file is parsed by NumPy a chunk of bytes at a time, never
+        holding a Python object per link.
+
+        :param compact: see fromDict().
+        :param cache: save the graph next to the file (see save()), and use that instead of the file in later calls,
+                      unless the file has been modified since.
+        :param chunk_size: amount of bytes parsed at once.
+        """
+        edge_file = Path(edge_file)
+        cache_path = edge_file.with_name(edge_file.name + (".compact" if compact else "") + ".csr")
+        if cache and cache_path.exists() and cache_path.stat().st_mtime >= edge_file.stat().st_mtime:
+            return Graph.load(cache_path)
+
+        sources, destinations = [], []
+        with open(edge_file, "rb") as handle:
+            rest = b""
+            while True:
+                chunk = handle.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = rest + chunk
+                end = chunk.rfind(b"\n") + 1  # The last line may continue in the next chunk.
+                chunk, rest = chunk[:end], chunk[end:]
+                s, d = Graph._parseEdges(chunk)
+                sources.append(s)
+                destinations.append(d)
+            s, d = Graph._parseEdges(rest)
+            sources.append(s)
+            destinations.append(d)
+        sources, destinations = np.concatenate(sources), np.concatenate(destinations)
+
+        if compact:
+            node_ids = np.unique(np.concatenate((sources, destinations)))
+            graph = Graph(np.searchsorted(node_ids, sources), np.searchsorted(node_ids, destinations), len(node_ids), node_ids)
+        else:
+            graph = Graph(sources, destinations, int(max(sources.max(initial=-1), destinations.max(initial=-1))) + 1)
+        if cache:
+            graph.save(cache_path)
+        return graph
+
+    @staticmethod
+    def _parseEdges(text: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        NumPy's loadtxt() parses the IDs, and insists that every line has as many as the first one, so a line with one
+        ID followed by a line with three is an error rather than two links. Anything that isn't an ID is an error too.
+        """
+        text = Graph._withoutComments(text)
+        if not text.strip():
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        ids = np.loadtxt(BytesIO(text), dtype=np.int64, ndmin=2, comments=None)  # Any whitespace separates, blank lines are skipped.
+        if ids.shape[1] != 2:
+            raise ValueError("Every line of an edge file should have exactly two node IDs.")
+        return ids[:,0], ids[:,1]
+
+    @staticmethod
+    def _withoutComments(text: bytes) -> bytes:
+        """
+        Cuts out the lines that start with # or // (after whitespace, if any). A marker anywhere else is left in, and
+        then fails to parse as an ID. There are usually only a few comments, at the top of the file, so rather than going
+        over all lines, this jumps from one marker to the next.
+        """
+        pieces = []
+        start = 0  # Start of the text that isn't in a piece yet. Always the start of a line.
+        next_hash, next_slashes = text.find(b"#"), text.find(b"//")
+        while next_hash >= 0 or next_slashes >= 0:
+            marker = min(position for position in (next_hash, next_slashes) if position >= 0)
+            line_start = text.rfind(b"\n", 0, marker) + 1
+            line_end = text.find(b"\n", marker)
+            line_end = len(text) if line_end < 0 else line_end + 1
+
+            if not text[line_start:marker].strip():  # Nothing before the marker, so the line is a comment.
+                pieces.append(text[start:line_start])
+                start = line_end
+            if 0 <= next_hash < line_end:  # Any other marker on this line is either in the comment or not at the start.
+                next_hash = text.find(b"#", line_end)
+            if 0 <= next_slashes < line_end:
+                next_slashes = text.find(b"//", line_end)
+
+        if not pieces:
+            return text
+        pieces.append(text[start:])
+        return b"".join(pieces)
+
+    def save(self, path: Path):
+        """
+        Saves the CSR arrays as .npy files in a folder, so that load() can map them into memory without reading them.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "indptr.npy",      self.adjacency.indptr)
+        np.save(path / "indices.npy",     self.adjacency.indices)
+        np.save(path / "counts.npy",      self.adjacency.data)
+        np.save(path / "out_degrees.npy", self.out_degrees)
+        if self.node_ids is not None:
+            np.save(path / "node_ids.npy", self.node_ids)
+        elif (path / "node_ids.npy").exists():
+            (path / "node_ids.npy").unlink()
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool=True) -> "Graph":
+        """
+        :param mmap: map the arrays into memory rather than reading them. Only the parts that are used are then read,
+                     when they are used, and the operating system can share them between processes.
+        """
+        path = Path(path)
+        mode = "r" if mmap else None
+        indptr  = np.load(path / "indptr.npy",  mmap_mode=mode)
+        indices = np.load(path / "indices.npy", mmap_mode=mode)
+        counts  = np.load(path / "counts.npy",  mmap_mode=mode)
+
+        graph = cls.__new__(cls)
+        graph.n_nodes = len(indptr) - 1
+        graph.node_ids = np.load(path / "node_ids.npy", mmap_mode=mode) if (path / "node_ids.npy").exists() else None
+        graph.adjacency = sp.csr_matrix((counts, indices, indptr), shape=(graph.n_nodes, graph.n_nodes))
+        graph.out_degrees = np.load(path / "out_degrees.npy", mmap_mode=mode)
+        return graph
+
+    def originalIds(self) -> np.ndarray:
+        """For every node index, the ID it had in the input."""
+        return self.node_ids if self.node_ids is not None else np.arange(self.n_nodes)
+
+    @property
+    def n_edges(self) -> int:
+        return int(self.adjacency.sum())
+
+    @property
+    def dangling(self) -> np.ndarray:
+        """Mask of the nodes without out-links."""
+        return self.out_degrees == 0
+
+    def transitionMatrix(self) -> sp.csr_matrix:
+        """
+        The matrix T with T[j,i] = probability that a random surfer at node i follows a link to node j, i.e. the
+        transpose of the row-normalised adjacency matrix. Multiplying it with a distribution over the nodes gives the
+        distribution one click later. Columns of dangling nodes are all zero.
+        """
+        inverse_degrees = np.zeros(self.n_nodes)
+        inverse_degrees[~self.dangling] = 1 / self.out_degrees[~self.dangling]
+        return (sp.diags(inverse_degrees) @ self.adjacency).T.tocsr()
+
+
+def checkNoConversionArguments(nodes: int=None, filter_sink_tail: bool=False):
+    """
+    For functions that take either a dictionary of edges or a Graph: the arguments that say how to convert the
+    dictionary can't do anything to a Graph, which has been converted already, so they shouldn't be given with one.
+    """
+    if nodes is not None or filter_sink_tail:
+        raise ValueError("A Graph is used as is, so nodes and filter_sink_tail only apply to a dictionary of edges. Pass them to Graph.fromDict() instead.")
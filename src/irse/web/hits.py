@@ -1,4 +1,168 @@
 """
-I don't have time to implement this. If you want to experiment with HITS (but without the filter), see:
-https://github.com/anjali-chadha/HITS-algorithm
-"""
\ No newline at end of file
+HITS (Kleinberg, 1999): every page gets two scores. A page is a good authority when good hubs link to it, and a good
+hub when it links to good authorities. With A the adjacency matrix (A[i,j] = 1 when page i links to page j), that is
+    a = A^T h
+    h = A a
+which is iterated, normalising both after every iteration, until they stop changing. Then a is the principal
+eigenvector of A^T A and h that of A A^T. Like PageRank, every iteration is a sparse matrix-vector product, but unlike
+PageRank, there is no teleportation, so convergence can be slow when the two largest eigenvalues are close.
+
+Kleinberg's HITS is query-dependent: it doesn't run on the whole web, but on the neighbourhood of the pages that match
+the query (see QueryTimeHITS). Both are implemented here.
+"""
+from typing import Dict, List, Tuple, Union, TYPE_CHECKING
+
+import numpy as np
+import scipy.sparse as sp
+
+from fiject import LineGraph
+
+from irse.web.graph import Graph, checkNoConversionArguments
+from irse.web.pagerank import Convergence
+if TYPE_CHECKING:  # Only for the annotations: importing the retrieval model loads its whole NLP pipeline.
+    from irse.retrieval.bm25 import OkapiRetrieval
+
+
+class HITS:
+
+    def __init__(self, max_iterations: int=20, norm: int=2, epsilon: float=1e-6):
+        self.norm = norm
+        self.epsilon = epsilon
+        self.maximum_iterations = max_iterations
+        self.convergence: Convergence = None  # Of the most recent computation.
+
+    def getHITSVectors(self, edges: Union[Dict[int,List[int]], Graph], nodes: int=None, filter_sink_tail: bool=False,
+                       plot: LineGraph=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the hub vector and the authority vector, indexed by node ID like PageRank.getPageRankVector(). Each
+        sums to 1. Repeated links count once. A Graph is used as is.
+        """
+        if isinstance(edges, Graph):
+            checkNoConversionArguments(nodes, filter_sink_tail)
+            return self._solve(_links(edges), plot)
+        if not edges:
+            return np.array([]), np.array([])
+
+        graph = Graph.fromDict(edges, nodes=nodes, filter_sink_tail=filter_sink_tail)
+        return self._solve(_links(graph), plot)
+
+    def getHubsAndAuthorities(self, edges: Dict[int,List[int]], filter_sink_tail: bool=False,
+                              plot: LineGraph=None) -> Tuple[Dict[int,float], Dict[int,float]]:
+        """Same as getHITSVectors(), but only for the IDs that appear in the graph, like PageRank.getPageRanks()."""
+        if not edges:
+            return dict(), dict()
+
+        graph = Graph.fromDict(edges, filter_sink_tail=filter_sink_tail, compact=True)
+        hubs, authorities = self._solve(_links(graph), plot)
+        ids = graph.originalIds().tolist()
+        return dict(zip(ids, hubs.tolist())), dict(zip(ids, authorities.tolist()))
+
+    def _solve(self, links: sp.csr_matrix, plot: LineGraph=None, progress: bool=True) -> Tuple[np.ndarray, np.ndarray]:
+        N = links.shape[0]
+        linked_from = links.T.tocsr()  # Row j has the pages that link to page j.
+
+        self.convergence = Convergence(self.epsilon, self.norm, self.maximum_iterations, plot,
+                                       label=f"HITS ($N={N}$) $||\\cdot||_{self.norm}$", name="HITS", progress=progress)
+        hubs_and_authorities = np.ones((N, 2))/N
+        for _ in self.convergence:
+            authorities = _normalised(linked_from @ hubs_and_authorities[:,0])
+            hubs        = _normalised(links @ authorities)
+            new = np.column_stack((hubs, authorities))
+            self.convergence.report(hubs_and_authorities, new)  # The deviation is that of whichever changed most.
+            hubs_and_authorities = new
+        return hubs_and_authorities[:,0], hubs_and_authorities[:,1]
+
+
+class QueryTimeHITS:
+    """
+    HITS as Kleinberg proposed it: for a query,
+      1. the root set is the pages that match the query best;
+      2. the base set is the root set, plus every page that a root page links to, plus (at most a fixed amount of)
+         pages that link to each root page;
+      3. HITS runs on the graph of links between the pages of the base set.
+    The base set is small, so a query only costs the retrieval plus a few products with a matrix of a few thousand
+    rows. What does have to be prepared is a way to find the pages that link to a page, so the graph is stored with
+    its links in both directions.
+
+    The pages have to be the documents of the index, i.e. page i of the crawl is document i (like JACK.graphFromCrawl()
+    and JACK.corpusFromCrawl() number them).
+    """
+
+    def __init__(self, retrieval: "OkapiRetrieval", edges: Dict[int,List[int]], hits: HITS=None,
+                 root_size: int=200, max_in_links: int=50):
+        """
+        :param retrieval: only its .filter() (for the root set) and its .index (for the amount of pages) are used.
+        :param root_size: amount of best-matching pages in the root set.
+        :param max_in_links: at most this many pages that link to a root page are added for every root page, so that
+                             a popular page doesn't drag in a large part of the web.
+        """
+        self.retrieval = retrieval
+        self.hits = hits if hits is not None else HITS()
+        self.root_size = root_size
+        self.max_in_links = max_in_links
+
+        graph = Graph.fromDict(edges, nodes=retrieval.index.n_documents)
+        self.links       = _links(graph)
+        self.linked_from = self.links.T.tocsr()
+
+    def baseSet(self, query: str) -> np.ndarray:
+        """The IDs of the pages in the base set of the query, in increasing order."""
+        root = np.array([page for page, _ in self.retrieval.filter(query, truncate_at=self.root_size)], dtype=np.int64)
+        if len(root) == 0:
+            return root
+
+        # The in-links of every root page are a range of .linked_from.indices, of which only the first few are kept.
+        starts = self.linked_from.indptr[root]
+        ends   = np.minimum(self.linked_from.indptr[root+1], starts + self.max_in_links)
+        lengths = ends - starts
+        in_links = self.linked_from.indices[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())]
+        out_links = self.links[root].indices
+        return np.unique(np.concatenate((root, out_links, in_links)))
+
+    def rank(self, query: str, truncate_at: int=10, plot: LineGraph=None) -> Tuple[List[Tuple[int, float]], List[Tuple[int, float]]]:
+        """
+        The best hubs and the best authorities for the query, as (page, score) pairs from highest to lowest score,
+        ties by page ID. Scores sum to 1 over the base set.
+        """
+        base = self.baseSet(query)
+        if len(base) == 0:
+            return [], []
+
+        hubs, authorities = self.hits._solve(self.links[base][:,base], plot, progress=False)  # One bar per query would only be noise.
+        return _top(base, hubs, truncate_at), _top(base, authorities, truncate_at)
+
+
+def _links(graph: Graph) -> sp.csr_matrix:
+    """The adjacency matrix, but with every link counted once."""
+    links = graph.adjacency.copy()
+    links.data[:] = 1
+    return links
+
+
+def _normalised(vector: np.ndarray) -> np.ndarray:
+    total = vector.sum()
+    return vector / total if total > 0 else vector
+
+
+def _top(pages: np.ndarray, scores: np.ndarray, truncate_at: int) -> List[Tuple[int, float]]:
+    order = np.lexsort((pages, -scores))[:truncate_at]
+    return list(zip(pages[order].tolist(), scores[order].tolist()))
+
+
+if __name__ == "__main__":
+    from irse.web.crawler import PATH_DATA_OUT, JACK
+    from irse.retrieval.bm25 import OkapiRetrieval
+    path = PATH_DATA_OUT / "crawl-180417.json"
+    edges = JACK.graphFromCrawl(path)
+
+    g = LineGraph("HITS-convergence")
+    hubs, authorities = HITS(max_iterations=50, norm=1).getHITSVectors(edges, filter_sink_tail=True, plot=g)
+    print("Hubs:", np.argsort(-hubs)[:10])
+    print("Authorities:", np.argsort(-authorities)[:10])
+    g.commitWithArgs(
+        LineGraph.ArgsGlobal(x_label="Iteration", y_label="Absolute change", legend_position="upper right"),
+        LineGraph.ArgsPerLine(show_points=False)
+    )
+
+    hits = QueryTimeHITS(OkapiRetrieval(JACK.corpusFromCrawl(path)), edges)
+    print(hits.rank("language family"))
@@ -3,17 +3,23 @@ Code based on https://github.com/bhaveshgawri/PageRank.
 except I took out all the bugs and simplified bad practices.
 """
 from enum import Enum
-from typing import Dict, List
+from typing import Dict, List, Iterator, Union
+from abc import ABC, abstractmethod
 from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve_triangular
 from tqdm.auto import tqdm
 
 from fiject import LineGraph
 
+from irse.web.graph import Graph, checkNoConversionArguments
+
 
 def readEdges(edge_file_tsv: Path):
+    """Reads an edge file into an adjacency list. For big files, Graph.fromEdgeFile() is much faster."""
     edges = defaultdict(list)
 
     with open(edge_file_tsv, "r", encoding="utf-8") as handle:
@@ -27,71 +33,352 @@ def readEdges(edge_file_tsv: Path):
     return edges
 
 
+class Convergence:
+    """
+    Shared by all PageRank solvers (and HITS): decides when to stop iterating, and reports how much every iteration
+    changed the vector, in .deviations and, if a LineGraph is given, as a line in that graph.
+    """
+
+    def __init__(self, epsilon: float, norm: int, max_iterations: int, plot: LineGraph=None, label: str="",
+                 name: str="PageRank", progress: bool=True):
+        """
+        :param progress: whether to show a progress bar over the iterations. Worth turning off when many small
+                         computations run one after the other.
+        """
+        self.name = name
+        self.progress = progress
+        self.epsilon = epsilon
+        self.norm = norm
+        self.max_iterations = max_iterations
+        self.plot  = plot
+        self.label = label
+        self.deviations: List[float] = []
+
+    def __iter__(self) -> Iterator[int]:
+        """Iteration numbers, until the vector stops changing or the maximum amount of iterations is reached."""
+        for i in tqdm(range(self.max_iterations), desc=self.name, disable=not self.progress):
+            if self.converged:
+                break
+            yield i
+
+    @property
+    def converged(self) -> bool:
+        return bool(self.deviations) and self.deviations[-1] < self.epsilon
+
+    @property
+    def iterations(self) -> int:
+        return len(self.deviations)
+
+    def report(self, previous: np.ndarray, current: np.ndarray):
+        """When many vectors are computed at once (as the columns of a matrix), the one that changed most counts."""
+        deviation = float(np.max(np.linalg.norm(current - previous, ord=self.norm, axis=0)))
+        if self.plot is not None:
+            self.plot.add(self.label, len(self.deviations), deviation)
+        self.deviations.append(deviation)
+
+
+class PageRankSolver(ABC):
+    """
+    Finds the x with
+        x = gamma * (T x + (d . x) v) + (1-gamma) v
+    where T is the transition matrix, d marks the dangling nodes (which have no out-links) and v is the teleportation
+    distribution. A surfer at a dangling node has nowhere to click, so it teleports; that is the (d . x) v term. With
+    it, no probability mass leaks out of the vector, so x stays a distribution without having to be renormalised.
+
+    The teleportation distribution can also be a matrix with one distribution per column. Then, every column of the
+    result is the x for that column's v, and all of them are computed together, so that T is read once per iteration
+    rather than once per column.
+    """
+
+    name = "PageRank"
+
+    @abstractmethod
+    def solve(self, transitions: sp.csr_matrix, dangling: np.ndarray, teleportation: np.ndarray, gamma: float,
+              convergence: Convergence) -> np.ndarray:
+        pass
+
+
+class PowerIteration(PageRankSolver):
+    """
+    Applies the right-hand side over and over, starting from the teleportation distribution. The error shrinks by a
+    factor gamma every iteration.
+    """
+
+    def solve(self, transitions: sp.csr_matrix, dangling: np.ndarray, teleportation: np.ndarray, gamma: float,
+              convergence: Convergence) -> np.ndarray:
+        x = teleportation
+        for _ in convergence:
+            x_next = self.step(x, transitions, dangling, teleportation, gamma)
+            convergence.report(x, x_next)
+            x = x_next
+        return x
+
+    @staticmethod
+    def step(x: np.ndarray, transitions: sp.csr_matrix, dangling: np.ndarray, teleportation: np.ndarray, gamma: float) -> np.ndarray:
+        x_next = transitions @ x
+        x_next *= gamma  # In place, since with many columns, every pass over a temporary matrix costs as much as the product.
+        x_next += (gamma * (dangling @ x) + 1-gamma) * teleportation
+        return x_next
+
+
+class GaussSeidel(PageRankSolver):
+    """
+    Since (d . x) is just a number, x is proportional to the solution y of the linear system (I - gamma T) y = v. This
+    solver finds y one node at a time, each node using the values that were already updated in the same sweep. A sweep
+    is a triangular solve: with I - gamma T = L + U, where L is the lower triangle including the diagonal, it solves
+    L y_next = v - U y. Normalising y gives x. On graphs where power iteration is slow, this needs about a third fewer
+    iterations, but a sweep is inherently sequential, so it is only faster in wall-clock time when the matrix product
+    is the expensive part (e.g. when the graph doesn't fit in memory and every iteration has to read it from disk).
+    """
+
+    name = "PageRank, Gauss-Seidel"
+
+    def solve(self, transitions: sp.csr_matrix, dangling: np.ndarray, teleportation: np.ndarray, gamma: float,
+              convergence: Convergence) -> np.ndarray:
+        system = sp.identity(len(teleportation), format="csr") - gamma * transitions
+        lower = sp.tril(system, format="csr")
+        upper = sp.triu(system, k=1, format="csr")
+
+        y = x = teleportation
+        for _ in convergence:
+            y = spsolve_triangular(lower, teleportation - upper @ y, lower=True)
+            x_next = y / y.sum(axis=0)
+            convergence.report(x, x_next)
+            x = x_next
+        return x
+
+
+class QuadraticExtrapolation(PageRankSolver):
+    """
+    Power iteration, except that every so many iterations, the last few iterates are used to estimate the components
+    of the error along the second and third eigenvectors, which are the slowest to die out, and subtract them
+    (Kamvar et al., 2003). Most useful for gamma close to 1, where power iteration is slowest.
+    """
+
+    name = "PageRank, quadratic extrapolation"
+
+    def __init__(self, period: int=10):
+        """
+        :param period: amount of power iterations between two extrapolations.
+        """
+        self.period = period
+
+    def solve(self, transitions: sp.csr_matrix, dangling: np.ndarray, teleportation: np.ndarray, gamma: float,
+              convergence: Convergence) -> np.ndarray:
+        x = teleportation
+        history = [x]
+        for i in convergence:
+            x_next = PowerIteration.step(x, transitions, dangling, teleportation, gamma)
+            history = history[-3:] + [x_next]
+            if (i+1) % self.period == 0 and len(history) == 4:
+                x_next = self._extrapolate(*history)
+                history = [x_next]
+            convergence.report(x, x_next)
+            x = x_next
+        return x
+
+    @staticmethod
+    def _extrapolate(x0: np.ndarray, x1: np.ndarray, x2: np.ndarray, x3: np.ndarray) -> np.ndarray:
+        if x0.ndim == 2:  # Every column has its own eigenvector components.
+            return np.column_stack([QuadraticExtrapolation._extrapolate(x0[:,i], x1[:,i], x2[:,i], x3[:,i]) for i in range(x0.shape[1])])
+
+        y = np.column_stack((x1 - x0, x2 - x0))
+        g1, g2 = np.linalg.lstsq(y, -(x3 - x0), rcond=None)[0]
+        g3 = 1.0
+        x = (g1 + g2 + g3) * x1 + (g2 + g3) * x2 + g3 * x3
+        x = np.maximum(x, 0)
+        return x / x.sum()
+
+
 class PageRank:
 
-    def __init__(self, teleportation_probability: float, max_iterations: int=20, norm: int=2, epsilon: float=1e-6):
+    def __init__(self, teleportation_probability: float, max_iterations: int=20, norm: int=2, epsilon: float=1e-6,
+                 solver: PageRankSolver=None):
+        """
+        :param solver: how to find the PageRank vector. Power iteration by default.
+        """
         self.gamma = 1 - teleportation_probability
         self.norm = norm
         self.epsilon = epsilon
         self.maximum_iterations = max_iterations
+        self.solver = solver if solver is not None else PowerIteration()
+        self.convergence: Convergence = None  # Of the most recent computation.
+        self.pushes = 0  # Amount of nodes that pushed their residual in the most recent update.
 
-    def getPageRankVector(self, edges: Dict[int,List[int]], nodes: int=None, filter_sink_tail: bool=False,
+    def getPageRankVector(self, edges: Union[Dict[int,List[int]], Graph], nodes: int=None, filter_sink_tail: bool=False,
                           plot: LineGraph=None):
+        """
+        Returns a vector indexed by node ID, so with one entry for every ID from 0 up to the highest one, whether such
+        a node exists or not. For graphs with high or sparse IDs, use getPageRanks() instead.
+
+        The edges can also be a Graph that was converted before, e.g. read with Graph.fromEdgeFile(). It is used as is,
+        so then the other arguments can't be given (a ValueError says so), and the vector is indexed by node index.
+        """
+        if isinstance(edges, Graph):
+            checkNoConversionArguments(nodes, filter_sink_tail)
+            return self._solve(edges, plot)
         if not edges:
             return np.array([])
 
-        # Find maximum node known to the graph.
-        min_src_node_id = +np.inf
-        max_src_node_id = -np.inf
-        min_dst_node_id = +np.inf
-        max_dst_node_id = -np.inf
-        for source, destinations in edges.items():
-            min_src_node_id = min(min_src_node_id,source)
-            max_src_node_id = max(max_src_node_id,source)
-            min_dst_node_id = min(min_dst_node_id,min(destinations) if destinations else +np.inf)
-            max_dst_node_id = max(max_dst_node_id,max(destinations) if destinations else -np.inf)
+        # The graph is converted once into a sparse matrix, with the out-degrees already divided out.
+        graph = Graph.fromDict(edges, nodes=nodes, filter_sink_tail=filter_sink_tail)
 
         # Min node is just used for a warning.
-        min_node_id = min(min_src_node_id, min_dst_node_id)
+        min_node_id = min(min(edges), int(graph.adjacency.indices.min(initial=graph.n_nodes)))
         if min_node_id > 1:
-            print(f"Beware that the given graph starts at node {min_node_id} rather than 0 or 1, so a lot of dummy pages will be in the vector.")
+            print(f"Beware that the given graph starts at node {min_node_id} rather than 0 or 1, so a lot of dummy pages will be in the vector. Consider using getPageRanks().")
 
-        # Max node is used to have the correct PageRank vector size.
-        if filter_sink_tail:
-            max_node_id = max_src_node_id
-            for source, destinations in edges.items():
-                edges[source] = list(filter(lambda d: d <= max_node_id, destinations))
-        else:
-            max_node_id = max(max_src_node_id, max_dst_node_id)
+        return self._solve(graph, plot)
 
-        N = max_node_id+1 if nodes is None else max(nodes, max_node_id+1)
-        UNIFORM_PROBABILITY = np.ones(N)/N
+    def getPageRanks(self, edges: Union[Dict[int,List[int]], Graph], filter_sink_tail: bool=False, plot: LineGraph=None) -> Dict[int,float]:
+        """
+        Same as getPageRankVector(), except that only the IDs that actually appear in the graph are nodes, and the
+        result maps each of those IDs to its PageRank. Memory (and teleportation) hence scales with the amount of real
+        nodes rather than with the highest ID. A Graph is used as is, with its original IDs.
+        """
+        if isinstance(edges, Graph):
+            checkNoConversionArguments(filter_sink_tail=filter_sink_tail)
+            return dict(zip(edges.originalIds().tolist(), self._solve(edges, plot).tolist()))
+        if not edges:
+            return dict()
 
-        # Iterative computation (summation form; no matrices)
-        prev_PR_vector = UNIFORM_PROBABILITY
-        absolute_deviation = np.inf
-        for i in tqdm(range(self.maximum_iterations), desc="PageRank"):
-            if absolute_deviation < self.epsilon:
-                break
+        graph = Graph.fromDict(edges, filter_sink_tail=filter_sink_tail, compact=True)
+        return dict(zip(graph.originalIds().tolist(), self._solve(graph, plot).tolist()))
+
+    def getPersonalizedPageRankVectors(self, edges: Dict[int,List[int]], teleportation: np.ndarray, nodes: int=None,
+                                       filter_sink_tail: bool=False, batch_size: int=16, plot: LineGraph=None) -> np.ndarray:
+        """
+        Personalized (or topic-sensitive) PageRank: rather than to any page, the surfer teleports to pages according to
+        a given distribution, so that pages close to those pages rank higher. Many such distributions are computed at
+        once, a batch at a time (see PageRankSolver). How much that saves depends on how much of the time goes to
+        reading the graph rather than to the dense arithmetic, which grows with the batch: the batch keeps iterating
+        until its slowest vector has converged, and once the batch no longer fits in the CPU cache, every pass over it
+        costs as much as the matrix product. Batches of a few dozen vectors are usually best.
+
+        :param teleportation: matrix with one row per distribution and one column per node ID (like the vector
+                              returned by getPageRankVector()). Rows are normalised to sum to 1. See teleportToSeeds().
+        :param batch_size: amount of distributions iterated together. Memory is about 5 dense vectors per distribution.
+                           self.convergence is that of the last batch.
+        :return: matrix with, in every row, the PageRank vector for the distribution in that row.
+        """
+        teleportation = np.atleast_2d(np.asarray(teleportation, dtype=np.float64))
+        if np.any(teleportation < 0):
+            raise ValueError("Teleportation probabilities can't be negative.")
+        totals = teleportation.sum(axis=1)
+        if np.any(totals == 0):
+            raise ValueError("Every teleportation distribution needs at least one node with a nonzero probability.")
 
-            current_PR_vector = np.zeros(N)
-            for source in edges:
-                for destination in edges[source]:
-                    current_PR_vector[destination] += prev_PR_vector[source] / len(edges[source])  # Probability of being at the source times probability of jumping to the destination from there.
+        graph = Graph.fromDict(edges, nodes=max(nodes or 0, teleportation.shape[1]), filter_sink_tail=filter_sink_tail)
+        if graph.n_nodes > teleportation.shape[1]:  # Nodes without a probability are never teleported to.
+            teleportation = np.pad(teleportation, ((0,0), (0, graph.n_nodes - teleportation.shape[1])))
 
-            # Renormalise
-            current_PR_vector /= np.sum(current_PR_vector)
+        transitions = graph.transitionMatrix()
+        result = np.empty((len(teleportation), graph.n_nodes))
+        for start in range(0, len(teleportation), batch_size):
+            batch = (teleportation[start:start+batch_size] / totals[start:start+batch_size, None]).T  # One distribution per column.
+            result[start:start+batch_size] = self._solve(graph, plot, batch, transitions).T
+        return result
 
-            # Add teleportation
-            current_PR_vector = self.gamma*current_PR_vector + (1-self.gamma)*UNIFORM_PROBABILITY
+    @staticmethod
+    def teleportToSeeds(seeds: List[List[int]], n_nodes: int) -> np.ndarray:
+        """For every list of node IDs, the teleportation distribution that is uniform over those nodes."""
+        teleportation = np.zeros((len(seeds), n_nodes))
+        for i, nodes in enumerate(seeds):
+            teleportation[i, nodes] = 1
+        return teleportation
 
-            absolute_deviation = np.linalg.norm(current_PR_vector - prev_PR_vector, ord=self.norm)
-            prev_PR_vector = current_PR_vector
+    def updatePageRankVector(self, previous: np.ndarray, edges: Dict[int,List[int]], nodes: int=None,
+                             filter_sink_tail: bool=False, tolerance: float=1e-10) -> np.ndarray:
+        """
+        Same as getPageRankVector(), but for a graph that grew (or changed a little) since the given PageRank vector
+        was computed, e.g. by crawling more pages. The old vector is corrected rather than recomputed, which touches the
+        pages near the changes rather than the whole graph. See _update().
 
-            if plot is not None:
-                plot.add(f"PageRank ($N={N}$, $\gamma = {self.gamma}$) $||\cdot||_{self.norm}$", i, absolute_deviation)
+        :param previous: PageRank vector of the graph before the change. Its nodes keep their IDs; IDs beyond it are new.
+        :param tolerance: the corrections stop when no page has more than this amount of PageRank left to pass on.
+                          The old vector should have been computed at least this precisely, else its own error is
+                          corrected too, and that takes as long as computing it from scratch.
+        """
+        previous = np.asarray(previous, dtype=np.float64)
+        graph = Graph.fromDict(edges, nodes=max(nodes or 0, len(previous)), filter_sink_tail=filter_sink_tail)
+        start = np.zeros(graph.n_nodes)
+        start[:len(previous)] = previous
+        known = np.arange(graph.n_nodes) < len(previous)
+        return self._update(graph, start, known, tolerance)
+
+    def updatePageRanks(self, previous: Dict[int,float], edges: Dict[int,List[int]], filter_sink_tail: bool=False,
+                        tolerance: float=1e-10) -> Dict[int,float]:
+        """
+        Same as updatePageRankVector(), with nodes identified by their ID like in getPageRanks(). Nodes that are in the
+        previous PageRanks but no longer in the graph are dropped.
+        """
+        if not edges:
+            return dict()
+
+        graph = Graph.fromDict(edges, filter_sink_tail=filter_sink_tail, compact=True)
+        ids = graph.originalIds()
+        old_ids   = np.fromiter(previous.keys(),   dtype=np.int64,   count=len(previous))
+        old_ranks = np.fromiter(previous.values(), dtype=np.float64, count=len(previous))
+        positions = np.minimum(np.searchsorted(ids, old_ids), len(ids)-1)
+        kept = ids[positions] == old_ids
+
+        start = np.zeros(graph.n_nodes)
+        start[positions[kept]] = old_ranks[kept]
+        known = np.zeros(graph.n_nodes, dtype=bool)
+        known[positions[kept]] = True
+        return dict(zip(ids.tolist(), self._update(graph, start, known, tolerance).tolist()))
+
+    def _update(self, graph: Graph, start: np.ndarray, known: np.ndarray, tolerance: float) -> np.ndarray:
+        """
+        Rather than x itself, this works with z = (I - gamma T)^-1 1, of which x is the normalised version (see
+        GaussSeidel). Unlike x, z doesn't depend on the amount of nodes nor on the dangling nodes: z[u] is 1 plus gamma
+        times what flows into u over the links into u. So when the graph changes, z only changes downstream of the
+        changes, and the old z is a good start anywhere else.
+
+        The old vector only gives z up to a constant factor. For every node of which nothing upstream changed, the old
+        vector x satisfies x - gamma T x = 1/factor, so the factor is recovered as the median over the known nodes. New
+        nodes start at z = 1, their own teleportation.
+
+        Then, the residual r = 1 - (I - gamma T) z is what every node still has to pass on, which is about zero except
+        near the changes. Nodes whose residual is too big push it: they add it to their z and pass gamma times it on
+        over their out-links (the residual push or Gauss-Southwell method). Every push shrinks the total residual by
+        at least (1 - gamma) times what was pushed, so the pushes die out after spreading some distance downstream.
+        All nodes above the threshold push at once, as one sparse product with just their rows of the graph.
+        """
+        gamma = self.gamma
+        transitions = graph.transitionMatrix()
+        out_links = transitions.T.tocsr()  # Row u has the probability of going from u to every other node.
+
+        consistency = start - gamma * (transitions @ start)
+        valid = known & (consistency > 0)
+        factor = 1 / np.median(consistency[valid]) if np.any(valid) else 1.0
+        z = np.where(known, factor * start, 1.0)
+        residual = 1 - z + gamma * (transitions @ z)
+
+        threshold = tolerance * z.sum()  # In units of z, which sums to about this much more than x.
+        self.pushes = 0
+        while True:
+            frontier = np.flatnonzero(np.abs(residual) > threshold)
+            if len(frontier) == 0:
+                break
+            pushed = residual[frontier]
+            z[frontier] += pushed
+            residual[frontier] = 0
+            residual += gamma * (out_links[frontier].T @ pushed)
+            self.pushes += len(frontier)
+        return z / z.sum()
+
+    def _solve(self, graph: Graph, plot: LineGraph=None, teleportation: np.ndarray=None, transitions: sp.csr_matrix=None) -> np.ndarray:
+        N = graph.n_nodes
+        UNIFORM_PROBABILITY = np.ones(N)/N
+        if teleportation is None:
+            teleportation = UNIFORM_PROBABILITY
+        if transitions is None:
+            transitions = graph.transitionMatrix()
 
-        return prev_PR_vector
+        self.convergence = Convergence(self.epsilon, self.norm, self.maximum_iterations, plot,
+                                       label=f"{self.solver.name} ($N={N}$, $\\gamma = {self.gamma}$) $||\\cdot||_{self.norm}$")
+        return self.solver.solve(transitions, graph.dangling.astype(np.float64), teleportation, self.gamma, self.convergence)
 
 
 if __name__ == "__main__":
@@ -104,14 +391,17 @@ if __name__ == "__main__":
     g = LineGraph("PR-convergence")
 
     ###
-    # edges = readEdges(test)
+    # edges = Graph.fromEdgeFile(test)  # Only slow the first time.
 
     from irse.web.crawler import PATH_DATA_OUT, JACK
     crawler = JACK()
     edges = crawler.graphFromCrawl(PATH_DATA_OUT / "crawl-180417.json")
     ###
 
-    print(pr.getPageRankVector(edges, filter_sink_tail=True, plot=g))
+    for solver in [PowerIteration(), GaussSeidel(), QuadraticExtrapolation()]:
+        pr.solver = solver
+        print(pr.getPageRankVector(edges, filter_sink_tail=True, plot=g))
+        print(f"{solver.name}: {pr.convergence.iterations} iterations")
     g.commitWithArgs(
         LineGraph.ArgsGlobal(x_label="Iteration", y_label="Absolute change", legend_position="upper right"),
         LineGraph.ArgsPerLine(show_points=False)
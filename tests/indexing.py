@@ -1,7 +1,13 @@
-from irse.indexing.nonparametric import GammaCode, DeltaCode, OmegaCode, Simple9, VByte
+from irse.indexing.nonparametric import GammaCode, DeltaCode, OmegaCode, Simple9, VByte, Simple16, PForDelta, OptPForDelta
 from irse.indexing.parametric import GolombRiceCode
 from irse.indexing.contextual import InterpolativeCode
 from irse.indexing.huffman import HuffmanCode, LLRUN, HuffmanTree
+from irse.indexing.bits import PackedBitWriter
+
+import sys
+import time
+import numpy as np
+import numpy.random as npr
 
 
 def test_postings():
@@ -67,6 +73,305 @@ def test_huffman():
     print(list(l.decodeMany(l.encodeMany(postings))))
 
 
+def test_canonicalHuffman():
+    counts = {"c": 12, "d": 13, "a": 5, "b": 9, "e": 16, "f": 45}
+    h = HuffmanCode(canonical=True)
+    h.trainFromCounts(counts)
+    print(sorted(h.codebook_cache.items()))  # Same as the codebook of HuffmanTree.fromCanonicalCodebook in test_huffman().
+
+    h_tree = HuffmanCode()
+    h_tree.trainFromCounts(counts)
+    assert h.codebook_cache == HuffmanTree.fromCanonicalCodebook(h_tree.tree.getCodebookCanonical()).getCodebook()
+
+    words = ["a", "f", "b", "e", "d"]
+    h2 = HuffmanCode.fromCodeLengths(h.getCodeLengths())  # No tree needed.
+    assert list(h2.decodeMany(h.encodeMany(words))) == words
+    assert list(h2.decodeManyPacked(h.encodeManyPacked(words))) == words
+
+    postings = [69, 58, 1, 421, 1]
+    l = LLRUN(canonical=True)
+    l.train([1,2,3,54,50,10,20,40,50,60,40,4,5,7,545,7,54,754,8,4,54,2,45,755,57,154])
+    assert list(LLRUN.fromCodeLengths(l.getCodeLengths()).decodeMany(l.encodeMany(postings))) == postings
+
+    # A truncated input is an error, as with the tree, rather than zeroes that decode to some symbol. The second code has
+    # codewords longer than the lookup table, which are decoded with the limits instead.
+    short = HuffmanCode(canonical=True)
+    short.train("aaaaaaaabbbbccd")
+    fibonacci = [1, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233]
+    long = HuffmanCode(canonical=True)
+    long.trainFromCounts({chr(ord("a") + i): count for i, count in enumerate(fibonacci)})
+    assert len(long.codebook_cache["a"]) > 10
+    for code, word in [(short, "dd"), (long, "aa")]:
+        truncated = code.encodeMany(word)[:-1]
+        writer = PackedBitWriter()
+        writer.writeBits(truncated)
+        packed = writer.finish()
+        for decode in [lambda: list(code.decodeMany(truncated)), lambda: list(code.decodeManyPacked(packed))]:
+            try:
+                decode()
+                assert False
+            except EOFError:
+                pass
+
+
+def test_lengthLimitedHuffman():
+    fibonacci = [1, 1, 2, 3, 5, 8, 13, 21, 34, 55]  # The most skewed distribution there is: Huffman gives the rarest symbols 9 bits.
+    h = HuffmanCode(canonical=True, max_codeword_length=5)
+    h.trainFromCounts({chr(ord("a") + i): count for i, count in enumerate(fibonacci)})
+    print(sorted(h.codebook_cache.items()))
+    assert max(map(len, h.codebook_cache.values())) == 5
+
+    words = ["a", "j", "b", "e", "d"]
+    assert list(h.decodeMany(h.encodeMany(words))) == words
+
+
+def test_llrunPerKey():
+    posting_lists = {"the": [1, 1, 2, 1, 1, 3, 1], "aardvark": [1042, 3021], "language": [5, 20, 7, 64, 9]}
+    models = LLRUN.trainPerKey(((term, gap) for term, gaps in posting_lists.items() for gap in gaps), canonical=True)
+    for term, gaps in posting_lists.items():
+        print(term, models[term].codebook_cache)
+        assert list(models[term].decodeManyPacked(models[term].encodeArray(gaps))) == gaps
+
+
+def test_packing():
+    postings = [69, 58, 1, 421, 1]
+    ordered_postings = [2,9,12,14,19,21,31,32,33]
+
+    l = LLRUN()
+    l.train([1,2,3,54,50,10,20,40,50,60,40,4,5,7,545,7,54,754,8,4,54,2,45,755,57,154])
+    for code, numbers in [(GammaCode(), postings), (DeltaCode(), postings), (OmegaCode(), postings), (VByte(), postings),
+                          (Simple9(), postings), (GolombRiceCode(64), postings), (InterpolativeCode(), ordered_postings),
+                          (l, postings)]:
+        packed = code.encodeManyPacked(numbers)
+        print(type(code).__name__, packed.data, str(packed))
+        assert str(packed) == code.encodeMany(numbers)  # The string encoding is just a view on the packed encoding.
+        assert list(code.decodeManyPacked(packed)) == numbers
+
+    # 0 still takes a byte.
+    numbers = [0, 5, 0, 300, 0]
+    packed = VByte().encodeManyPacked(numbers)
+    assert str(packed) == VByte().encodeMany(numbers) and str(packed).startswith("10000000")
+    assert list(VByte().decodeManyPacked(packed)) == numbers
+    assert VByte().encodeArray(np.array(numbers)).data == packed.data
+
+    # Symbols without a codeword can't be written; skipping them would shift the rest of the stream.
+    h = HuffmanCode()
+    h.train("aab")
+    for code, unknown in [(h, "c"), (l, 2**20)]:
+        try:
+            code.encodeManyPacked([unknown])
+            assert False
+        except ValueError:
+            pass
+
+
+def _timeCode(code, numbers, packed: bool):
+    start = time.perf_counter()
+    encoding = code.encodeManyPacked(numbers) if packed else code.encodeMany(numbers)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n = sum(1 for _ in (code.decodeManyPacked(encoding) if packed else code.decodeMany(encoding)))
+    decode_time = time.perf_counter() - start
+    assert n == len(numbers)
+
+    size = encoding.nbytes if packed else sys.getsizeof(encoding)
+    return size, encode_time, decode_time
+
+
+def benchmark_packing(n: int=20_000):
+    """
+    Bytes per posting and throughput of the string encodings versus the packed encodings, on geometrically distributed
+    gaps (which is what you get when a term appears in each document independently). For reference: a raw int32 array
+    takes 4 bytes per posting.
+    """
+    gaps = [int(g) for g in npr.default_rng(0).geometric(p=0.05, size=n)]
+    doc_ids = [int(d) for d in npr.default_rng(0).geometric(p=0.05, size=n).cumsum()]
+
+    l = LLRUN()
+    l.train(gaps)
+    h = HuffmanCode()
+    h.train(map(str, gaps))
+    for code, numbers in [(GammaCode(), gaps), (DeltaCode(), gaps), (OmegaCode(), gaps), (VByte(), gaps), (Simple9(), gaps),
+                          (GolombRiceCode(16), gaps), (InterpolativeCode(), doc_ids), (l, gaps), (h, list(map(str, gaps)))]:
+        print(type(code).__name__)
+        for packed in [False, True]:
+            size, encode_time, decode_time = _timeCode(code, numbers, packed)
+            print(f"\t{'packed' if packed else 'string'}: {size/n:6.3f} bytes/posting, "
+                  f"encode {n/encode_time:10.0f} postings/s, decode {n/decode_time:10.0f} postings/s")
+
+
+def benchmark_decodingScaling():
+    """
+    Decoding time per posting should stay flat as posting lists get longer, since no decoder slices its input anymore.
+    """
+    rng = npr.default_rng(0)
+    for code in [GammaCode(), DeltaCode(), OmegaCode(), VByte(), Simple9(), GolombRiceCode(16), InterpolativeCode()]:
+        print(type(code).__name__)
+        for n in [10_000, 100_000, 1_000_000]:
+            numbers = [int(g) for g in rng.geometric(p=0.05, size=n)]
+            if isinstance(code, InterpolativeCode):
+                numbers = [int(d) for d in np.cumsum(numbers)]
+            encoding = code.encodeMany(numbers)
+
+            start = time.perf_counter()
+            for _ in code.decodeMany(encoding):
+                pass
+            print(f"\tn={n:>9}: {(time.perf_counter() - start)/n*1e6:.3f} us/posting")
+
+
+def test_vectorised():
+    gaps = npr.default_rng(0).geometric(p=0.05, size=1000).astype(np.uint64)
+    gaps[500] = 2**27  # One big outlier, which forces Simple-9 into its widest stride.
+    for code in [VByte(), Simple9(), GolombRiceCode(16)]:
+        packed = code.encodeArray(gaps)
+        assert list(code.decodeManyPacked(packed)) == gaps.tolist()  # Scalar decoder understands the vectorised encoder...
+        assert code.decodeArray(code.encodeManyPacked(gaps.tolist())).tolist() == gaps.tolist()  # ...and vice versa.
+
+
+def benchmark_vectorised(n: int=1_000_000):
+    gaps = npr.default_rng(0).geometric(p=0.05, size=n).astype(np.uint64)
+    as_list = gaps.tolist()
+    for code in [VByte(), Simple9(), GolombRiceCode(16)]:
+        start = time.perf_counter()
+        packed = code.encodeManyPacked(as_list)
+        scalar_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        list(code.decodeManyPacked(packed))
+        scalar_decode = time.perf_counter() - start
+
+        start = time.perf_counter()
+        packed = code.encodeArray(gaps)
+        vector_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        code.decodeArray(packed)
+        vector_decode = time.perf_counter() - start
+
+        print(type(code).__name__)
+        print(f"\tencode: {n/scalar_encode:11.0f} -> {n/vector_encode:11.0f} postings/s ({scalar_encode/vector_encode:.0f}x)")
+        print(f"\tdecode: {n/scalar_decode:11.0f} -> {n/vector_decode:11.0f} postings/s ({scalar_decode/vector_decode:.0f}x)")
+
+
+def test_blockCodecs():
+    gaps = npr.default_rng(0).geometric(p=0.05, size=1000).astype(np.uint64)
+    gaps[[10, 500, 501]] = 2**27  # Outliers.
+    for code in [Simple16(), PForDelta(), OptPForDelta()]:
+        packed = code.encodeArray(gaps)
+        print(type(code).__name__, f"{packed.n_bits/len(gaps):.2f} bits/posting")
+        assert packed == code.encodeManyPacked(gaps.tolist())
+        assert code.decodeArray(packed).tolist() == gaps.tolist()
+        assert list(code.decodeMany(code.encodeMany(gaps.tolist()))) == gaps.tolist()
+
+    # A 0 would be read back as padding, losing it and everything after it, so neither path accepts it.
+    for code in [Simple9(), Simple16()]:
+        for numbers in [[3, 0, 5], [2**28]]:
+            for encode in [code.encodeMany, lambda numbers: code.encodeArray(np.array(numbers, dtype=np.uint64))]:
+                try:
+                    encode(numbers)
+                    assert False
+                except ValueError:
+                    pass
+
+
+def _gapDistributions(n: int):
+    rng = npr.default_rng(0)
+    frequent = rng.geometric(p=0.2, size=n)   # Term in 1 out of 5 documents.
+    rare     = rng.geometric(p=0.001, size=n)  # Term in 1 out of 1000 documents.
+    clustered = np.where(rng.random(n) < 0.9, rng.geometric(p=0.5, size=n), rng.geometric(p=0.0001, size=n))  # Runs of nearby documents (e.g. crawled from the same site), and big jumps between runs.
+    return {"frequent": frequent.astype(np.uint64), "rare": rare.astype(np.uint64), "clustered": clustered.astype(np.uint64)}
+
+
+def benchmark_blockCodecs(n: int=1_000_000):
+    """
+    Compares the block codecs with the other codes on a few kinds of gap distributions. Codes with a vectorised
+    implementation are timed with it; the others with their packed scalar implementation.
+    """
+    for name, gaps in _gapDistributions(n).items():
+        print(name)
+        for code in [GammaCode(), DeltaCode(), GolombRiceCode(int(np.mean(gaps)*0.69) or 1), VByte(), Simple9(), Simple16(), PForDelta(), OptPForDelta()]:
+            vectorised = hasattr(code, "encodeArray")
+            numbers = gaps if vectorised else gaps[:n//10].tolist()  # The scalar codes are slow, so give them less.
+
+            start = time.perf_counter()
+            packed = code.encodeArray(numbers) if vectorised else code.encodeManyPacked(numbers)
+            encode_time = time.perf_counter() - start
+            start = time.perf_counter()
+            code.decodeArray(packed) if vectorised else list(code.decodeManyPacked(packed))
+            decode_time = time.perf_counter() - start
+
+            print(f"\t{type(code).__name__:>14}: {packed.n_bits/len(numbers):6.2f} bits/posting, "
+                  f"encode {len(numbers)/encode_time:10.0f} postings/s, decode {len(numbers)/decode_time:10.0f} postings/s")
+
+
+def benchmark_huffmanDecoding(n: int=200_000):
+    """
+    Tree-walking versus table-driven decoding, for alphabets with Zipfian frequencies.
+    """
+    rng = npr.default_rng(0)
+    for alphabet_size in [10, 100, 10_000]:
+        frequencies = 1/np.arange(1, alphabet_size+1)
+        words = [str(w) for w in rng.choice(alphabet_size, size=n, p=frequencies/frequencies.sum())]
+        print(f"Alphabet of {alphabet_size}:")
+        for canonical in [False, True]:
+            h = HuffmanCode(canonical=canonical)
+            h.train(words)
+            packed = h.encodeManyPacked(words)
+
+            start = time.perf_counter()
+            for _ in h.decodeManyPacked(packed):
+                pass
+            print(f"\t{'canonical' if canonical else 'tree':>9}: {n/(time.perf_counter() - start):10.0f} symbols/s")
+
+
+def benchmark_huffmanTraining():
+    """
+    Training time of tree-based and length-only Huffman training, and of length-limited training, for Zipfian alphabets.
+    """
+    for alphabet_size in [1_000, 10_000, 100_000, 1_000_000]:
+        counts = {f"term{i}": 10_000_000 // i + 1 for i in range(1, alphabet_size+1)}
+        print(f"Alphabet of {alphabet_size}:")
+        for name, h in [("tree", HuffmanCode()), ("lengths", HuffmanCode(canonical=True)), ("limited to 16", HuffmanCode(canonical=True, max_codeword_length=16))]:
+            if name == "limited to 16" and alphabet_size > 2**16:
+                continue
+            start = time.perf_counter()
+            h.trainFromCounts(counts)
+            print(f"\t{name:>13}: {time.perf_counter() - start:.3f} s, longest codeword {max(map(len, h.codebook_cache.values()))} bits")
+
+
+def test_interpolative():
+    i = InterpolativeCode()
+    assert i.encodeMany([2,9,12,14,19,21,31,32,33]) == "0001001010000011111011011000011000110100001"  # Lecture example.
+    for doc_ids in [[5], [7,8], [3,4,5], np.cumsum(npr.default_rng(0).integers(1, 50, size=5000)).tolist()]:
+        packed = i.encodeManyPacked(doc_ids)
+        assert list(i.decodeMany(i.encodeMany(doc_ids))) == doc_ids
+        assert i.decodeArray(packed).tolist() == doc_ids
+
+    # Lists far longer than the recursion limit, and several lists after each other.
+    long = np.cumsum(npr.default_rng(1).integers(1, 5, size=100_000))
+    writer = PackedBitWriter()
+    i.writeMany(long, writer)
+    i.writeMany([1,2,3], writer)
+    assert i.decodeArray(writer.finish()).tolist() == long.tolist() + [1,2,3]
+
+
+def benchmark_interpolative(n: int=2_000_000):
+    for name, gaps in _gapDistributions(n).items():
+        doc_ids = np.cumsum(gaps)
+        code = InterpolativeCode()
+
+        start = time.perf_counter()
+        writer = PackedBitWriter()
+        code.writeMany(doc_ids, writer)
+        packed = writer.finish()
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decoded = code.decodeArray(packed)
+        decode_time = time.perf_counter() - start
+        assert np.array_equal(decoded, doc_ids)
+        print(f"{name:>9}: {packed.n_bits/n:5.2f} bits/posting, encode {n/encode_time:9.0f} postings/s, decode {n/decode_time:9.0f} postings/s")
+
+
 if __name__ == "__main__":
     test_huffman()
     # test_postings()
@@ -0,0 +1,424 @@
+from irse.indexing.nonparametric import GammaCode, VByte, Simple9, Simple16, PForDelta
+from irse.indexing.parametric import GolombRiceCode
+from irse.indexing.contextual import InterpolativeCode
+from irse.indexing.inverted import InvertedIndex, IndexVersionError
+from irse.indexing.huffman import LLRUN
+from irse.indexing.spimi import SPIMI
+from irse.retrieval.scoring import BM25
+from irse.retrieval.caching import LRUCache, LFUCache
+from irse.retrieval.topk import WAND, MaxScore, BlockMaxWAND, TermAtATimeMaxScore
+from irse.retrieval.fusion import FusedRanking
+
+import os
+import re
+import time
+import tempfile
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import numpy.random as npr
+
+
+def _zipfianCorpus(n_documents: int, vocabulary_size: int=5000, average_length: int=100, seed: int=0):
+    rng = npr.default_rng(seed)
+    frequencies = 1/np.arange(1, vocabulary_size+1)
+    lengths = rng.poisson(average_length, size=n_documents) + 1
+    words = rng.choice(vocabulary_size, size=int(lengths.sum()), p=frequencies/frequencies.sum())
+    return [[f"w{w}" for w in document] for document in np.split(words, np.cumsum(lengths)[:-1])]
+
+
+def test_invertedIndex():
+    corpus = _zipfianCorpus(1000)
+    for code in [VByte(), GammaCode(), Simple9(), Simple16(), PForDelta(), GolombRiceCode(4), InterpolativeCode()]:
+        index = InvertedIndex.fromDocuments(corpus, code=code, block_size=64)
+        print(type(code).__name__, index.nbytes, "bytes")
+        assert index.n_documents == len(corpus)
+        assert index.document_lengths.tolist() == list(map(len, corpus))
+
+        for term in ["w0", "w1", "w10", "w4000"]:
+            expected = [(i, document.count(term)) for i, document in enumerate(corpus) if term in document]
+            documents, frequencies = index.postings(term)
+            assert list(zip(documents.tolist(), frequencies.tolist())) == expected
+            assert index.documentFrequency(term) == len(expected)
+
+            # Blocks can also be decoded without knowing about the blocks before them.
+            blocks = index.blockRange(term)
+            if blocks:
+                documents, _ = index.decodeBlock(blocks[-1])
+                assert documents[-1] == expected[-1][0]
+
+    assert "not a word" not in index
+    assert len(index.postings("not a word")[0]) == 0
+
+
+def test_savedIndex():
+    corpus = _zipfianCorpus(500) + [["héllo", "wörld", "héllo"]]
+    llrun = LLRUN()
+    llrun.train(range(1, 500))
+    canonical_llrun = LLRUN(canonical=True, max_codeword_length=6)
+    canonical_llrun.train(range(1, 500))
+    for code in [VByte(), InterpolativeCode(), llrun, canonical_llrun, GolombRiceCode(3), PForDelta(block_size=16, exception_ratio=0.2)]:
+        index = InvertedIndex.fromDocuments(corpus, code=code, block_size=32)
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "test.index"
+            index.save(path)
+            loaded = InvertedIndex.load(path)
+
+            # The codes are rebuilt from their parameters rather than unpickled.
+            assert type(loaded.code) == type(code) and loaded.code.parameters() == code.parameters()
+            assert list(loaded.lexicon) == list(index.lexicon)
+            assert loaded.document_lengths.tolist() == index.document_lengths.tolist()
+            for term in ["w0", "w1", "w333", "héllo", "not a word"]:
+                assert loaded.postings(term)[0].tolist() == index.postings(term)[0].tolist()
+                assert loaded.postings(term)[1].tolist() == index.postings(term)[1].tolist()
+            assert BM25(loaded).rank(["w5", "héllo"]) == BM25(index).rank(["w5", "héllo"])
+            del loaded  # Release the memory map before the folder is deleted.
+
+    # An index of another version is refused with an error of its own, so that callers know to rebuild it.
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "old.index"
+        index.save(path)
+        data = bytearray(path.read_bytes())
+        data[len(InvertedIndex.MAGIC)] -= 1
+        path.write_bytes(bytes(data))
+        try:
+            InvertedIndex.load(path)
+            assert False
+        except IndexVersionError:
+            pass
+
+
+def test_spimi():
+    corpus = _zipfianCorpus(1000)
+    for code in [VByte(), InterpolativeCode()]:
+        with tempfile.TemporaryDirectory() as folder:
+            InvertedIndex.fromDocuments(corpus, code=code, block_size=32).save(Path(folder) / "memory.index")
+            index = SPIMI(memory_budget=100_000, code=code, block_size=32).build(iter(corpus), Path(folder) / "spimi.index")  # About 100 runs.
+            assert (Path(folder) / "spimi.index").read_bytes() == (Path(folder) / "memory.index").read_bytes()
+            assert index.postings("w0")[0].tolist() == [i for i, document in enumerate(corpus) if "w0" in document]
+            del index
+
+            # Merging at most 3 runs at once takes four passes before the final merge, and gives the same index.
+            index = SPIMI(memory_budget=100_000, code=code, block_size=32, max_fan_in=3).build(iter(corpus), Path(folder) / "passes.index")
+            assert (Path(folder) / "passes.index").read_bytes() == (Path(folder) / "memory.index").read_bytes()
+            del index
+
+
+def _preprocess(text: str):
+    """Stand-in for OkapiRetrieval's preprocessing: tokenise, lowercase, and strip some suffixes."""
+    terms = []
+    for token in re.findall(r"\w+", text.lower()):
+        for suffix in ["ing", "es", "s"]:
+            if token.endswith(suffix) and len(token) > len(suffix) + 2:
+                token = token[:-len(suffix)]
+                break
+        terms.append(token)
+    return terms
+
+
+def test_parallelSpimi():
+    texts = [" ".join(document) for document in _zipfianCorpus(1000)]
+    with tempfile.TemporaryDirectory() as folder:
+        serial   = SPIMI(memory_budget=100_000).build(texts, Path(folder) / "serial.index", preprocess=_preprocess)
+        parallel = SPIMI(memory_budget=100_000).build(iter(texts), Path(folder) / "parallel.index", preprocess=_preprocess, processes=2, batch_size=150)
+        assert (Path(folder) / "serial.index").read_bytes() == (Path(folder) / "parallel.index").read_bytes()
+        del serial, parallel
+
+        # Small batches give a run each, more than can be merged at once.
+        batched = SPIMI(memory_budget=100_000, max_fan_in=4).build(iter(texts), Path(folder) / "batched.index", preprocess=_preprocess, processes=2, batch_size=50)
+        assert (Path(folder) / "serial.index").read_bytes() == (Path(folder) / "batched.index").read_bytes()
+        del batched
+
+
+def test_lruCache():
+    cache = LRUCache(max_size=2)
+    calls = []
+    compute = lambda key: calls.append(key) or key.upper()
+    assert [cache.get(key, compute) for key in ["a", "b", "a", "c", "b", "a"]] == ["A", "B", "A", "C", "B", "A"]
+    assert calls == ["a", "b", "c", "b", "a"]  # "b" was the least recently used when "c" came in.
+    assert (cache.hits, cache.misses) == (1, 5)
+
+    # Zipfian tokens hit a small cache most of the time: a tenth of the vocabulary covers about two thirds of the tokens.
+    cache = LRUCache(max_size=500)
+    for document in _zipfianCorpus(200):
+        for token in document:
+            cache.get(token, str.upper)
+    print(f"Hit rate: {cache.hit_rate:.1%}")
+    assert cache.hit_rate > 0.6
+
+    # Bounded in bytes: the values are strings, and their length is their size.
+    cache = LRUCache(max_size=100, max_bytes=10, sizeof=len)
+    for key in ["aaaa", "bbbb", "cc", "dddd", "e"*20]:
+        cache.put(key, key)
+    assert [key for key, _ in cache.items()] == ["bbbb", "cc", "dddd"] and cache.n_bytes == 10  # Too big a value isn't cached at all.
+
+
+def test_lfuCache():
+    cache = LFUCache(max_size=2)
+    calls = []
+    compute = lambda key: calls.append(key) or key.upper()
+    for key in ["a", "a", "b", "c", "a", "b"]:
+        cache.get(key, compute)
+    assert calls == ["a", "b", "c", "b"]  # "c" evicted "b" and then "b" evicted "c", because "a" was used more often than either.
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert [key for key, _ in cache.items()] == ["b", "a"]
+
+    # A new key that becomes popular gets in, even when everything in the cache has been used more often.
+    cache = LFUCache(max_size=2)
+    for key in ["a", "a", "b", "b", "hot", "hot", "hot"]:
+        cache.get(key, str.upper)
+    assert "hot" in cache and cache.hits == 4
+
+    cache = LFUCache(max_size=4, max_bytes=10, sizeof=len)
+    for key in ["aaa", "aaa", "bbb", "ccc", "ddd"]:
+        cache.get(key, str.upper)
+    assert [key for key, _ in cache.items()] == ["ccc", "ddd", "aaa"]
+    cache.clear()
+    assert len(cache) == 0 and cache.n_bytes == 0
+
+    # Popular keys survive a scan of keys that are only used once. Not so with LRU.
+    popular = [f"popular{i}" for i in range(5)]
+    for cache, expected_hits in [(LRUCache(max_size=10), 0), (LFUCache(max_size=10), 5)]:
+        for _ in range(3):
+            for key in popular:
+                cache.get(key, str.upper)
+        for i in range(100):
+            cache.get(f"scan{i}", str.upper)
+        cache.resetStatistics()
+        for key in popular:
+            cache.get(key, str.upper)
+        assert cache.hits == expected_hits
+
+
+def test_bm25():
+    from rank_bm25 import BM25Okapi
+
+    corpus = _zipfianCorpus(500)
+    reference = BM25Okapi(corpus)
+    bm25 = BM25(InvertedIndex.fromDocuments(corpus))
+    for query in [["w0"], ["w3", "w40", "w3"], ["w100", "w2000", "not a word"], ["not a word"]]:
+        documents, scores = bm25.scores(query)
+        expected = reference.get_scores(query)
+        assert np.allclose(scores, expected[documents])
+        assert np.all(np.delete(expected, documents) == 0)  # Documents that aren't touched really have score 0.
+
+        ranking = bm25.rank(query, truncate_at=10)
+        expected_ranking = sorted(filter(lambda x: x[1] > 0, enumerate(expected)), key=lambda x: x[1], reverse=True)[:10]
+        assert [i for i, _ in ranking] == [i for i, _ in expected_ranking]
+
+
+def test_topk():
+    corpus = _zipfianCorpus(3000, vocabulary_size=2000)
+    rng = npr.default_rng(2)
+    queries = [["w0"], ["w3", "w40", "w3"], ["w100", "w1500", "not a word"], ["not a word"], ["w1", "w2", "w1", "w1"]] \
+            + [[f"w{w}" for w in rng.integers(0, 2000, size=n)] for n in [2, 5, 10, 20, 40]]
+    for code in [VByte(), InterpolativeCode()]:
+        bm25 = BM25(InvertedIndex.fromDocuments(corpus, code=code, block_size=32))
+        for algorithm in [WAND(bm25), MaxScore(bm25), BlockMaxWAND(bm25), TermAtATimeMaxScore(bm25)]:
+            for query in queries:
+                for k in [1, 10, 100, 5000]:
+                    assert algorithm.rank(query, k) == bm25.rank(query, truncate_at=k), (type(algorithm).__name__, query, k)
+
+
+def _fusedReference(bm25: BM25, static_scores: np.ndarray, query, bm25_weight: float, static_weight: float, k: int):
+    """Scores every document that contains a query term, and sorts all of them."""
+    documents, scores = bm25.scores(query)
+    scores = bm25_weight * scores + static_weight * static_scores[documents]
+    order = np.lexsort((documents, -scores))[:k]
+    return list(zip(documents[order].tolist(), scores[order].tolist()))
+
+
+def test_fusedRanking():
+    corpus = _zipfianCorpus(3000, vocabulary_size=2000)
+    index = InvertedIndex.fromDocuments(corpus, block_size=32)
+    bm25 = BM25(index)
+    static_scores = npr.default_rng(6).pareto(1.5, size=len(corpus))  # Heavy-tailed, like PageRank.
+    static_scores[::7] = 1.0  # Plenty of ties.
+
+    with tempfile.TemporaryDirectory() as folder:
+        FusedRanking(index, static_scores, chunk_size=100, save_to=Path(folder) / "fused.index")
+        for bm25_weight, static_weight in [(1.0, 0.0), (1.0, 1.0), (0.1, 10.0), (0.0, 1.0)]:
+            fused = FusedRanking.load(Path(folder) / "fused.index", bm25_weight, static_weight, chunk_size=100)
+            for query in [["w0"], ["w3", "w40", "w3"], ["w100", "w1500", "not a word"], ["not a word"], ["w5", "w50", "w500", "w1999"]]:
+                for k in [1, 10, 5000]:
+                    assert fused.rank(query, k) == _fusedReference(bm25, static_scores, query, bm25_weight, static_weight, k)
+            del fused
+
+
+def test_rankMany():
+    corpus = _zipfianCorpus(1000)
+    bm25 = BM25(InvertedIndex.fromDocuments(corpus))
+    rng = npr.default_rng(4)
+    queries = [["w0"], ["w3", "w40", "w3"], [], ["not a word"], ["w1", "w1"]] + [[f"w{w}" for w in rng.integers(0, 5000, size=rng.integers(1, 10))] for _ in range(300)]
+    for k in [None, 0, 1, 10, 1000]:
+        assert bm25.rankMany(queries, truncate_at=k, batch_size=64) == [bm25.rank(query, truncate_at=k) for query in queries]
+
+    # Terms are dropped after the last batch that uses them, but never decoded twice.
+    decoded = []
+    term_scores = bm25.termScores
+    bm25.termScores = lambda term: decoded.append(term) or term_scores(term)
+    bm25.rankMany(queries, batch_size=64)
+    assert sorted(decoded) == sorted({term for query in queries for term in query})
+
+
+def benchmark_bm25():
+    """
+    Query latency of rank_bm25 (which scores every document) versus scoring through the inverted index.
+    """
+    from rank_bm25 import BM25Okapi
+
+    rng = npr.default_rng(1)
+    for n_documents in [1_000, 10_000, 50_000]:
+        corpus = _zipfianCorpus(n_documents, vocabulary_size=50_000)
+        reference = BM25Okapi(corpus)
+        bm25 = BM25(InvertedIndex.fromDocuments(corpus))
+        queries = [[f"w{w}" for w in rng.integers(20, 50_000, size=3)] for _ in range(20)]
+
+        start = time.perf_counter()
+        for query in queries:
+            reference.get_scores(query)
+        reference_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        for query in queries:
+            bm25.rank(query)
+        index_time = (time.perf_counter() - start) / len(queries)
+        print(f"{n_documents:>6} documents: rank_bm25 {1000*reference_time:8.2f} ms/query, inverted index {1000*index_time:6.2f} ms/query")
+
+
+def benchmark_topk(n_documents: int=50_000, k: int=10):
+    """
+    Latency of exhaustive scoring versus dynamic pruning, for queries of growing length.
+    """
+    corpus = _zipfianCorpus(n_documents, vocabulary_size=50_000)
+    bm25 = BM25(InvertedIndex.fromDocuments(corpus))
+    bm25.average_idf  # Computed on first use, which shouldn't count towards whichever algorithm runs first.
+    algorithms = [("exhaustive", lambda query, k: bm25.rank(query, truncate_at=k)),
+                  ("WAND", WAND(bm25).rank), ("MaxScore", MaxScore(bm25).rank), ("BMW", BlockMaxWAND(bm25).rank),
+                  ("TAAT MaxScore", TermAtATimeMaxScore(bm25).rank)]
+
+    rng = npr.default_rng(3)
+    for length in [2, 5, 10, 20, 50]:
+        queries = [[f"w{w}" for w in rng.integers(0, 5_000, size=length)] for _ in range(10)]
+        timings = []
+        for name, rank in algorithms:
+            start = time.perf_counter()
+            for query in queries:
+                rank(query, k)
+            timings.append(f"{name} {1000*(time.perf_counter() - start)/len(queries):7.2f} ms")
+        print(f"{length:>2} terms:", " | ".join(timings))
+
+
+def benchmark_rankMany(n_documents: int=50_000, n_queries: int=2000, k: int=10):
+    """
+    Throughput of answering many queries one by one versus all at once.
+    """
+    corpus = _zipfianCorpus(n_documents, vocabulary_size=50_000)
+    bm25 = BM25(InvertedIndex.fromDocuments(corpus))
+    bm25.average_idf
+
+    rng = npr.default_rng(5)
+    queries = [[f"w{w}" for w in rng.zipf(1.2, size=rng.integers(1, 6)) if w < 50_000] for _ in range(n_queries)]
+
+    start = time.perf_counter()
+    for query in queries:
+        bm25.rank(query, truncate_at=k)
+    one_by_one = n_queries / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    bm25.rankMany(queries, truncate_at=k)
+    batched = n_queries / (time.perf_counter() - start)
+    print(f"One by one: {one_by_one:8.0f} queries/s")
+    print(f"Batched:    {batched:8.0f} queries/s")
+
+
+def benchmark_fusedRanking(n_documents: int=50_000, k: int=10):
+    """
+    Latency of scoring all documents that match the query and then sorting by combined score, versus stopping early.
+    """
+    corpus = _zipfianCorpus(n_documents, vocabulary_size=50_000)
+    index = InvertedIndex.fromDocuments(corpus)
+    bm25 = BM25(index)
+    bm25.average_idf
+    static_scores = npr.default_rng(7).pareto(1.5, size=n_documents)
+
+    rng = npr.default_rng(8)
+    queries = [[f"w{w}" for w in rng.integers(0, 5_000, size=3)] for _ in range(20)]
+    for static_weight in [0.1, 1.0, 10.0]:
+        fused = FusedRanking(index, static_scores, static_weight=static_weight)
+        fused.bm25.average_idf
+
+        start = time.perf_counter()
+        for query in queries:
+            _fusedReference(bm25, static_scores, query, 1.0, static_weight, k)
+        exhaustive = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        for query in queries:
+            fused.rank(query, k)
+        early = (time.perf_counter() - start) / len(queries)
+        print(f"Static weight {static_weight:>4}: exhaustive {1000*exhaustive:6.2f} ms/query, early termination {1000*early:6.2f} ms/query")
+
+
+def benchmark_startup(n_documents: int=50_000):
+    """
+    Time until the first query is answered: building the index from the corpus versus opening a saved one.
+    """
+    corpus = _zipfianCorpus(n_documents, vocabulary_size=50_000)
+    query = ["w30", "w4000"]
+
+    start = time.perf_counter()
+    index = InvertedIndex.fromDocuments(corpus)
+    BM25(index).rank(query)
+    print(f"Build: {time.perf_counter() - start:.3f} s")
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "benchmark.index"
+        index.save(path)
+
+        start = time.perf_counter()
+        loaded = InvertedIndex.load(path)
+        BM25(loaded).rank(query)
+        print(f"Load:  {1000*(time.perf_counter() - start):.3f} ms ({path.stat().st_size/1e6:.1f} MB on disk)")
+        del loaded
+
+
+def benchmark_spimi():
+    """
+    Peak memory (as seen by tracemalloc) of in-memory inversion versus SPIMI with a fixed budget, for growing corpora.
+    The corpus itself is generated lazily, so it doesn't count.
+    """
+    def lazyCorpus(n_documents: int):
+        for seed in range(n_documents // 1000):
+            yield from _zipfianCorpus(1000, vocabulary_size=50_000, seed=seed)
+
+    for n_documents in [5_000, 10_000, 20_000]:
+        with tempfile.TemporaryDirectory() as folder:
+            for name, build in [("in memory", lambda: InvertedIndex.fromDocuments(lazyCorpus(n_documents))),
+                                ("SPIMI, 16 MiB", lambda: SPIMI(memory_budget=16*2**20).build(lazyCorpus(n_documents), Path(folder) / "spimi.index"))]:
+                tracemalloc.start()
+                start = time.perf_counter()
+                index = build()
+                duration = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f"{n_documents:>6} documents, {name:>13}: peak {peak/2**20:6.1f} MiB, {duration:.1f} s")
+                del index
+
+
+def benchmark_parallelSpimi(n_documents: int=20_000):
+    """
+    Indexing throughput (documents per second, preprocessing included) for 1 process up to as many processes as there are cores.
+    """
+    texts = [" ".join(document) for document in _zipfianCorpus(n_documents, vocabulary_size=50_000)]
+    with tempfile.TemporaryDirectory() as folder:
+        for processes in range(1, (os.cpu_count() or 1) + 1):
+            start = time.perf_counter()
+            index = SPIMI().build(texts, Path(folder) / f"{processes}.index", preprocess=_preprocess, processes=processes, batch_size=1000)
+            duration = time.perf_counter() - start
+            print(f"{processes:>2} processes: {n_documents/duration:8.0f} documents/s")
+            del index
+
+
+if __name__ == "__main__":
+    benchmark_bm25()
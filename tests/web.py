@@ -1,8 +1,18 @@
+import time
+import tempfile
+import tracemalloc
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
 import numpy.random as npr
 
 from irse.web.crawler import *
-from irse.web.pagerank import PageRank
+from irse.web.pagerank import PageRank, PowerIteration, GaussSeidel, QuadraticExtrapolation, readEdges
+from irse.web.graph import Graph
+from irse.web.hits import HITS, QueryTimeHITS
 from irse.retrieval.bm25 import OkapiRetrieval
+from irse.retrieval.fusion import FusedRanking
+from irse.indexing.inverted import IndexVersionError
 
 
 def exampleCrawl():
@@ -11,14 +21,89 @@ def exampleCrawl():
     return crawler.crawl("https://en.wikipedia.org/wiki/Language", max_crawls=100)
 
 
-def exampleRanking(path: Path, use_pagerank=True, use_filterrank=False):
+class _Site:
+    """
+    A local stand-in for a website, served from a thread. Page k links to pages 2k+1 and 2k+2 of the same site and to
+    page k of the other sites. Every response takes a fixed amount of time, and the time of every request is kept.
+    """
+
+    def __init__(self, latency: float=0.0):
+        site = self
+        self.latency = latency
+        self.request_times: List[float] = []
+        self.others: List["_Site"] = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.request_times.append(time.monotonic())
+                time.sleep(site.latency)
+                k = int(self.path.strip("/") or 0)
+                links = [f"/{2*k+1}", f"/{2*k+2}"] + [f"{other.url}/{k}" for other in site.others]
+                html = f"<html><head><title>Page {k}</title></head><body><p>{' '.join(['word'] * 25)} {k}</p>" \
+                       + "".join(f'<a href="{link}">link</a>' for link in links) + "</body></html>"
+                body = html.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _crawlSites(crawler: JACK, n_sites: int, max_crawls: int, latency: float=0.0) -> Tuple[dict, List[_Site], float]:
+    sites = [_Site(latency) for _ in range(n_sites)]
+    for site in sites:
+        site.others = [other for other in sites if other is not site]
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            path = crawler.crawl(sites[0].url + "/0", max_crawls=max_crawls, output=Path(folder) / "crawl.json")
+            duration = time.perf_counter() - start
+            with open(path, "r", encoding="utf-8") as handle:
+                return json.load(handle), sites, duration
+    finally:
+        for site in sites:
+            site.close()
+
+
+def exampleRanking(path: Path, use_pagerank=True, use_filterrank=False, pagerank_weight: float=1.0):
     # Filter
-    corpus = list(JACK.corpusFromCrawl(path))   # Brace yourselves, this may be a lot.
-    ir = OkapiRetrieval(corpus)
+    index_path = path.with_suffix(".index")
+    ir = None
+    if index_path.exists():  # Only the first run has to tokenise and lemmatise the corpus.
+        try:
+            ir = OkapiRetrieval.load(index_path)
+        except IndexVersionError:  # Written by an older version of the code, so it is built again.
+            pass
+    if ir is None:  # The corpus is streamed into an index on disk, so it never has to fit in memory.
+        ir = OkapiRetrieval(JACK.corpusFromCrawl(path), save_to=index_path)
 
-    # Ranker
-    pr = PageRank(teleportation_probability=0.15)
-    ranks = pr.getPageRankVector(JACK.graphFromCrawl(path))
+    # Ranker. Rather than re-sorting the top BM25 results by PageRank, both are combined while retrieving, using a copy
+    # of the index in which the pages are renumbered by PageRank.
+    bm25_weight     = 1.0 if use_filterrank else 0.0
+    pagerank_weight = pagerank_weight if use_pagerank else 0.0
+    ranker_path = path.with_suffix(".pagerank.index")
+    ranker = None
+    if ranker_path.exists():
+        try:
+            ranker = FusedRanking.load(ranker_path, bm25_weight, pagerank_weight)
+        except IndexVersionError:
+            pass
+    if ranker is None:
+        n_pages = ir.index.n_documents
+        pr = PageRank(teleportation_probability=0.15)
+        ranks = pr.getPageRankVector(JACK.graphFromCrawl(path), nodes=n_pages)[:n_pages]
+        ranker = FusedRanking(ir.index, n_pages*ranks, bm25_weight, pagerank_weight, save_to=ranker_path)
 
     while True:
         print("="*79)
@@ -26,19 +111,435 @@ def exampleRanking(path: Path, use_pagerank=True, use_filterrank=False):
         while not query:
             query = input("Query: ")
 
-        ids_and_scores = ir.filter(query, truncate_at=50)
-        filter_set = [i for i, _ in ids_and_scores]
+        # Output 5 most relevant. Only those documents are kept while streaming over the corpus.
+        top = [i for i, _ in ranker.rank(ir.preprocessor(query), truncate_at=5)]
+        documents = {i: document for i, document in enumerate(JACK.corpusFromCrawl(path)) if i in top}
+        for n,i in enumerate(top):
+            print("="*35, "MATCH", n+1, "="*35)
+            print(documents[i])
 
-        # Re-rank
-        if not use_filterrank:
-            npr.shuffle(filter_set)
-        if use_pagerank:
-            filter_set.sort(key=lambda i: ranks[i], reverse=True)  # Highest-PR first.
 
-        # Output 5 most relevant.
-        for n,i in enumerate(filter_set[:5]):
-            print("="*35, "MATCH", n+1, "="*35)
-            print(corpus[i])
+def _randomGraph(n_nodes: int, n_edges: int, seed: int=0) -> Dict[int, List[int]]:
+    """Links go preferably to low IDs, so that some pages are much more popular than others. Some pages have no links."""
+    rng = npr.default_rng(seed)
+    sources      = rng.integers(0, n_nodes, size=n_edges)
+    destinations = np.minimum(rng.zipf(1.5, size=n_edges) - 1, n_nodes + 10)  # A few links go to pages that weren't crawled.
+    graph = {source: [] for source in range(0, n_nodes, 7)}
+    for source, destination in zip(sources.tolist(), destinations.tolist()):
+        graph.setdefault(source, []).append(destination)
+    return graph
+
+
+def _localGraph(n_nodes: int, n_edges: int, seed: int=0) -> Dict[int, List[int]]:
+    """Links only go to pages with a nearby ID, so that PageRank takes many clicks to spread over the graph."""
+    rng = npr.default_rng(seed)
+    sources      = rng.integers(0, n_nodes, size=n_edges)
+    destinations = np.clip(sources + rng.integers(-20, 21, size=n_edges), 0, n_nodes-1)
+    graph = dict()
+    for source, destination in zip(sources.tolist(), destinations.tolist()):
+        graph.setdefault(source, []).append(destination)
+    return graph
+
+
+def _loopPageRank(pr: PageRank, edges: Dict[int, List[int]], N: int) -> np.ndarray:
+    """The summation form of PageRank, one edge at a time. Pages without out-links spread their PageRank uniformly."""
+    prev_PR_vector = np.ones(N)/N
+    absolute_deviation = np.inf
+    for i in range(pr.maximum_iterations):
+        if absolute_deviation < pr.epsilon:
+            break
+        current_PR_vector = np.zeros(N)
+        for source in edges:
+            for destination in edges[source]:
+                current_PR_vector[destination] += prev_PR_vector[source] / len(edges[source])
+        current_PR_vector += (1 - np.sum(current_PR_vector)) / N  # Whatever didn't go anywhere is at a dangling page.
+        current_PR_vector = pr.gamma*current_PR_vector + (1-pr.gamma)*np.ones(N)/N
+        absolute_deviation = np.linalg.norm(current_PR_vector - prev_PR_vector, ord=pr.norm)
+        prev_PR_vector = current_PR_vector
+    return prev_PR_vector
+
+
+def test_crawler():
+    crawl, sites, _ = _crawlSites(JACK(max_in_flight=4, requests_per_second_per_host=1000), n_sites=2, max_crawls=20)
+    assert list(crawl) == [str(i) for i in range(20)]
+    assert crawl["0"]["url"] == sites[0].url + "/0" and crawl["0"]["title"] == "Page 0"
+
+    # Every outlink is the ID of a crawled page that the page links to.
+    ids = {page["url"]: int(i) for i, page in crawl.items()}
+    for page in crawl.values():
+        k = int(page["url"].rsplit("/", 1)[1])
+        site = next(site for site in sites if page["url"].startswith(site.url))
+        links = [f"{site.url}/{2*k+1}", f"{site.url}/{2*k+2}"] + [f"{other.url}/{k}" for other in site.others]
+        assert page["outlinks"] == sorted(ids[link] for link in links if link in ids)
+        assert page["body"].endswith(f" {k}")
+
+    # Without truncation, links to pages that weren't crawled get IDs after the crawled ones.
+    crawl, _, _ = _crawlSites(JACK(truncate_outlinks=False, max_in_flight=1, requests_per_second_per_host=1000), n_sites=1, max_crawls=5)
+    assert [page["outlinks"] for page in crawl.values()] == [[1, 2], [3, 4], [5, 6], [7, 8], [9, 10]]
+
+
+def test_crawlerPoliteness():
+    # Many requests at once, but every host gets at most 10 per second.
+    crawl, sites, duration = _crawlSites(JACK(max_in_flight=8, requests_per_second_per_host=10), n_sites=2, max_crawls=16)
+    assert len(crawl) == 16
+    for site in sites:
+        assert np.all(np.diff(site.request_times) >= 0.1 - 0.01)
+    assert duration >= 0.7 - 0.01  # 8 requests per host, the first one immediately.
+
+    # With slow servers, more requests in flight means more pages per second.
+    _, _, sequential = _crawlSites(JACK(max_in_flight=1, requests_per_second_per_host=1000), n_sites=1, max_crawls=24, latency=0.05)
+    _, _, concurrent = _crawlSites(JACK(max_in_flight=8, requests_per_second_per_host=1000), n_sites=1, max_crawls=24, latency=0.05)
+    assert concurrent < sequential / 2
+
+
+def test_pagerank():
+    edges = _randomGraph(500, 3000)
+    edges[3].extend([4, 4])  # Repeated links count double.
+    pr = PageRank(teleportation_probability=0.15, max_iterations=50, norm=1)
+
+    N = max(max(edges), max(d for destinations in edges.values() for d in destinations)) + 1
+    assert np.allclose(pr.getPageRankVector(edges), _loopPageRank(pr, edges, N))
+    assert np.allclose(pr.getPageRankVector(edges, nodes=N+5), _loopPageRank(pr, edges, N+5))
+
+    N = max(edges) + 1
+    truncated = {source: [d for d in destinations if d < N] for source, destinations in edges.items()}
+    assert np.allclose(pr.getPageRankVector(edges, filter_sink_tail=True), _loopPageRank(pr, truncated, N))
+
+
+def test_compactPagerank():
+    edges = _randomGraph(300, 2000)
+    pr = PageRank(teleportation_probability=0.15, max_iterations=50)
+
+    # Spread the IDs out. Compacting them again should give the same PageRanks as numbering them 0, 1, 2, ... to begin with.
+    spread = lambda node: 10**9 + 1000*node
+    spread_edges = {spread(source): [spread(d) for d in destinations] for source, destinations in edges.items()}
+    ranks = pr.getPageRanks(spread_edges)
+
+    ids = sorted(set(edges) | {d for destinations in edges.values() for d in destinations})
+    dense = {node: i for i, node in enumerate(ids)}
+    vector = pr.getPageRankVector({dense[source]: [dense[d] for d in destinations] for source, destinations in edges.items()})
+    assert list(ranks) == [spread(node) for node in ids]
+    assert np.allclose(list(ranks.values()), vector)
+    assert np.isclose(sum(ranks.values()), 1)
+
+
+def test_pagerankSolvers():
+    edges = _localGraph(500, 2500)
+    graph = Graph.fromDict(edges)
+    N = graph.n_nodes
+
+    # Exact solution of x = gamma (T x + (d . x) v) + (1-gamma) v, with v uniform.
+    gamma = 0.85
+    matrix = graph.transitionMatrix().toarray() + np.outer(np.ones(N)/N, graph.dangling)
+    exact = np.linalg.solve(np.eye(N) - gamma*matrix, (1-gamma)*np.ones(N)/N)
+
+    iterations = dict()
+    for solver in [PowerIteration(), GaussSeidel(), QuadraticExtrapolation()]:
+        pr = PageRank(teleportation_probability=1-gamma, max_iterations=1000, norm=1, epsilon=1e-12, solver=solver)
+        assert np.allclose(pr.getPageRankVector(edges), exact, rtol=0, atol=1e-10)
+        assert pr.convergence.converged
+        iterations[solver.name] = pr.convergence.iterations
+    print(iterations)
+    assert iterations[GaussSeidel.name] < iterations[PowerIteration.name]
+    assert iterations[QuadraticExtrapolation.name] < iterations[PowerIteration.name]
+
+
+def test_personalizedPagerank():
+    edges = _localGraph(400, 2000)
+    graph = Graph.fromDict(edges)
+    N = graph.n_nodes
+    gamma = 0.85
+    matrix = graph.transitionMatrix().toarray()
+
+    rng = npr.default_rng(0)
+    teleportation = PageRank.teleportToSeeds([rng.choice(N, size=3).tolist() for _ in range(9)], N)
+    teleportation = np.vstack((teleportation, np.ones(N), rng.random((2, N))))
+    for solver in [PowerIteration(), GaussSeidel(), QuadraticExtrapolation()]:
+        pr = PageRank(teleportation_probability=1-gamma, max_iterations=1000, norm=1, epsilon=1e-12, solver=solver)
+        ranks = pr.getPersonalizedPageRankVectors(edges, teleportation, batch_size=5)
+        assert ranks.shape == (12, N)
+        for v, x in zip(teleportation, ranks):
+            v = v / v.sum()  # Dangling pages teleport according to the same distribution.
+            exact = np.linalg.solve(np.eye(N) - gamma*(matrix + np.outer(v, graph.dangling)), (1-gamma)*v)
+            assert np.allclose(x, exact, rtol=0, atol=1e-10)
+        assert np.allclose(ranks[9], pr.getPageRankVector(edges), rtol=0, atol=1e-10)
+
+    # A surfer that starts at an isolated page, and teleports back to it, never leaves it.
+    ranks = PageRank(teleportation_probability=0.15).getPersonalizedPageRankVectors(edges, PageRank.teleportToSeeds([[N+1]], N+2))
+    assert np.allclose(ranks, np.eye(N+2)[[N+1]])
+
+
+def _grow(edges: Dict[int, List[int]], n_new: int, seed: int=1) -> Dict[int, List[int]]:
+    """Adds pages after the highest ID, with links to and from the pages just before them, like a crawl that went on."""
+    rng = npr.default_rng(seed)
+    grown = {source: list(destinations) for source, destinations in edges.items()}
+    first = max(edges) + 1
+    for page in range(first, first + n_new):
+        grown[page] = rng.integers(max(0, page-30), page+20, size=10).tolist()
+        for source in rng.integers(max(0, page-30), page, size=3).tolist():
+            grown.setdefault(source, []).append(page)
+    return grown
+
+
+def test_incrementalPagerank():
+    edges = _localGraph(2000, 10_000)
+    pr = PageRank(teleportation_probability=0.15, max_iterations=1000, norm=1, epsilon=1e-13)
+    previous = pr.getPageRankVector(edges)
+
+    # Nothing changed, so there is nothing to correct.
+    assert np.allclose(pr.updatePageRankVector(previous, edges), previous, rtol=0, atol=1e-12)
+    assert pr.pushes == 0
+
+    grown = _grow(edges, 50)
+    exact = pr.getPageRankVector(grown)
+    recomputation = pr.convergence.iterations * len(exact)  # Every iteration visits every node.
+    updated = pr.updatePageRankVector(previous, grown, tolerance=1e-12)
+    assert np.abs(updated - exact).sum() < 1e-8
+    assert pr.pushes < recomputation / 5
+
+    # Same with IDs that aren't node indices. Pages that disappear from the graph are dropped.
+    spread = lambda node: 10**9 + 1000*node
+    spread_edges = {spread(source): [spread(d) for d in destinations] for source, destinations in grown.items()}
+    previous = pr.getPageRanks({spread(source): [spread(d) for d in destinations] for source, destinations in edges.items()})
+    previous[1] = 0.5
+    updated = pr.updatePageRanks(previous, spread_edges, tolerance=1e-12)
+    exact = pr.getPageRanks(spread_edges)
+    assert list(updated) == list(exact)
+    assert np.abs(np.array(list(updated.values())) - np.array(list(exact.values()))).sum() < 1e-8
+
+
+def test_hits():
+    # Three hubs that link to the same authority, and one that also links to another page.
+    hubs, authorities = HITS(max_iterations=100, epsilon=1e-12).getHITSVectors({1: [0], 2: [0, 0], 3: [0], 4: [0, 5]})
+    eigenvector = np.array([1, (np.sqrt(13) - 3)/2])  # Of A^T A restricted to pages 0 and 5, which is [[4, 1], [1, 1]].
+    assert np.allclose(authorities[[0,5]], eigenvector / eigenvector.sum()) and np.all(authorities[1:5] == 0)
+    assert hubs[4] > hubs[1] == hubs[2] == hubs[3] and hubs[0] == hubs[5] == 0 and np.isclose(hubs.sum(), 1)
+
+    # On a bigger graph, the principal eigenvectors of A A^T and A^T A.
+    edges = _randomGraph(300, 1500)
+    hits = HITS(max_iterations=1000, norm=1, epsilon=1e-14)
+    hubs, authorities = hits.getHITSVectors(edges)
+    assert hits.convergence.converged
+    links = (Graph.fromDict(edges).adjacency.toarray() > 0).astype(float)
+    for matrix, vector in [(links @ links.T, hubs), (links.T @ links, authorities)]:
+        eigenvector = np.abs(np.linalg.eigh(matrix)[1][:,-1])
+        assert np.allclose(vector, eigenvector / eigenvector.sum(), rtol=0, atol=1e-10)
+
+    spread = lambda node: 10**9 + 1000*node
+    hub_dict, authority_dict = hits.getHubsAndAuthorities({spread(source): [spread(d) for d in destinations] for source, destinations in edges.items()})
+    present = sorted(set(edges) | {d for destinations in edges.values() for d in destinations})
+    assert list(authority_dict) == [spread(node) for node in present]
+    assert np.allclose(list(authority_dict.values()), authorities[present])
+    assert np.allclose(list(hub_dict.values()), hubs[present])
+
+
+def test_queryTimeHits():
+    # Pages 0-2 are about cats; 3 and 4 link to them; 5 links to 3; 6 is unrelated.
+    corpus = ["cats", "cats and dogs", "cats everywhere", "list of pets", "more pets", "pet directories", "cars"]
+    edges  = {0: [1], 1: [], 2: [6], 3: [0, 1, 2], 4: [1, 2], 5: [3], 6: [2]}
+    hits = QueryTimeHITS(OkapiRetrieval(corpus), edges, hits=HITS(max_iterations=100, epsilon=1e-12), max_in_links=2)
+
+    # Root set {0,1,2}, their out-links {1,6}, and the first two pages linking to each: {3} for 0, {0,3} for 1, {3,4} for 2.
+    assert hits.baseSet("cat").tolist() == [0, 1, 2, 3, 4, 6]
+    hubs, authorities = hits.rank("cat", truncate_at=2)
+    assert [page for page, _ in hubs] == [3, 4]
+    assert {page for page, _ in authorities} == {1, 2}
+    assert not hits.hits.convergence.progress  # No progress bar for every query.
+    assert hits.rank("zebra") == ([], [])
+
+
+def benchmark_queryTimeHits(n_nodes: int=100_000, n_queries: int=100):
+    """Milliseconds per query for query-time HITS on a crawl-sized graph, with a root set of 200 pages."""
+    rng = npr.default_rng(0)
+    vocabulary = [f"word{i}" for i in range(2000)]
+    corpus = [" ".join(rng.choice(vocabulary, size=20)) for _ in range(n_nodes)]
+    hits = QueryTimeHITS(OkapiRetrieval(corpus), _randomGraph(n_nodes, 10*n_nodes))
+    queries = [" ".join(rng.choice(vocabulary, size=2)) for _ in range(n_queries)]
+
+    start = time.perf_counter()
+    sizes = [len(hits.baseSet(query)) for query in queries]
+    base_time = time.perf_counter() - start
+    hits.retrieval.results.clear()  # Else the retrieval is free the second time.
+    start = time.perf_counter()
+    for query in queries:
+        hits.rank(query)
+    total_time = time.perf_counter() - start
+    print(f"Base sets of {np.mean(sizes):.0f} pages on average. Per query: {1000*base_time/n_queries:.1f} ms for the base set, {1000*total_time/n_queries:.1f} ms in total.")
+
+
+def _writeEdgeFile(path: Path, edges: Dict[int, List[int]]):
+    with open(path, "w", encoding="utf-8") as handle:
+        handle.write("# Directed graph\n// FromNodeId\tToNodeId\n")
+        for source, destinations in edges.items():
+            if source % 100 == 0:
+                handle.write(f"# Node {source}\n")
+            for destination in destinations:
+                handle.write(f"{source}\t{destination}\n")
+
+
+def _sameGraph(a: Graph, b: Graph) -> bool:
+    return a.n_nodes == b.n_nodes and np.array_equal(a.originalIds(), b.originalIds()) \
+       and (a.adjacency != b.adjacency).nnz == 0 and np.array_equal(a.out_degrees, b.out_degrees)
+
+
+def test_edgeFile():
+    edges = _randomGraph(500, 3000)
+    edges = {source: destinations for source, destinations in edges.items() if destinations}  # An edge file can't have sources without links.
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "edges.tsv"
+        _writeEdgeFile(path, edges)
+        for compact in [False, True]:
+            expected = Graph.fromDict(readEdges(path), compact=compact)
+            assert _sameGraph(Graph.fromEdgeFile(path, compact=compact, cache=False, chunk_size=100), expected)  # Lines are split over chunks.
+            assert _sameGraph(Graph.fromEdgeFile(path, compact=compact), expected)
+            cached = Graph.fromEdgeFile(path, compact=compact)  # From the cache this time.
+            assert not cached.adjacency.indices.flags.writeable  # Mapped from the file, read-only.
+            assert _sameGraph(cached, expected)
+
+        # PageRank works on the mapped graph as on any other.
+        pr = PageRank(teleportation_probability=0.15)
+        assert np.allclose(pr.getPageRankVector(Graph.fromEdgeFile(path)), pr.getPageRankVector(edges))
+        for compute in [lambda graph: pr.getPageRankVector(graph, nodes=10), lambda graph: pr.getPageRanks(graph, filter_sink_tail=True),
+                        lambda graph: HITS().getHITSVectors(graph, filter_sink_tail=True)]:  # Would be ignored for a Graph.
+            try:
+                compute(Graph.fromEdgeFile(path))
+                assert False
+            except ValueError:
+                pass
+
+        # A changed file invalidates the cache.
+        time.sleep(0.01)
+        with open(path, "a", encoding="utf-8") as handle:
+            handle.write("1000\t1001\n")
+        assert Graph.fromEdgeFile(path).n_nodes == 1002
+
+        # Indented comments are skipped. A line with one ID and a line with three have four IDs together, but aren't two
+        # links, and a comment after a link isn't something readEdges() accepts either.
+        other = Path(folder) / "other.tsv"
+        other.write_text("  # Indented\n1\t2\n", encoding="utf-8")
+        assert Graph.fromEdgeFile(other, cache=False).n_edges == 1
+        for lines in ["1\n2 3 4\n", "1\t2  # note\n"]:
+            other.write_text("1\t2\n" + lines, encoding="utf-8")
+            try:
+                Graph.fromEdgeFile(other, cache=False)
+                assert False
+            except ValueError:
+                pass
+
+
+def benchmark_edgeFile(n_nodes: int=1_000_000, n_edges: int=2_000_000):
+    """
+    Time and peak memory to read an edge file of a few million links, with readEdges() and with Graph.fromEdgeFile().
+    Memory is measured in a separate run, since tracing every allocation slows down readEdges() a lot.
+    """
+    rng = npr.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "edges.tsv"
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write("# Benchmark graph\n")
+            np.savetxt(handle, np.column_stack((rng.integers(0, n_nodes, n_edges), rng.integers(0, n_nodes, n_edges))), fmt="%d", delimiter="\t")
+        print(f"{n_edges} links, {path.stat().st_size/2**20:.0f} MiB of text")
+
+        for name, read in [("readEdges()",                          lambda: readEdges(path)),
+                           ("readEdges() + Graph.fromDict()",       lambda: Graph.fromDict(readEdges(path))),
+                           ("Graph.fromEdgeFile(), no cache",       lambda: Graph.fromEdgeFile(path, cache=False)),
+                           ("Graph.fromEdgeFile(), building cache", lambda: Graph.fromEdgeFile(path)),
+                           ("Graph.fromEdgeFile(), from cache",     lambda: Graph.fromEdgeFile(path))]:
+            start = time.perf_counter()
+            read()
+            duration = time.perf_counter() - start
+
+            if "building" in name:  # The second run would read the cache.
+                print(f"{name:>37}: {duration:6.2f} s")
+                continue
+            tracemalloc.start()
+            read()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:>37}: {duration:6.2f} s, peak {peak/2**20:5.0f} MiB")
+
+
+def benchmark_pagerank():
+    """
+    Time per PageRank computation, one edge at a time versus one sparse matrix product per iteration.
+    """
+    pr = PageRank(teleportation_probability=0.15, max_iterations=20)
+    for n_nodes in [1_000, 10_000, 100_000]:
+        edges = _randomGraph(n_nodes, 10*n_nodes)
+        N = max(max(edges), max(d for destinations in edges.values() for d in destinations)) + 1
+
+        start = time.perf_counter()
+        _loopPageRank(pr, edges, N)
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pr.getPageRankVector(edges)
+        sparse_time = time.perf_counter() - start
+        print(f"{n_nodes:>7} nodes: loop {loop_time:8.3f} s, sparse {sparse_time:6.3f} s ({loop_time/sparse_time:.0f}x)")
+
+
+def benchmark_pagerankSolvers(n_nodes: int=100_000):
+    """
+    Iterations and time until the PageRank vector changes less than 1e-10 (in L1 norm), for every solver and for
+    decreasing teleportation probabilities (which make power iteration slower).
+    """
+    edges = _localGraph(n_nodes, 10*n_nodes)
+    for teleportation_probability in [0.15, 0.05, 0.01]:
+        for solver in [PowerIteration(), GaussSeidel(), QuadraticExtrapolation()]:
+            pr = PageRank(teleportation_probability, max_iterations=5000, norm=1, epsilon=1e-10, solver=solver)
+            start = time.perf_counter()
+            pr.getPageRanks(edges)
+            print(f"1-gamma = {teleportation_probability}: {solver.name:>35}: {pr.convergence.iterations:>4} iterations, {time.perf_counter() - start:.2f} s")
+
+
+
+def benchmark_personalizedPagerank(n_nodes: int=100_000, n_seeds: int=256):
+    """
+    Time for 20 iterations of PageRank personalized to each of a few hundred single pages, one at a time (batches of 1)
+    versus in bigger batches.
+    """
+    edges = _localGraph(n_nodes, 10*n_nodes)
+    pr = PageRank(teleportation_probability=0.15, max_iterations=20, epsilon=0)
+    n_nodes = Graph.fromDict(edges).n_nodes
+    teleportation = PageRank.teleportToSeeds([[seed] for seed in npr.default_rng(0).choice(n_nodes, size=n_seeds, replace=False)], n_nodes)
+
+    for batch_size in [1, 4, 16, 64, 256]:
+        start = time.perf_counter()
+        pr.getPersonalizedPageRankVectors(edges, teleportation, batch_size=batch_size)
+        print(f"{n_seeds} seeds in batches of {batch_size:>3}: {time.perf_counter() - start:.2f} s")
+
+
+
+def benchmark_incrementalPagerank(n_nodes: int=100_000, n_new: int=2_000):
+    """Time to get the PageRanks of a crawl that grew by a few thousand pages, from scratch versus from the old ones."""
+    edges = _localGraph(n_nodes, 10*n_nodes)
+    pr = PageRank(teleportation_probability=0.15, max_iterations=1000, norm=1, epsilon=1e-12)
+    previous = pr.getPageRankVector(edges)
+    grown = _grow(edges, n_new)
+
+    start = time.perf_counter()
+    exact = pr.getPageRankVector(grown)
+    full_time = time.perf_counter() - start
+    print(f"From scratch: {full_time:.3f} s ({pr.convergence.iterations} iterations)")
+    for tolerance in [1e-9, 1e-10, 1e-11]:
+        start = time.perf_counter()
+        updated = pr.updatePageRankVector(previous, grown, tolerance=tolerance)
+        update_time = time.perf_counter() - start
+        print(f"Update with tolerance {tolerance}: {update_time:.3f} s ({pr.pushes/len(exact):.1f} pushes per node), L1 error {np.abs(updated - exact).sum():.1e}")
+
+    start = time.perf_counter()
+    Graph.fromDict(grown)
+    print(f"Of which converting the graph: {time.perf_counter() - start:.3f} s")
+
+
+
+def benchmark_crawler(n_pages: int=100, latency: float=0.1):
+    """Pages per second against local sites that take a while to respond, for more and more requests in flight."""
+    for requests_per_second_per_host in [1000, 10]:
+        for max_in_flight in [1, 2, 4, 8, 16]:
+            crawler = JACK(max_in_flight=max_in_flight, requests_per_second_per_host=requests_per_second_per_host)
+            crawl, _, duration = _crawlSites(crawler, n_sites=4, max_crawls=n_pages, latency=latency)
+            print(f"{requests_per_second_per_host:>4} requests/s per host, {max_in_flight:>2} in flight: {len(crawl)/duration:5.1f} pages/s")
 
 
 if __name__ == "__main__":